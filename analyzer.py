@@ -0,0 +1,94 @@
+"""Lightweight analyzer of the search queries and interest chips for the web workers. It gives the same tokens as the
+analyzer of the scraper's vectorizer (lowercasing, the tweet tokenizer, lemmatization and stop words) without loading
+scikit-learn, NLTK or PyMuPDF. Everything it needs is in a prebuilt artifact written by build_analyzer.py: the patterns of
+the tokenizer, the stop words and a lemma lookup table of the tokens whose lemma is a term of the vocabulary. Tokens that
+aren't in the table are kept as they are, which is what the lemmatizer does for most of them."""
+import html.entities
+import logging
+import regex
+import json
+import gzip
+import os
+
+ANALYZER_PATH = 'analyzer.json.gz'
+# Seconds the tokenizer can spend on a query, the phone number pattern backtracks a lot on long runs of digits
+TOKENIZE_TIMEOUT = 1.0
+
+ENTITY_RE = regex.compile(r'&(#?(x?))([^&;\s]+);')
+
+def replace_html_entities(text):
+    """Replaces the html entities with their characters and removes the ones that can't be converted, like the tweet
+    tokenizer does."""
+    def convert(match):
+        body = match.group(3)
+        if match.group(1):
+            try:
+                number = int(body, 16) if match.group(2) else int(body, 10)
+                # Browsers read the numbers 80-9F as Windows-1252 bytes
+                if 0x80 <= number <= 0x9F:
+                    return bytes((number,)).decode("cp1252")
+            except ValueError:
+                number = None
+        else:
+            number = html.entities.name2codepoint.get(body)
+        if number is not None:
+            try:
+                return chr(number)
+            except (ValueError, OverflowError):
+                pass
+        return ""
+    return ENTITY_RE.sub(convert, text)
+
+class Analyzer:
+    """Turns a text into the list of its terms. [word_pattern] and [hang_pattern] are (pattern, flags) pairs of the
+    tokenizer, [lemmas] maps a token to its lemma."""
+
+    def __init__(self, word_pattern, hang_pattern, stop_words, lemmas):
+        self.word_re = regex.compile(*word_pattern)
+        self.hang_re = regex.compile(*hang_pattern)
+        self.word_pattern = word_pattern
+        self.hang_pattern = hang_pattern
+        self.stop_words = frozenset(stop_words)
+        self.lemmas = lemmas
+
+    def __call__(self, text):
+        text = replace_html_entities(text.lower())
+        try:
+            words = self.word_re.findall(self.hang_re.sub(r"\1\1\1", text), timeout=TOKENIZE_TIMEOUT)
+        except TimeoutError:
+            logging.warning(f"Couldn't tokenize a text of {len(text)} characters in time")
+            return []
+        tokens = [token for token in words if len(token) > 1 and any(map(lambda x: x.isalpha(), token))]
+        terms = [self.lemmas.get(token, token) for token in tokens]
+        return [term for term in terms if term not in self.stop_words]
+
+    def save(self, path=ANALYZER_PATH):
+        # Writing to a temporary file first, so the web workers never load a half written artifact
+        temporary = path + '.tmp'
+        with gzip.open(temporary, 'wt', encoding='utf8') as file:
+            json.dump({
+                'word_pattern': self.word_pattern, 'hang_pattern': self.hang_pattern,
+                'stop_words': sorted(self.stop_words), 'lemmas': self.lemmas
+            }, file)
+        os.replace(temporary, path)
+
+    @classmethod
+    def load(cls, path=ANALYZER_PATH):
+        with gzip.open(path, 'rt', encoding='utf8') as file:
+            data = json.load(file)
+        return cls(data['word_pattern'], data['hang_pattern'], data['stop_words'], data['lemmas'])
+
+analyzer = None
+
+def get_analyzer():
+    """Returns the analyzer from the artifact, loaded on the first call. Without the artifact it falls back to the
+    analyzer of the scraper's vectorizer, which loads the whole scraping stack."""
+    global analyzer
+    if analyzer is None:
+        if os.path.exists(ANALYZER_PATH):
+            analyzer = Analyzer.load(ANALYZER_PATH)
+        else:
+            logging.warning(f"{ANALYZER_PATH} doesn't exist, build it with build_analyzer.py. Using the scraper's analyzer")
+            from arxiv_scraper import vectorizer
+            analyzer = vectorizer.build_analyzer()
+    return analyzer
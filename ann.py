@@ -0,0 +1,188 @@
+"""Approximate nearest neighbour index for the recommendations, used instead of scoring every paper in the time period
+when the corpus is large. The tf-idf vectors are projected to a small dense space with a hashed sparse random projection,
+and the papers are partitioned by spherical k-means into lists (IVF). A query scores only the papers in the [probes]
+lists closest to it, with the exact cosine from the ranking engine. More probes give better recall and slower queries.
+The lists are saved to a file, so the web workers of the shared serving mode load them instead of training k-means."""
+from ranking import engine
+from scipy.sparse import csr_matrix
+from metrics import stage
+import numpy as np
+import threading
+import logging
+import os
+
+ANN_PATH = 'ann_index.npz'
+DIMENSIONS = 128
+# Every term is projected to this many random dimensions with random signs
+HASHES_PER_TERM = 4
+PROBES = 8
+TRAINING_SAMPLE = 50000
+KMEANS_ITERATIONS = 10
+# The projection of the terms is generated in chunks, so it can grow with the vocabulary and stay the same for old terms
+PROJECTION_CHUNK = 2**16
+# Number of vectors assigned to the lists at once, it bounds the memory used by the vectors x centroids product
+ASSIGN_CHUNK = 8192
+
+def kmeans(vectors, n_lists, generator):
+    """Spherical k-means, returns the L2 normalized centroids."""
+    centroids = vectors[generator.choice(len(vectors), n_lists, replace=False)]
+    for _ in range(KMEANS_ITERATIONS):
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        membership = csr_matrix(
+            (np.ones(len(vectors), dtype=np.float32), (assignments, np.arange(len(vectors)))), shape=(n_lists, len(vectors))
+        )
+        sums = np.asarray(membership @ vectors)
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        # Empty lists keep their old centroids
+        centroids = np.where(norms > 0, sums / np.where(norms > 0, norms, 1), centroids).astype(np.float32)
+    return centroids
+
+class AnnIndex:
+    """IVF index over the papers of a RankingEngine. The lists hold paper ids, the candidates are scored by the engine.
+    If [path] is None nothing is saved."""
+
+    def __init__(self, engine, path=ANN_PATH, dimensions=DIMENSIONS, probes=PROBES, seed=0):
+        self.engine = engine
+        self.path = path
+        self.dimensions = dimensions
+        self.probes = probes
+        self.seed = seed
+        self.lock = threading.Lock()
+        self.built = False
+        # The web workers of the shared serving mode only load the file saved by the ingestion process
+        self.read_only = False
+        self.trained_size = 0
+        self.hash_dimensions = np.zeros((0, HASHES_PER_TERM), dtype=np.int32)
+        self.hash_signs = np.zeros((0, HASHES_PER_TERM), dtype=np.float32)
+        self.centroids = np.zeros((0, dimensions), dtype=np.float32)
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.lists = np.zeros(0, dtype=np.int64)
+        self.list_ptr = np.zeros(1, dtype=np.int64)
+        self.members = np.zeros(0, dtype=np.int64)
+
+    def projection(self, n_terms):
+        """Returns the n_terms x dimensions projection matrix."""
+        with self.lock:
+            while len(self.hash_dimensions) < n_terms:
+                generator = np.random.default_rng([self.seed, len(self.hash_dimensions) // PROJECTION_CHUNK])
+                size = (PROJECTION_CHUNK, HASHES_PER_TERM)
+                self.hash_dimensions = np.concatenate([self.hash_dimensions, generator.integers(0, self.dimensions, size, dtype=np.int32)])
+                self.hash_signs = np.concatenate([self.hash_signs, generator.choice([-1, 1], size).astype(np.float32)])
+            dimensions, signs = self.hash_dimensions[:n_terms], self.hash_signs[:n_terms]
+        return csr_matrix(
+            (signs.ravel() / np.sqrt(HASHES_PER_TERM), dimensions.ravel(), np.arange(0, n_terms * HASHES_PER_TERM + 1, HASHES_PER_TERM)),
+            shape=(n_terms, self.dimensions)
+        )
+
+    def project(self, matrix):
+        """Projects the rows of a CSR matrix and normalizes them."""
+        vectors = np.asarray((matrix @ self.projection(matrix.shape[1])).todense(), dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms > 0, norms, 1)
+
+    def assign(self, vectors, centroids):
+        return np.concatenate([
+            np.argmax(vectors[i:i+ASSIGN_CHUNK] @ centroids.T, axis=1) for i in range(0, len(vectors), ASSIGN_CHUNK)
+        ] or [np.zeros(0, dtype=np.int64)])
+
+    def set_lists(self, ids, lists, centroids):
+        order = np.argsort(lists, kind='stable')
+        list_ptr = np.zeros(len(centroids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(lists, minlength=len(centroids)), out=list_ptr[1:])
+        with self.lock:
+            self.ids, self.lists, self.centroids = ids, lists, centroids
+            self.list_ptr, self.members = list_ptr, ids[order]
+            self.built = True
+
+    def build(self):
+        """Trains the lists on a sample of the engine's papers and assigns all of them."""
+        with self.engine.lock:
+            matrix, ids = self.engine.matrix, self.engine.ids
+        generator = np.random.default_rng(self.seed)
+        vectors = self.project(matrix)
+        n_lists = max(1, min(int(np.sqrt(len(ids))), len(ids)))
+        sample = generator.choice(len(ids), min(len(ids), TRAINING_SAMPLE), replace=False) if len(ids) else []
+        centroids = kmeans(vectors[sample], n_lists, generator) if len(ids) else np.zeros((1, self.dimensions), dtype=np.float32)
+        self.set_lists(ids, self.assign(vectors, centroids), centroids)
+        self.trained_size = len(ids)
+        self.save()
+        logging.info(f"ANN index built with {len(ids)} papers in {len(centroids)} lists")
+
+    def save(self):
+        if self.path is None:
+            return
+        with self.lock:
+            arrays = {'ids': self.ids, 'lists': self.lists, 'centroids': self.centroids, 'trained_size': np.array(self.trained_size)}
+        # Writing to a temporary file first, so a crash never leaves a half written index
+        temporary = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp.npz"
+        np.savez(temporary, **arrays)
+        os.replace(temporary, self.path)
+
+    def ensure_built(self):
+        """Loads the lists from the disk, or builds them if the file doesn't exist. Returns False if the index is read only
+        and there is no file yet, the recommendations are then scored exactly."""
+        if self.built:
+            return True
+        if self.path is not None and os.path.exists(self.path):
+            with np.load(self.path) as data:
+                self.set_lists(data['ids'], data['lists'], data['centroids'])
+                self.trained_size = int(data['trained_size'])
+            return True
+        if self.read_only:
+            logging.warning(f"ANN index {self.path} not found, it is built by the ingestion process")
+            return False
+        self.build()
+        return True
+
+    def update(self, new_ids):
+        """Adds the papers with [new_ids] (they have to be in the engine already) to the nearest lists. The lists are trained
+        again when the number of papers doubled since the last training."""
+        if not self.built and self.path is not None and os.path.exists(self.path):
+            self.ensure_built()
+        if not self.built or len(self.ids) + len(new_ids) > 2 * self.trained_size:
+            self.build()
+            return
+        rows = self.engine.rows(new_ids)
+        rows = rows[rows >= 0]
+        with self.engine.lock:
+            new_ids = self.engine.ids[rows]
+            vectors = self.project(self.engine.matrix[rows])
+        keep = ~np.isin(self.ids, new_ids)
+        self.set_lists(
+            np.concatenate([self.ids[keep], new_ids]),
+            np.concatenate([self.lists[keep], self.assign(vectors, self.centroids)]),
+            self.centroids
+        )
+        self.save()
+        logging.info(f"ANN index updated with {len(new_ids)} papers")
+
+    def top_k(self, vector, k, since=None, probes=None):
+        """Returns the ids and cosine scores of the [k] best papers updated since [since] among the papers in the [probes]
+        lists closest to the [vector]."""
+        probes = probes or self.probes
+        with self.lock:
+            centroids, list_ptr, members = self.centroids, self.list_ptr, self.members
+        query = csr_matrix(
+            (vector.weights, vector.ids, [0, len(vector)]), shape=(1, int(vector.ids.max()) + 1 if len(vector) else 0)
+        )
+        query = self.project(query)[0]
+        probes = min(probes, len(centroids))
+        best_lists = np.argpartition(-(centroids @ query), probes - 1)[:probes]
+        candidates = np.concatenate([members[list_ptr[l]:list_ptr[l+1]] for l in best_lists])
+
+        # The rows of the engine are sorted by date, so the time period is a lower bound on the row number
+        rows = self.engine.rows(candidates)
+        rows = rows[rows >= max(self.engine.window(since), 0)]
+        with stage('scoring'):
+            scores = self.engine.score_rows(vector, rows)
+        with stage('sorting'):
+            if k < len(rows):
+                best = np.argpartition(-scores, k)[:k]
+            else:
+                best = np.arange(len(rows))
+            best = best[np.argsort(-scores[best], kind='stable')]
+        with self.engine.lock:
+            ids = self.engine.ids[rows[best]]
+        return ids, scores[best]
+
+ann_index = AnnIndex(engine)
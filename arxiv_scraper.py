@@ -1,44 +1,80 @@
 from sklearn.feature_extraction.text import TfidfVectorizer
 from nltk.tokenize import TweetTokenizer
-from nltk.tag import pos_tag
+from nltk.tag import pos_tag, PerceptronTagger
 from nltk.stem import WordNetLemmatizer
-from nltk.corpus import wordnet
-from database import db, Paper
-import dateutil.parser
+from nltk.corpus.reader.wordnet import ADJ, NOUN, VERB, ADV
+from database import db, Paper, Ingestion, IngestionCursor, get_term_ids
+from vectors import SparseVector
+from vocabulary import Vocabulary, DRIFT_THRESHOLD, vocabulary
+from pipeline import Pipeline
+from text_store import text_store
+from metrics import scraper_stage_seconds, scraper_failures
+from listing import AtomListing, LISTING_INTERVAL, PREFETCH_PAGES
+from scipy.sparse import csr_matrix
+from collections import OrderedDict, Counter
+from multiprocessing import Pool
+import re
+import numpy as np
 import warnings
-import fitz
-import feedparser
-import requests
 import logging
+import time
 
 # Ignoring scikit learn warnings from the tf-idf vectorizer
 warnings.filterwarnings("ignore")
 
+# Maps the first character of a POS tag to the wordnet POS that lemmatize() accepts
+TAG_DICT = {
+    "J": ADJ,
+    "N": NOUN,
+    "V": VERB,
+    "R": ADV,
+}
+
 def get_wordnet_pos(word):
     """Map POS tag to first character lemmatize() accepts"""
     tag = pos_tag([word])[0][1][0].upper()
-    tag_dict = {
-        "J": wordnet.ADJ,
-        "N": wordnet.NOUN,
-        "V": wordnet.VERB,
-        "R": wordnet.ADV,
-    }
-    return tag_dict.get(tag, wordnet.NOUN)
+    return TAG_DICT.get(tag, NOUN)
+
+# The tagger is loaded once per process, pos_tag() loads it again on every call
+tagger = None
+def get_tagger():
+    global tagger
+    if tagger is None:
+        tagger = PerceptronTagger()
+    return tagger
+
+# Bounded LRU cache of token -> lemma shared by all the documents normalized in this process
+LEMMA_CACHE_SIZE = 2**18
+lemma_cache = OrderedDict()
+
+def lemmatize_tokens(tokens):
+    """Lemmatizes the tokens the same way as lemmatizer.lemmatize(token, get_wordnet_pos(token)), but every distinct token
+    is tagged and lemmatized only once. Tokens that aren't in the cache are tagged together in one batch."""
+    missing = [token for token in dict.fromkeys(tokens) if token not in lemma_cache]
+    if missing:
+        # Every token is tagged as a separate sentence, so the tags are the same as the ones from pos_tag([token])
+        for token, tagged in zip(missing, get_tagger().tag_sents([[token] for token in missing])):
+            lemma_cache[token] = lemmatizer.lemmatize(token, TAG_DICT.get(tagged[0][1][0].upper(), NOUN))
+
+    lemmas = [lemma_cache[token] for token in tokens]
+    for token in dict.fromkeys(tokens):
+        lemma_cache.move_to_end(token)
+    while len(lemma_cache) > LEMMA_CACHE_SIZE:
+        lemma_cache.popitem(last=False)
+    return lemmas
 
 lemmatizer = WordNetLemmatizer()
 tokenizer = TweetTokenizer()
 def text_normalization(text):
-    processed = []
-    text_tokens = tokenizer.tokenize(text)                
-    for token in text_tokens:
-        if not any(map(lambda x: x.isalpha(), token)):
-            continue
-        if len(token) == 1:
-            continue
-        # Lemmatization
-        token = lemmatizer.lemmatize(token, get_wordnet_pos(token))
-        processed.append(token)
-    return processed
+    text_tokens = tokenizer.tokenize(text)
+    text_tokens = [token for token in text_tokens if len(token) > 1 and any(map(lambda x: x.isalpha(), token))]
+    # Lemmatization
+    return lemmatize_tokens(text_tokens)
+
+def normalize_documents(texts, processes=None):
+    """Normalizes a list of texts in a pool of [processes] worker processes, every worker has its own lemma cache."""
+    with Pool(processes) as pool:
+        return pool.map(text_normalization, texts, chunksize=8)
 
 vectorizer = TfidfVectorizer(
     input='content',
@@ -51,151 +87,265 @@ vectorizer = TfidfVectorizer(
     stop_words='english'
 )
 
-def get_papers(starting_date, debug=False):
-    """Download all the papers from the arxiv API that were submitted since [starting_date] and add them to the database.
-    [strating_date] needs to have all the parameters (year, month, day, hour,...) and include tzinfo."""
-    BASE_URL = 'http://export.arxiv.org/api/query?search_query='
-    SEARCH_CATEGORIES = 'cat:cs.CV+OR+cat:cs.LG+OR+cat:cs.CL+OR+cat:cs.AI+OR+cat:cs.NE+OR+cat:cs.RO'
-    MAX_RESULTS = 10
-    MAX_VECTOR_LENGTH = 1000
-
-    def try_again(link):
-        logging.error("There was a problem with downloading the pdf, trying again...")
-        try:
-            response = requests.get(link)
-            logging.info(f"Attempted to download the pdf again, status code: {response.status_code}")
-        except:
-            logging.error(f"Couldn't download the pdf from this link: {link}")
-            return -1
-        if response.status_code != 200:
-            logging.error(f"Couldn't download the pdf from this link: {link}")
-            return -1
-        return response
-    
-    def check_schema(structure, article):
-        """"Checks if the API response has a valid structure"""
-        if isinstance(structure, dict):
-            for key, item in structure.items():
-                if key not in article:
-                    logging.error(f"The structure of the API response is invalid. The element: \'{key}\' not found")
-                    return False
-                if type(item) != type:
-                    return check_schema(item, article[key])
-                if type(article[key]) != item:
-                    logging.error(f"The structure of the API response is invalid. The type of item article[\'{key}\'] is uncorrect")
-                    return False
-                return True
+# The vectorizer is only used for its analyzer (tokenization and stop words), the vocabulary and idf are kept in [vocabulary].
+# The web workers tokenize with the lighter analyzer from analyzer.py instead
+
+def reweight_papers():
+    """Re-weights all the paper vectors with the current idf and normalizes them again. Needs an app context."""
+    vocabulary.ensure_loaded()
+    logging.info(f"Re-weighting paper vectors, idf drift: {vocabulary.drift():.4f}")
+    idf = vocabulary.idf()
+    ratio = idf / vocabulary.weighted_idf
+    for paper in Paper.query.all():
+        ids = paper.vector.ids
+        weights = paper.vector.weights.astype(np.float64)
+        # Terms that aren't in the vocabulary keep their weights
+        known = ids < len(ratio)
+        weights[known] *= ratio[ids[known]]
+        norm = np.sqrt(weights @ weights)
+        if norm > 0:
+            weights = weights / norm
+        paper.vector = SparseVector(ids, weights)
+    db.session.commit()
+    vocabulary.weighted_idf = idf
+    vocabulary.epoch += 1
+    vocabulary.save()
+
+MAX_VECTOR_LENGTH = 1000
+
+def paper_vectors(result):
+    """Converts the rows of the tf-idf CSR matrix to SparseVectors with the MAX_VECTOR_LENGTH highest weights. The rows
+    are never densified, the top weights are selected from the stored values of every row. Among equal weights the terms
+    with the lower ids are kept."""
+    result = csr_matrix(result)
+    result.sort_indices()
+    vectors = []
+    for i in range(result.shape[0]):
+        # The column numbers are the term ids
+        begin, end = result.indptr[i], result.indptr[i + 1]
+        terms, weights = result.indices[begin:end], result.data[begin:end]
+        positive = weights > 0
+        terms, weights = terms[positive], weights[positive]
+        if len(weights) > MAX_VECTOR_LENGTH:
+            kth = np.partition(weights, len(weights) - MAX_VECTOR_LENGTH)[len(weights) - MAX_VECTOR_LENGTH]
+            above = weights > kth
+            # The terms are sorted, so the ties at the kth weight are taken from the lowest ids
+            ties = np.flatnonzero(weights == kth)[:MAX_VECTOR_LENGTH - np.count_nonzero(above)]
+            above[ties] = True
+            terms, weights = terms[above], weights[above]
+        vectors.append(SparseVector(terms, weights))
+    return vectors
+
+BASE_URL = 'http://export.arxiv.org/api/query?search_query='
+SEARCH_CATEGORIES = 'cat:cs.CV+OR+cat:cs.LG+OR+cat:cs.CL+OR+cat:cs.AI+OR+cat:cs.NE+OR+cat:cs.RO'
+# Number of papers vectorized and committed together
+BATCH_SIZE = 50
+# Articles whose pdf couldn't be downloaded or converted this many times are skipped
+MAX_ATTEMPTS = 3
+
+def parse_arxiv_id(site_link):
+    """Splits the link to the abstract page (e.g. http://arxiv.org/abs/2401.01234v2) to the arXiv id and the version."""
+    match = re.search(r'abs/(.+?)(?:v(\d+))?$', site_link)
+    if match is None:
+        return site_link, 1
+    return match.group(1), int(match.group(2) or 1)
+
+def replaced_documents(papers):
+    """Returns the tokens of the stored versions of the [papers] (rows with the site_link and the vector) that new versions
+    replace. The text is read from the store and tokenized again, a text that isn't there anymore is approximated by the
+    terms of the paper vector (it's missing the terms pruned by MAX_DF or past MAX_VECTOR_LENGTH)."""
+    analyzer = None
+    documents = []
+    for paper in papers:
+        text = text_store.get_text(*parse_arxiv_id(paper.site_link))
+        if text is not None:
+            analyzer = analyzer or vectorizer.build_analyzer()
+            documents.append(analyzer(text))
         else:
-            for i, item in enumerate(structure):
-                if type(item) != type:
-                    return check_schema(item, article[i])
-                if type(article[i]) != item:
-                    logging.error(f"The structure of the API response is invalid. The type of item article[\'{key}\'] is uncorrect")
-                    return False
-                return True
-
-    collection = []
-    ids = []
-    start_index = 0
-    not_last = True
+            documents.append([vocabulary.terms[i] for i in paper.vector.ids if i < len(vocabulary.terms)])
+    return documents
+
+def get_papers(starting_date, debug=False, base_url=BASE_URL, listing_interval=LISTING_INTERVAL):
+    """Download all the papers from the arxiv API that were submitted since [starting_date] and add them to the database.
+    [strating_date] needs to have all the parameters (year, month, day, hour,...) and include tzinfo.
+    [base_url] can point to a local server that serves the Atom feed and the pdfs (for testing).
+    [listing_interval] is the minimum number of seconds between two requests for the pages of the listing.
+    The progress of every article is kept in the Ingestion log, so a run that is started again skips the papers that are
+    already in the database and continues the listing where an interrupted run stopped.
+    Returns the ids of the new (and updated) papers of this run, the papers of all the runs that weren't published yet
+    are returned by unpublished_paper_ids()."""
+    # Start index of the page that is being listed
+    listing_index = 0
+
+    def list_articles(start_index=0):
+        """Yields the valid articles from the API response, page by page, until an article older than [starting_date].
+        The next pages are downloaded and parsed in the background while the articles of this one are processed."""
+        nonlocal listing_index
+        # The debug mode only lists the first page
+        listing = AtomListing(
+            base_url + SEARCH_CATEGORIES, start_index, prefetch=0 if debug else PREFETCH_PAGES, interval=listing_interval,
+            max_pages=1 if debug else None
+        )
+        for listing_index, articles in listing:
+            for article in articles:
+                # Comparing the updated date of the article and the [starting_date]
+                if article['updated_date'] < starting_date:
+                    return
+                logging.info(f"The link to the pdf from the arXiv API: {article['pdf_link']}")
+                yield article
+
     logging.info(f"Downloading the newest papers from the arXiv API since {starting_date} in {'normal mode' if not debug else 'debug mode'}")
-    while not_last:
-        url_parameters = f'&sortBy=lastUpdatedDate&start={start_index}&max_results={MAX_RESULTS}'
-        url = BASE_URL + SEARCH_CATEGORIES + url_parameters
-        
-        # Sending HTTP GET request to the API and converting the response from the Atom format to python dict
-        api_response = feedparser.parse(url)
-
-        if len(api_response['entries']) == 0:
-            break
-
-        for article in api_response['entries']:
-            # Checking the schema of the API response
-            api_structure = {
-                'updated': str,
-                'published': str,
-                'title': str,
-                'summary': str,
-                'authors': [{'name': str}, {'name': str}, {'name': str}],
-                'links': [{'href': str}, {'href': str}]
-            }
-            if not check_schema(api_structure, article):
-                continue
 
-            # Comparing the updated date of the article and the [starting_date]
-            updated_date = dateutil.parser.isoparse(article['updated'])
-            if updated_date < starting_date:
-                not_last = False
-                break
-
-            # Getting the data from the API response
-            pdf_link = article['links'][1]['href']
-            site_link = article['links'][0]['href']
-            title = article['title']
-            abstract = article['summary']
-            authors = ", ".join(map(lambda x: x['name'], article['authors']))
-            logging.info(f"The link to the pdf from the arXiv API: {pdf_link}")
-
-            # Downloading the pdf
-            try:
-                response = requests.get(pdf_link)
-                logging.info(f"Attempted to download the pdf, status code: {response.status_code}")
-            except:
-                response = try_again(pdf_link)
-                if response == -1:
-                    continue
-        
-            if response.status_code != 200:
-                response = try_again(pdf_link)
-                if response == -1:
-                    continue
-            
-            # Converting the pdf to text
-            try:
-                with fitz.open("pdf", response.content) as document:
-                    text = chr(12).join([page.get_text() for page in document])
-                collection.append(text)
-                logging.info(f"Succesfully converted the pdf from this link: {pdf_link}")
-            except:
-                logging.error(f"Couldn't convert the pdf from this link: {pdf_link}")
+    # The debug mode doesn't touch the database, so it uses a separate vocabulary with its own ids
+    if debug:
+        documents = [tokens for _, _, tokens in Pipeline(vectorizer).run(list_articles())]
+        if len(documents) == 0:
+            logging.error(f"Downloading the pdf's from the arXiv API was unsuccessful. Starting date: {starting_date}")
+            return []
+        debug_vocabulary = Vocabulary()
+        debug_vocabulary.add_documents(documents)
+        return debug_vocabulary.transform(documents), debug_vocabulary
+
+    vocabulary.ensure_loaded()
+    # A run that crashed for the same [starting_date] is continued from the first page it didn't finish
+    cursor = db.session.get(IngestionCursor, starting_date.replace(tzinfo=None))
+    if cursor is None:
+        cursor = IngestionCursor(starting_date=starting_date.replace(tzinfo=None), start_index=0)
+        db.session.add(cursor)
+    elif cursor.finished:
+        cursor.start_index, cursor.finished = 0, False
+    else:
+        logging.info(f"Continuing an interrupted run from the article number {cursor.start_index} of the listing")
+
+    entries = {}
+    queued = set()
+    pages = {}
+    # Number of unfinished articles of every page of the listing, the cursor moves past the pages without them
+    unfinished = Counter()
+
+    def new_articles():
+        """Yields the listed articles that aren't in the database yet (or are newer versions of papers that are)."""
+        for article in list_articles(cursor.start_index):
+            arxiv_id, version = parse_arxiv_id(article['site_link'])
+            # The listing can shift while it's read, so the same article can come twice
+            if arxiv_id in queued:
+                continue
+            entry = db.session.get(Ingestion, arxiv_id)
+            if entry is not None and entry.state in ('vectorized', 'committed', 'published') and entry.version >= version:
+                continue
+            if entry is not None and entry.version == version and entry.attempts >= MAX_ATTEMPTS:
+                logging.warning(f"Skipping {arxiv_id}v{version}, it failed {entry.attempts} times")
                 continue
+            if entry is None:
+                entry = Ingestion(arxiv_id=arxiv_id, version=version, attempts=0)
+                db.session.add(entry)
+            elif entry.version != version:
+                entry.version, entry.attempts = version, 0
+            entry.state = 'listed'
+            entry.attempts += 1
+            entry.updated_date = article['updated_date'].replace(tzinfo=None)
+            entries[article['site_link']] = entry
+            queued.add(arxiv_id)
+            pages[article['site_link']] = listing_index
+            unfinished[listing_index] += 1
+            yield article
+
+    def finish(article):
+        unfinished[pages.pop(article['site_link'])] -= 1
+
+    def progress(article, stage, content):
+        if stage == 'fetched':
+            entries[article['site_link']].state = 'fetched'
+            if text_store.keep_pdfs:
+                text_store.put(*parse_arxiv_id(article['site_link']), 'pdf', content)
+        else:
+            finish(article)
+
+    def cached_text(article):
+        return text_store.get_text(*parse_arxiv_id(article['site_link']))
+
+    ids = []
+
+    def commit_batch(batch):
+        """Vectorizes the [batch] of (article, tokens) and commits the papers together with the ingestion log."""
+        documents = [tokens for _, tokens in batch]
+        with scraper_stage_seconds.time(stage='vectorization'):
+            vocabulary.add_documents(documents, assign_ids=lambda terms: get_term_ids(terms, create=True))
+            vectors = paper_vectors(vocabulary.transform(documents))
+        start = time.perf_counter()
+        # The new terms are committed first, so the vocabulary never has ids that aren't in the Term table
+        db.session.commit()
+
+        # The new versions of papers that are already in the database are updated together in one statement
+        known = [entries[article['site_link']].paper_id for article, _ in batch]
+        existing = {paper.id: paper for paper in db.session.execute(
+            db.select(Paper.id, Paper.site_link, Paper.vector)
+            .where(Paper.id.in_([paper_id for paper_id in known if paper_id is not None]))
+        )}
+        new_papers = []
+        updates = []
+        for (article, _), vector in zip(batch, vectors):
+            entry = entries[article['site_link']]
+            if entry.paper_id in existing:
+                # A new version of a paper replaces the old one
+                updates.append({'id': entry.paper_id, 'vector': vector, **article})
+            else:
+                paper = Paper(vector=vector, **article)
+                db.session.add(paper)
+                new_papers.append((entry, paper))
+            entry.state = 'vectorized'
+            finish(article)
+        try:
+            if updates:
+                db.session.execute(db.update(Paper), updates)
+            db.session.flush()
+            for entry, paper in new_papers:
+                entry.paper_id = paper.id
+            cursor.start_index = min((index for index, count in unfinished.items() if count > 0), default=listing_index)
+            db.session.commit()
+        except Exception:
+            logging.exception(f"Couldn't add a batch of {len(batch)} papers to the database")
+            db.session.rollback()
+            # The papers aren't in the database, so they don't count in the document frequencies
+            vocabulary.remove_documents(documents)
+            scraper_failures.inc(stage='commit')
+            return
+        papers = [(entries[article['site_link']], entries[article['site_link']].paper_id) for article, _ in batch]
+        ids.extend(paper_id for _, paper_id in papers)
+
+        # The replaced versions don't count in the document frequencies anymore
+        if updates:
+            vocabulary.remove_documents(replaced_documents([existing[update['id']] for update in updates]))
+        vocabulary.save()
+        for entry, _ in papers:
+            entry.state = 'committed'
+        db.session.commit()
+        scraper_stage_seconds.observe(time.perf_counter() - start, stage='commit')
+        logging.info(f"Added a batch of {len(batch)} papers to the database")
+
+    # The pdfs are downloaded and converted concurrently, the results come in the order in which they are finished and
+    # they are vectorized and committed in batches. The texts are kept in the store, so the papers can be vectorized
+    # again without downloading them
+    batch = []
+    for article, text, tokens in Pipeline(vectorizer).run(new_articles(), progress, cached_text):
+        entries[article['site_link']].state = 'extracted'
+        text_store.put_text(*parse_arxiv_id(article['site_link']), text)
+        batch.append((article, tokens))
+        if len(batch) == BATCH_SIZE:
+            commit_batch(batch)
+            batch = []
+    if batch:
+        commit_batch(batch)
+
+    cursor.start_index, cursor.finished = 0, True
+    db.session.commit()
+
+    if len(ids) == 0:
+        logging.error(f"No new papers were added from the arXiv API. Starting date: {starting_date}")
+        return []
+
+    # The new papers changed the document frequencies, the old vectors are re-weighted only when the change is big enough
+    if vocabulary.drift() > DRIFT_THRESHOLD:
+        reweight_papers()
 
-            # Creating a new database entry
-            if not debug:
-                new_paper = Paper(
-                    title=title,
-                    authors=authors,
-                    abstract=abstract,
-                    pdf_link=pdf_link,
-                    site_link=site_link,
-                    vector = dict(),
-                    updated_date=updated_date,
-                )
-                db.session.add(new_paper)
-                try:
-                    db.session.commit()
-                    ids.append(new_paper.id)
-                except:
-                    logging.error(f"Couldn't add a new paper to the database, link: {site_link}")
-                    db.session.rollback()
-
-        if debug: break
-        start_index += MAX_RESULTS
-
-    if len(collection) == 0:
-        logging.error(f"Downloading the pdf's from the arXiv API was unsuccessful. Starting date: {starting_date}")
-        return
-    
-    result = vectorizer.fit_transform(collection)
-    if debug: return result, vectorizer
-
-    result = result.toarray()
-    for i, id in enumerate(ids):
-        paper = db.session.get(Paper, id)
-        vector = {}
-        for a,b in zip(vectorizer.get_feature_names_out(), result[i]):
-            vector[a] = b
-        vector = dict(sorted(vector.items(), key=lambda x: x[1], reverse=True)[:MAX_VECTOR_LENGTH])
-        paper.vector = vector
-    
-    db.session.commit()
\ No newline at end of file
+    return ids
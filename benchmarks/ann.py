@@ -0,0 +1,39 @@
+"""Benchmark of the ANN index against the exact ranking of the engine: recall@20 and queries/sec for several probes.
+Run from the repository root: python -m benchmarks.ann [--papers N] [--queries N]"""
+from ranking import RankingEngine
+from ann import AnnIndex
+from benchmarks.synthetic import Corpus
+from datetime import datetime, timedelta
+import numpy as np
+import argparse
+import time
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--papers', type=int, default=50000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=20)
+    args = parser.parse_args()
+
+    corpus = Corpus()
+    papers = corpus.papers(args.papers, length=300)
+    users = corpus.users(papers, args.queries)
+    engine = RankingEngine()
+    engine.build(papers)
+    since = datetime.now() - timedelta(weeks=52)
+
+    start = time.perf_counter()
+    exact = [set(engine.top_k(user, args.k, since)[0].tolist()) for user in users]
+    exact_speed = len(users) / (time.perf_counter() - start)
+
+    index = AnnIndex(engine, path=None)
+    start = time.perf_counter()
+    index.build()
+    print(f"Papers: {len(papers)}, lists: {len(index.centroids)}, build time: {time.perf_counter() - start:.1f}s")
+    print(f"Exact:      recall@{args.k} 1.000, {exact_speed:.1f} queries/sec")
+    for probes in [1, 2, 4, 8, 16, 32, 64]:
+        start = time.perf_counter()
+        results = [index.top_k(user, args.k, since, probes)[0] for user in users]
+        speed = len(users) / (time.perf_counter() - start)
+        recall = np.mean([len(exact[i] & set(result.tolist())) / args.k for i, result in enumerate(results)])
+        print(f"Probes {probes:>3}: recall@{args.k} {recall:.3f}, {speed:.1f} queries/sec")
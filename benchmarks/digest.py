@@ -0,0 +1,156 @@
+"""Benchmark of the email digests against a local SMTP stand-in: the digests/s and the peak memory of
+DigestMailer.send() for a synthetic corpus loaded into a temporary SQLite database. The stand-in can drop the connection
+before accepting every --drop-every-th message, so the retries are exercised too. The papers of the received digests are
+checked against the scores of RankingEngine for a sample of the users, and a second run must not send anything.
+Run from the repository root: python -m benchmarks.digest [--papers 20000] [--new 500] [--users 5000] [--drop-every 0]"""
+import os
+import re
+import sys
+import time
+import argparse
+import tempfile
+import threading
+import tracemalloc
+import email
+import socketserver
+import numpy as np
+
+SIMILAR_RE = re.compile(rb'/similar/(\d+)')
+
+def linked_papers(content):
+    """The ids of the papers linked in the html part of the message, in order."""
+    html = next(part for part in email.message_from_bytes(content).walk() if part.get_content_type() == 'text/html')
+    return list(dict.fromkeys(int(i) for i in SIMILAR_RE.findall(html.get_payload(decode=True))))
+
+class SMTPStandIn(socketserver.ThreadingTCPServer):
+    """Accepts every message and keeps the ids of the papers linked in it by recipient."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, drop_every=0):
+        super().__init__(('127.0.0.1', 0), SMTPHandler)
+        self.drop_every = drop_every
+        self.lock = threading.Lock()
+        self.messages = 0
+        self.dropped = 0
+        self.papers = {}
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    disable_nagle_algorithm = True
+
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        self.reply('220 localhost SMTP stand-in')
+        recipient = None
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('ascii', 'replace').strip()
+            verb = command[:4].upper()
+            if verb in ('EHLO', 'HELO'):
+                self.reply('250 localhost')
+            elif verb == 'RCPT':
+                recipient = command.split(':', 1)[1].strip().strip('<>')
+                self.reply('250 OK')
+            elif verb in ('MAIL', 'RSET', 'NOOP'):
+                self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                lines = []
+                while True:
+                    data_line = self.rfile.readline()
+                    if not data_line or data_line == b'.\r\n':
+                        break
+                    lines.append(data_line)
+                with server.lock:
+                    drop = server.drop_every and (server.messages + server.dropped + 1) % server.drop_every == 0
+                    if drop:
+                        server.dropped += 1
+                    else:
+                        server.messages += 1
+                        server.papers[recipient] = linked_papers(b''.join(lines))
+                if drop:
+                    # Closing the connection without an answer, the client has to send the message again
+                    return
+                self.reply('250 OK: queued')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--papers', type=int, default=20000)
+    parser.add_argument('--new', type=int, default=500, help="number of papers of the last download")
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--connections', type=int, default=4)
+    parser.add_argument('--drop-every', type=int, default=0)
+    parser.add_argument('--sample', type=int, default=50, help="number of users whose digests are checked")
+    args = parser.parse_args()
+
+    # The database and every file the app saves are in a temporary directory. The database has to be set before the app
+    # is imported, main.py reads FLASK_* variables from the environment
+    directory = tempfile.mkdtemp()
+    os.environ['FLASK_SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{os.path.join(directory, 'digest.db')}"
+    from main import app, db
+    from ranking import engine
+    from database import Digest
+    from metrics import digest_deliveries
+    from benchmarks.synthetic import Corpus, load_database, use_directory
+    import digest
+    import bcrypt
+    use_directory(directory)
+
+    corpus = Corpus()
+    papers = corpus.papers(args.papers, length=500)
+    users = corpus.users(papers, args.users)
+    # The newest papers are the ones of the last download
+    new_ids = [paper_id for paper_id, _, _ in sorted(papers, key=lambda paper: paper[1])[-args.new:]]
+
+    server = SMTPStandIn(args.drop_every)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    digest.RETRY_DELAY = 0.01
+    digest.digest_mailer.host, digest.digest_mailer.port = server.server_address
+    digest.digest_mailer.connections = args.connections
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        load_database(db, papers, users, bcrypt.hashpw(b"benchmark", bcrypt.gensalt(rounds=4)))
+        engine.refresh()
+
+        start = time.perf_counter()
+        stats = digest.digest_mailer.send(new_ids)
+        elapsed = time.perf_counter() - start
+        # The memory is measured by sending everything again, tracemalloc slows the rendering down a lot
+        db.session.execute(db.delete(Digest))
+        db.session.commit()
+        tracemalloc.start()
+        digest.digest_mailer.send(new_ids)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        second = digest.digest_mailer.send(new_ids)
+
+        rows = engine.rows(new_ids)
+        mismatches = 0
+        for i in np.random.default_rng(0).choice(len(users), min(args.sample, len(users)), replace=False):
+            scores = engine.score_rows(users[i], rows)
+            order = np.lexsort((np.arange(len(rows)), -scores))[:digest.DIGEST_LENGTH]
+            expected = [int(engine.ids[rows[j]]) for j in order if scores[j] > digest.MIN_SCORE]
+            mismatches += server.papers.get(f"user{i}@example.com", []) != expected
+
+    retried = digest_deliveries.values.get(('retried',), 0)
+    print(f"{args.users} users, {len(new_ids)} new papers of {args.papers}, {args.connections} SMTP connections")
+    print(
+        f"sent {stats['sent']}, failed {stats['failed']}, skipped {stats['skipped']}, retried {retried}, "
+        f"received {server.messages} in both runs (dropped {server.dropped})"
+    )
+    print(f"{stats['sent'] / elapsed:.0f} digests/s ({elapsed:.2f}s), peak traced memory {peak / 2**20:.1f} MiB")
+    print(f"second run sent {second['sent']}, digests different from RankingEngine scores: {mismatches} of {args.sample}")
+    server.shutdown()
+    sys.exit(1 if mismatches or second['sent'] else 0)
@@ -0,0 +1,132 @@
+"""Benchmark of the listing stage of get_papers against a local mock of the arXiv API that replays recorded Atom feeds.
+The entries of the recorded feeds (every *.xml file in --feeds, e.g. saved with --record from the real API) are served
+sorted by the update date for any start and max_results, with --latency seconds of delay per request. Without --feeds the
+entries are synthetic. The old listing (blocking feedparser pages of 10 articles, one at a time) is compared with
+AtomListing. Run from the repository root:
+python -m benchmarks.listing [--feeds DIR] [--record DIR] [--entries 2000] [--latency 0.3] [--interval 0]"""
+from listing import AtomListing, PAGE_SIZE, PREFETCH_PAGES, parse_page
+from arxiv_scraper import BASE_URL, SEARCH_CATEGORIES
+from urllib.parse import urlparse, parse_qs
+from datetime import datetime, timedelta, timezone
+import http.server
+import urllib.request
+import feedparser
+import threading
+import argparse
+import glob
+import time
+import re
+import os
+
+ENTRY_RE = re.compile(r'<entry>.*?</entry>', re.DOTALL)
+UPDATED_RE = re.compile(r'<updated>(.*?)</updated>')
+HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n<feed xmlns="http://www.w3.org/2005/Atom">'
+
+def recorded_entries(directory):
+    """The distinct <entry> elements of the recorded feeds, newest first."""
+    entries = {}
+    for path in sorted(glob.glob(os.path.join(directory, '*.xml'))):
+        with open(path, encoding='utf8') as file:
+            for entry in ENTRY_RE.findall(file.read()):
+                entries[entry] = UPDATED_RE.search(entry).group(1)
+    return sorted(entries, key=entries.get, reverse=True)
+
+def synthetic_entries(count):
+    now = datetime.now(timezone.utc)
+    entries = []
+    for i in range(count):
+        updated = (now - timedelta(minutes=i)).strftime('%Y-%m-%dT%H:%M:%SZ')
+        entries.append(
+            f'<entry><id>http://arxiv.org/abs/2401.{i:05d}v1</id><updated>{updated}</updated><published>{updated}</published>'
+            f'<title>Paper {i}</title><summary>{"An abstract of a paper about neural networks. " * 20}</summary>'
+            + ''.join(f'<author><name>Author {j}</name></author>' for j in range(5)) +
+            f'<link href="http://arxiv.org/abs/2401.{i:05d}v1" rel="alternate" type="text/html"/>'
+            f'<link title="pdf" href="http://arxiv.org/pdf/2401.{i:05d}v1" rel="related" type="application/pdf"/></entry>'
+        )
+    return entries
+
+def replay_server(entries, latency):
+    """Starts the mock API in a background thread and returns the server and the base url of its listing."""
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            query = parse_qs(urlparse(self.path).query)
+            start, count = int(query['start'][0]), int(query['max_results'][0])
+            time.sleep(latency)
+            body = (HEADER + ''.join(entries[start:start + count]) + '</feed>').encode('utf8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/atom+xml')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            try:
+                self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                # The pages prefetched after the end of the listing are cancelled
+                pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}/api/query?search_query='
+
+def blocking_listing(url, page_size=10):
+    """The listing before AtomListing: one blocking request and parse per page."""
+    start_index = 0
+    while True:
+        entries = feedparser.parse(f'{url}&sortBy=lastUpdatedDate&start={start_index}&max_results={page_size}')['entries']
+        if len(entries) == 0:
+            return
+        yield start_index, entries
+        start_index += page_size
+
+def record(directory, pages, page_size):
+    os.makedirs(directory, exist_ok=True)
+    for page in range(pages):
+        url = f'{BASE_URL}{SEARCH_CATEGORIES}&sortBy=lastUpdatedDate&start={page * page_size}&max_results={page_size}'
+        with urllib.request.urlopen(url) as response, open(os.path.join(directory, f'page{page:04d}.xml'), 'wb') as file:
+            file.write(response.read())
+        time.sleep(3)
+
+def measure(pages):
+    start = time.perf_counter()
+    requests = articles = 0
+    for _, page in pages:
+        requests += 1
+        articles += len(page)
+    # The last request is the empty page
+    return time.perf_counter() - start, requests + 1, articles
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--feeds', help="directory with the recorded Atom feeds")
+    parser.add_argument('--record', help="save --pages pages of the real listing to this directory and exit")
+    parser.add_argument('--pages', type=int, default=10)
+    parser.add_argument('--entries', type=int, default=2000, help="number of synthetic entries without --feeds")
+    parser.add_argument('--latency', type=float, default=0.3)
+    parser.add_argument('--interval', type=float, default=0.0)
+    parser.add_argument('--page-size', type=int, default=PAGE_SIZE)
+    parser.add_argument('--prefetch', type=int, default=PREFETCH_PAGES)
+    args = parser.parse_args()
+
+    if args.record:
+        record(args.record, args.pages, args.page_size)
+        raise SystemExit
+
+    entries = recorded_entries(args.feeds) if args.feeds else synthetic_entries(args.entries)
+    server, url = replay_server(entries, args.latency)
+    # AtomListing must give every replayed article once and in order
+    expected = [article['site_link'] for article in parse_page((HEADER + ''.join(entries) + '</feed>').encode('utf8'))[1]]
+    listed = [article['site_link'] for _, page in AtomListing(url, page_size=args.page_size, interval=0) for article in page]
+    assert listed == expected, "AtomListing didn't list the replayed entries in order"
+
+    print(f"{len(entries)} entries, {args.latency * 1000:.0f} ms latency, {args.interval:.1f}s between requests")
+    for name, pages in [
+        ('blocking, 10 per page', blocking_listing(url)),
+        (f'AtomListing, {args.page_size} per page, prefetch {args.prefetch}',
+         AtomListing(url, page_size=args.page_size, prefetch=args.prefetch, interval=args.interval)),
+    ]:
+        elapsed, requests, articles = measure(pages)
+        print(f"{name:>40}: {elapsed:6.2f}s, {requests:4d} requests, {articles / elapsed:8.0f} articles/s")
+    server.shutdown()
@@ -0,0 +1,108 @@
+"""Evaluation of the LSA recommender against the exact cosine of the ranking engine on a synthetic corpus: the agreement
+of the rankings (overlap of the top k, Spearman correlation of all the scores in the time period and NDCG@k of the LSA
+ranking with the exact scores as the gains), the scoring latency, the time to train the SVD from scratch and to merge
+the newest papers into it incrementally, the profile updates and the memory of the vectors.
+Run from the repository root: python -m benchmarks.lsa [--papers 20000] [--users 200] [--dimensions 256] [--k 20]"""
+from ranking import RankingEngine
+from lsa import LsaIndex
+from recommender import update_user_profile_batch
+from benchmarks.synthetic import Corpus
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from scipy.stats import spearmanr
+import numpy as np
+import argparse
+import time
+
+def ndcg(ranked, gains, k):
+    """NDCG@[k] of the [ranked] positions, with the [gains] of all the positions."""
+    discounts = 1 / np.log2(np.arange(2, k + 2))
+    ideal = np.sort(gains)[::-1][:k] @ discounts[:min(k, len(gains))]
+    return float(gains[ranked[:k]] @ discounts[:min(k, len(ranked))] / ideal) if ideal > 0 else 1.0
+
+def median_ms(function, queries):
+    times = []
+    for query in queries:
+        start = time.perf_counter()
+        function(query)
+        times.append(time.perf_counter() - start)
+    return np.median(times) * 1000
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--papers', type=int, default=20000)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--dimensions', type=int, default=256)
+    parser.add_argument('--k', type=int, default=20)
+    parser.add_argument('--new', type=float, default=0.05, help="fraction of the newest papers merged incrementally")
+    args = parser.parse_args()
+
+    corpus = Corpus()
+    papers = corpus.papers(args.papers, length=300)
+    users = corpus.users(papers, args.users)
+    papers.sort(key=lambda paper: paper[1])
+    split = int(len(papers) * (1 - args.new))
+
+    # Training on the older papers and merging the newest ones, like after a download
+    engine = RankingEngine()
+    engine.build(papers[:split])
+    index = LsaIndex(engine, path=None, dimensions=args.dimensions)
+    start = time.perf_counter()
+    index.ensure_loaded(0)
+    fit_time = time.perf_counter() - start
+    engine.build(papers)
+    start = time.perf_counter()
+    index.update([paper_id for paper_id, _, _ in papers[split:]], 0)
+    update_time = time.perf_counter() - start
+    # The same SVD trained on all the papers at once
+    full = LsaIndex(engine, path=None, dimensions=args.dimensions)
+    full.ensure_loaded(0)
+    angles = np.linalg.svd(full.components.T @ index.components, compute_uv=False)
+    print(f"{len(papers)} papers, {engine.matrix.shape[1]} terms, {len(index.singular)} dimensions")
+    print(f"SVD of {split} papers: {fit_time:.1f}s, merging the {len(papers) - split} newest: {update_time:.1f}s")
+    print(f"Subspace of the merged SVD vs trained at once: mean cosine of the principal angles {angles.mean():.4f}")
+
+    embeddings = [index.project_vector(user) for user in users]
+    for name, delta in [("2 weeks", timedelta(weeks=2)), ("year", timedelta(weeks=52))]:
+        since = datetime.now() - delta
+        overlaps, correlations, gains = [], [], []
+        for user, embedding in zip(users, embeddings):
+            _, _, exact = engine.score(user, since)
+            _, scores = index.score(embedding, since)
+            exact_top = set(engine.top_k(user, args.k, since)[0].tolist())
+            overlaps.append(len(exact_top & set(index.top_k(embedding, args.k, since)[0].tolist())) / args.k)
+            correlations.append(spearmanr(exact, scores)[0])
+            gains.append(ndcg(np.lexsort((np.arange(len(scores)), -scores)), exact, args.k))
+        exact_ms = median_ms(lambda user: engine.top_k(user, args.k, since), users)
+        lsa_ms = median_ms(lambda embedding: index.top_k(embedding, args.k, since), embeddings)
+        print(
+            f"{name:>8} ({engine.count(since)} papers): overlap@{args.k} {np.mean(overlaps):.3f}, "
+            f"Spearman {np.nanmean(correlations):.3f}, NDCG@{args.k} {np.mean(gains):.3f}, "
+            f"top {args.k} exact {exact_ms:.2f} ms, LSA {lsa_ms:.2f} ms"
+        )
+
+    # Five likes applied to the sparse profile and to the embedding, and how far the embedding gets from the projection
+    # of the pruned sparse profile
+    likes = [(papers[i][2], True) for i in np.random.default_rng(0).choice(len(papers), 5, replace=False)]
+    sparse_ms = median_ms(lambda user: update_user_profile_batch(user, likes[:1]), users)
+    dense_ms = median_ms(
+        lambda user: index.update_profile(SimpleNamespace(embedding=None, embedding_version=None, vector=user), likes[:1]),
+        users
+    )
+    drift = []
+    for user in users:
+        embedding = index.update_profile(SimpleNamespace(embedding=None, embedding_version=None, vector=user), likes)
+        projected = index.project_vector(update_user_profile_batch(user, likes))
+        drift.append(embedding @ projected / (np.linalg.norm(embedding) * np.linalg.norm(projected)))
+    print(
+        f"A like: sparse profile {sparse_ms:.3f} ms, embedding {dense_ms:.3f} ms; cosine between the embedding after "
+        f"5 likes and the projection of the sparse profile {np.mean(drift):.4f}"
+    )
+
+    sparse_bytes = engine.matrix.data.nbytes + engine.matrix.indices.nbytes + engine.matrix.indptr.nbytes
+    profile_bytes = np.mean([len(user) for user in users]) * 8
+    print(
+        f"Memory: paper matrix {sparse_bytes / 2**20:.1f} MiB, embeddings {index.vectors.nbytes / 2**20:.1f} MiB "
+        f"+ components {index.components.nbytes / 2**20:.1f} MiB; a profile {profile_bytes / 1024:.1f} KiB sparse, "
+        f"{index.vectors.shape[1] * 4 / 1024:.1f} KiB dense"
+    )
@@ -0,0 +1,55 @@
+"""Benchmark of the neighbour table of the /similar page: time and peak memory of the full build and of the update after a
+day of new papers, for growing corpus sizes. The database isn't involved, only the blocked matrix products of scan().
+Run from the repository root: python -m benchmarks.neighbours [--sizes 5000 10000 20000 40000] [--new 500]"""
+from ranking import RankingEngine
+from neighbours import scan, NEIGHBOURS, BLOCK
+from benchmarks.synthetic import Corpus
+import numpy as np
+import tracemalloc
+import argparse
+import time
+
+def measure(matrix, norms, rows, thresholds, block):
+    """Consumes scan() and returns the elapsed time, the peak memory, the lists and the number of old lists entered."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    lists, entered = [], []
+    for block_lists, block_pairs in scan(matrix, norms, rows, NEIGHBOURS, thresholds, block):
+        lists.extend(block_lists)
+        if block_pairs is not None:
+            entered.append(block_pairs[0])
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak, lists, len(np.unique(np.concatenate(entered))) if entered else 0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[5000, 10000, 20000, 40000])
+    parser.add_argument('--new', type=int, default=500)
+    parser.add_argument('--block', type=int, default=BLOCK)
+    args = parser.parse_args()
+
+    corpus = Corpus()
+    all_papers = corpus.papers(max(args.sizes) + args.new, length=300)
+    print(f"{'papers':>8} {'build s':>8} {'build MiB':>10} {'papers/s':>9} {'update s':>9} {'update MiB':>11} {'lists updated':>14} {'table MiB':>10}")
+    for size in args.sizes:
+        engine = RankingEngine()
+        engine.build(all_papers[:size])
+        build_time, build_peak, lists, _ = measure(engine.matrix, engine.norms, np.arange(size), None, args.block)
+        thresholds = np.array([scores[-1] if len(scores) == NEIGHBOURS else 0 for _, _, scores in lists], dtype=np.float32)
+        old_ids = engine.ids[[row for row, _, _ in lists]]
+
+        # A day of new papers: the new rows are scored against everything and merged into the lists they enter
+        engine.build(all_papers[:size + args.new])
+        new_rows = engine.rows([paper[0] for paper in all_papers[size:size + args.new]])
+        row_thresholds = np.zeros(size + args.new, dtype=np.float32)
+        row_thresholds[engine.rows(old_ids)] = thresholds
+        update_time, update_peak, _, affected = measure(engine.matrix, engine.norms, new_rows, row_thresholds, args.block)
+
+        # Every list is NEIGHBOURS int64 ids and float32 scores
+        table_size = size * NEIGHBOURS * 12
+        print(
+            f"{size:>8} {build_time:>8.1f} {build_peak / 2**20:>10.1f} {size / build_time:>9.0f} {update_time:>9.2f} "
+            f"{update_peak / 2**20:>11.1f} {affected:>14} {table_size / 2**20:>10.1f}"
+        )
@@ -0,0 +1,85 @@
+"""Benchmark of the feed and search pages with and without the page caches: every card rendered by Jinja (the card cache
+off), the cards assembled from the cached fragments, and the browser revalidating a page it has with If-None-Match
+(304 Not Modified). The rankings are cached in all three, so the difference is the rendering. Reports the requests/s
+through the test client (with the login and the server side session) and the median time spent in the app from the
+Server-Timing header. Checks that the pages built from the fragments are the same as the rendered ones and that liking a
+paper changes the ETag. A synthetic corpus is loaded into a temporary SQLite database.
+Run from the repository root: python -m benchmarks.pages [--papers 5000] [--requests 200]"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import numpy as np
+
+URLS = ['/?page=1', '/?page=2&time=6', '/?page=1&time=6&sort=Date', '/search?query=gradient', '/search?query=gradient&page=3']
+
+def throughput(client, url, requests, headers=None):
+    """Requests per second of [url], the median total of the Server-Timing header in ms and the status of the last
+    response."""
+    totals = []
+    start = time.perf_counter()
+    for _ in range(requests):
+        response = client.get(url, headers=headers)
+        totals.append(float(response.headers['Server-Timing'].split('total;dur=')[1].split(',')[0]))
+    return requests / (time.perf_counter() - start), np.median(totals), response.status_code
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--papers', type=int, default=5000)
+    parser.add_argument('--requests', type=int, default=200)
+    args = parser.parse_args()
+
+    # The database and every file the app saves are in a temporary directory. The database has to be set before the app
+    # is imported, main.py reads FLASK_* variables from the environment
+    directory = tempfile.mkdtemp()
+    os.environ['FLASK_SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{os.path.join(directory, 'pages.db')}"
+    from main import app, db
+    from database import Term
+    from cache import card_cache
+    from benchmarks.synthetic import Corpus, load_database, use_directory
+    import bcrypt
+    use_directory(directory)
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    corpus = Corpus(n_terms=20000)
+    papers = corpus.papers(args.papers, length=500)
+    users = corpus.users(papers, 1)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        load_database(db, papers, users, bcrypt.hashpw(b"benchmark", bcrypt.gensalt(rounds=4)))
+        # The analyzer drops the digits of the synthetic terms, so the most common term is renamed to a word
+        common = np.bincount(np.concatenate([vector.ids for _, _, vector in papers])).argmax()
+        db.session.execute(db.update(Term).where(Term.id == int(common)).values(term="gradient"))
+        db.session.commit()
+
+    client = app.test_client()
+    client.post('/login', data={'email': "user0@example.com", 'password': 'benchmark'})
+    max_entries = card_cache.max_entries
+    failed = False
+    print(f"{args.papers} papers, {args.requests} requests per page, requests/s (median ms in the app):")
+    print(f"{'':>32} {'no caches':>16} {'fragments':>16} {'304':>16}")
+    for url in URLS:
+        # Warming up the rankings
+        client.get(url)
+        card_cache.max_entries = 0
+        card_cache.clear()
+        rendered = client.get(url)
+        full = throughput(client, url, args.requests)
+        card_cache.max_entries = max_entries
+        assembled = client.get(url)
+        fragments = throughput(client, url, args.requests)
+        revalidated = throughput(client, url, args.requests, {'If-None-Match': assembled.headers['ETag']})
+        same = rendered.data == assembled.data and rendered.headers['ETag'] == assembled.headers['ETag']
+        ok = same and revalidated[2] == 304
+        failed |= not ok
+        print(f"{url:>32}", *(f"{rate:7.0f} ({total:5.2f})" for rate, total, _ in (full, fragments, revalidated)),
+              " ok" if ok else " MISMATCH")
+
+    # Liking a paper changes the profile, the pages the browser has are outdated
+    etag = client.get(URLS[0]).headers['ETag']
+    client.post('/', json={str(papers[0][0]): True})
+    status = client.get(URLS[0], headers={'If-None-Match': etag}).status_code
+    print(f"after a like: {status} (200 expected)")
+    sys.exit(1 if failed or status != 200 else 0)
@@ -0,0 +1,84 @@
+"""Checks that recommender.update_user_profile_batch gives the same profiles as calling update_user_profile once per
+like/unlike, measures the drift left by liking and then unliking papers, and compares the speed of both.
+Run from the repository root: python -m benchmarks.profiles [--users N] [--batch N]"""
+from recommender import update_user_profile, update_user_profile_batch, ALPHA, BETA, GAMMA
+from benchmarks.synthetic import Corpus
+from vectors import SparseVector
+import numpy as np
+import argparse
+import time
+
+def sequential(vector, updates, gamma=GAMMA, unlike_beta=-BETA/ALPHA):
+    """Calls update_user_profile once per update. The unlike used to be P/alpha - beta*D, which doesn't cancel the like,
+    the batch update uses the inverse (P - beta*D)/alpha."""
+    for document, liked in updates:
+        if liked:
+            vector = update_user_profile(vector, document, ALPHA, BETA, gamma)
+        else:
+            vector = update_user_profile(vector, document, 1/ALPHA, unlike_beta, 0)
+    return vector
+
+def difference(vector1, vector2):
+    """Returns the number of terms that are only in one of the vectors and the largest difference of the weights."""
+    ids = np.union1d(vector1.ids, vector2.ids)
+    weights1, weights2 = np.zeros(len(ids)), np.zeros(len(ids))
+    weights1[np.searchsorted(ids, vector1.ids)] = vector1.weights
+    weights2[np.searchsorted(ids, vector2.ids)] = vector2.weights
+    return len(np.setxor1d(vector1.ids, vector2.ids)), float(np.abs(weights1 - weights2).max(initial=0))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--papers', type=int, default=2000)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--batch', type=int, default=50, help="number of likes/unlikes applied at once")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    corpus = Corpus(seed=args.seed)
+    generator = np.random.default_rng(args.seed)
+    papers = [vector for _, _, vector in corpus.papers(args.papers)]
+    # The profiles start from the interests (a weight of 1 for a few terms) and some liked papers
+    users = []
+    for _ in range(args.users):
+        interests = np.sort(generator.choice(corpus.n_terms, 10, replace=False) + 1)
+        liked = list(generator.choice(len(papers), 20, replace=False))
+        users.append((sequential(SparseVector(interests, [1] * 10), [(papers[i], True) for i in liked]), liked))
+
+    # Random batches of likes and unlikes, a paper is only unliked if it's liked
+    batches = []
+    for vector, liked in users:
+        liked, updates = set(liked), []
+        for _ in range(args.batch):
+            if liked and generator.random() < 0.3:
+                paper = generator.choice(sorted(liked))
+                liked.remove(paper)
+                updates.append((papers[paper], False))
+            else:
+                paper = int(generator.integers(len(papers)))
+                liked.add(paper)
+                updates.append((papers[paper], True))
+        batches.append((vector, updates))
+
+    start = time.perf_counter()
+    expected = [sequential(vector, updates) for vector, updates in batches]
+    sequential_time = time.perf_counter() - start
+    start = time.perf_counter()
+    results = [update_user_profile_batch(vector, updates) for vector, updates in batches]
+    batch_time = time.perf_counter() - start
+
+    differences = [difference(e, r) for e, r in zip(expected, results)]
+    print(f"Batch of {args.batch} updates for {args.users} users")
+    print(f"  sequential: {sequential_time:.3f}s, batch: {batch_time:.3f}s, speedup {sequential_time / batch_time:.1f}x")
+    print(f"  terms that differ: {sum(d[0] for d in differences)}, largest weight difference: {max(d[1] for d in differences):.2e}")
+
+    # Liking the papers of a batch and then unliking them in reverse order should give the starting profile back. The
+    # pruning is turned off, the weights it deletes can't come back by definition
+    drift_old, drift_sequential, drift_batch = [], [], []
+    for vector, updates in batches:
+        documents = [document for document, _ in updates]
+        round_trip = [(d, True) for d in documents] + [(d, False) for d in reversed(documents)]
+        drift_old.append(difference(vector, sequential(vector, round_trip, gamma=0, unlike_beta=-BETA))[1])
+        drift_sequential.append(difference(vector, sequential(vector, round_trip, gamma=0))[1])
+        drift_batch.append(difference(vector, update_user_profile_batch(vector, round_trip, gamma=0))[1])
+    print(f"Drift after liking and unliking {args.batch} papers without pruning (largest weight difference from the starting profile)")
+    print(f"  old unlike formula: {max(drift_old):.2e}, sequential: {max(drift_sequential):.2e}, batch: {max(drift_batch):.2e}")
@@ -0,0 +1,82 @@
+"""Check of the number of database queries made by every page for a user with many liked papers. The pages must not load
+the liked papers, so their query counts don't depend on the number of likes. Exits with an error when a page makes more
+queries than its budget in QUERY_BUDGETS. Every page is requested once before it's measured, so the budgets don't count
+the loading of the ranking engine and the search index (tests/test_queries.py checks the same). A synthetic corpus is loaded into a temporary SQLite database.
+Run from the repository root: python -m benchmarks.queries [--papers 5000] [--likes 2000] [--requests 20]"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import numpy as np
+
+# Maximum number of queries of a request to every endpoint, with the user loading and the server side session
+QUERY_BUDGETS = {
+    'about': 2,
+    'logout': 2,
+    'home_page': 4,
+    'search': 4,
+    'similar': 6,
+}
+URLS = [
+    ('about', '/about'), ('home_page', '/?page=1'), ('search', '/search?query=term10'), ('similar', '/similar/1'),
+    ('logout', '/logout'),
+]
+
+def query_count(db_queries, endpoint):
+    with db_queries.lock:
+        return db_queries.values.get((endpoint,), 0)
+
+def page_queries(client, endpoint, url, email="user0@example.com", password='benchmark'):
+    """Logs in and requests [url], returns the number of queries made by the request to the [endpoint] and the time it
+    took in seconds."""
+    from metrics import db_queries
+    client.post('/login', data={'email': email, 'password': password})
+    before = query_count(db_queries, endpoint)
+    start = time.perf_counter()
+    response = client.get(url)
+    elapsed = time.perf_counter() - start
+    assert response.status_code in (200, 302), f"{url} returned {response.status_code}"
+    return query_count(db_queries, endpoint) - before, elapsed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--papers', type=int, default=5000)
+    parser.add_argument('--likes', type=int, default=2000)
+    parser.add_argument('--requests', type=int, default=20)
+    args = parser.parse_args()
+
+    # The database and every file the app saves are in a temporary directory. The database has to be set before the app
+    # is imported, main.py reads FLASK_* variables from the environment
+    directory = tempfile.mkdtemp()
+    os.environ['FLASK_SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{os.path.join(directory, 'queries.db')}"
+    from main import app, db
+    from database import table
+    from benchmarks.synthetic import Corpus, load_database, use_directory
+    import bcrypt
+    use_directory(directory)
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    corpus = Corpus(n_terms=20000)
+    papers = corpus.papers(args.papers, length=500)
+    users = corpus.users(papers, 1)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        load_database(db, papers, users, bcrypt.hashpw(b"benchmark", bcrypt.gensalt(rounds=4)))
+        liked = np.random.default_rng(0).choice(len(papers), min(args.likes, len(papers)), replace=False) + 1
+        db.session.execute(db.insert(table), [{'paper_id': int(i), 'user_email': "user0@example.com"} for i in liked])
+        db.session.commit()
+
+    client = app.test_client()
+    failed = False
+    print(f"{len(liked)} liked papers")
+    for endpoint, url in URLS:
+        # Loading the ranking engine and the search index
+        page_queries(client, endpoint, url)
+        queries, latencies = zip(*(page_queries(client, endpoint, url) for _ in range(args.requests)))
+        budget = QUERY_BUDGETS[endpoint]
+        status = "ok" if max(queries) <= budget else "OVER BUDGET"
+        failed |= max(queries) > budget
+        print(f"{url:>24}: {max(queries)} queries (budget {budget}), median {np.median(latencies) * 1000:.1f} ms  {status}")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,178 @@
+"""Benchmark suite of the hot paths: cosine, update_user_profile, text_normalization, the vectorization stage of get_papers,
+and the / and /search endpoints. A synthetic corpus is loaded into a local database (SQLite by default, or any database
+given with --database) and the latency percentiles, throughput and peak memory of every path are written as JSON.
+Run from the repository root: python -m benchmarks.run --papers 10000 --users 1000 --output results.json"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import tracemalloc
+import numpy as np
+
+def summary(latencies, peak_memory):
+    latencies = np.array(latencies) * 1000
+    return {
+        'count': len(latencies),
+        'mean_ms': float(latencies.mean()),
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p90_ms': float(np.percentile(latencies, 90)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+        'max_ms': float(latencies.max()),
+        'throughput_per_s': float(len(latencies) / (latencies.sum() / 1000)),
+        'peak_memory_mb': peak_memory / 2**20,
+    }
+
+def measure(function, inputs, memory_samples=3):
+    """Calls [function] on every input and returns the summary of the latencies. The peak memory is measured in separate
+    calls on the first [memory_samples] inputs, because tracemalloc slows everything down."""
+    latencies = []
+    for item in inputs:
+        start = time.perf_counter()
+        function(item)
+        latencies.append(time.perf_counter() - start)
+    tracemalloc.start()
+    for item in inputs[:memory_samples]:
+        function(item)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return summary(latencies, peak)
+
+def run_safely(results, name, function):
+    """Stores the result of [function] under [name], or the error if it fails (e.g. missing NLTK data)."""
+    print(f"Running {name}...", file=sys.stderr)
+    try:
+        results[name] = function()
+    except Exception as error:
+        results[name] = {'error': f"{type(error).__name__}: {error}"}
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--papers', type=int, default=10000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--terms', type=int, default=50000)
+    parser.add_argument('--requests', type=int, default=100, help="number of requests to each endpoint")
+    parser.add_argument('--samples', type=int, default=1000, help="number of calls of the cosine and profile update")
+    parser.add_argument('--database', help="SQLAlchemy database URI, a temporary SQLite file by default")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark_results.json')
+    args = parser.parse_args()
+
+    # The database and every file the app saves are in a temporary directory. The database has to be set before the app
+    # is imported, main.py reads FLASK_* variables from the environment
+    directory = tempfile.mkdtemp()
+    database = args.database or f"sqlite:///{os.path.join(directory, 'benchmark.db')}"
+    os.environ['FLASK_SQLALCHEMY_DATABASE_URI'] = database
+
+    from main import app, db
+    from cache import feed_cache, search_cache
+    from ranking import engine
+    from recommender import cosine, update_user_profile
+    from arxiv_scraper import text_normalization, paper_vectors
+    from vocabulary import Vocabulary
+    from benchmarks.synthetic import Corpus, load_database, use_directory
+    from benchmarks.normalization import synthetic_corpus
+    import bcrypt
+    use_directory(directory)
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    generator = np.random.default_rng(args.seed)
+    corpus = Corpus(n_terms=args.terms, seed=args.seed)
+    results = {}
+
+    print("Generating the corpus...", file=sys.stderr)
+    start = time.perf_counter()
+    papers = corpus.papers(args.papers)
+    users = corpus.users(papers, args.users)
+    generation_time = time.perf_counter() - start
+
+    password = bcrypt.hashpw(b"benchmark", bcrypt.gensalt(rounds=4))
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        start = time.perf_counter()
+        load_database(db, papers, users, password)
+        load_time = time.perf_counter() - start
+
+    pairs = [(users[generator.integers(len(users))], papers[generator.integers(len(papers))][2]) for _ in range(args.samples)]
+    run_safely(results, 'cosine', lambda: measure(lambda pair: cosine(*pair), pairs))
+    run_safely(results, 'update_user_profile', lambda: measure(
+        lambda pair: update_user_profile(pair[0], pair[1], 0.95, 0.05, 0.02), pairs
+    ))
+
+    texts = [text.lower() for text in synthetic_corpus(20)]
+    run_safely(results, 'text_normalization', lambda: measure(text_normalization, texts))
+
+    def vectorize(documents):
+        vocabulary = Vocabulary()
+        vocabulary.add_documents(documents)
+        return paper_vectors(vocabulary.transform(documents))
+    batches = [corpus.documents(50) for _ in range(5)]
+    run_safely(results, 'get_papers_vectorization_50_documents', lambda: measure(vectorize, batches, memory_samples=1))
+
+    with app.app_context():
+        run_safely(results, 'ranking_engine_refresh', lambda: measure(lambda _: engine.refresh(), [None], memory_samples=1))
+
+    clients = []
+    for i in generator.choice(len(users), min(10, len(users)), replace=False):
+        client = app.test_client()
+        client.post('/login', data={'email': f"user{i}@example.com", 'password': 'benchmark'})
+        clients.append(client)
+
+    def get(url, clear_cache=False):
+        def request(client):
+            if clear_cache:
+                feed_cache.clear()
+                search_cache.clear()
+            response = client.get(url)
+            if response.status_code != 200:
+                raise RuntimeError(f"{url} returned {response.status_code}")
+        return request
+
+    requests = [clients[i % len(clients)] for i in range(args.requests)]
+    for time_option in [0, 3, 6]:
+        url = f'/?time={time_option}&page=1'
+        run_safely(results, f'home_page_time_{time_option}_uncached', lambda: measure(get(url, clear_cache=True), requests))
+        run_safely(results, f'home_page_time_{time_option}_cached', lambda: measure(get(url), requests))
+    run_safely(results, 'home_page_date_sort', lambda: measure(get('/?time=6&sort=Date&page=2'), requests))
+    search_url = '/search?query=term10+term200+term3000&page=1'
+    run_safely(results, 'search_uncached', lambda: measure(get(search_url, clear_cache=True), requests))
+    run_safely(results, 'search_cached', lambda: measure(get(search_url), requests))
+    # Most searches repeat a few popular queries: a Zipf distributed mix over 50 queries, paging through the results
+    queries = [f"term{a}+term{b}" for a, b in generator.integers(1, 5000, size=(50, 2))]
+    mix = [f"/search?query={queries[min(q, 50) - 1]}&page={generator.integers(1, 4)}" for q in generator.zipf(1.5, args.requests)]
+    search_cache.clear()
+    hits, misses = search_cache.hits, search_cache.misses
+    run_safely(results, 'search_popular_mix', lambda: measure(lambda i: get(mix[i])(requests[i]), range(len(mix))))
+    results['search_popular_mix_hit_rate'] = (search_cache.hits - hits) / max(search_cache.hits + search_cache.misses - hits - misses, 1)
+    # Time spent getting the ranked results, without the rest of the request
+    from metrics import search_seconds
+    results['search_ranking_mean_ms'] = {
+        outcome: total / sum(counts) * 1000 for (outcome,), (counts, total) in search_seconds.values.items()
+    }
+
+    output = {
+        'configuration': vars(args) | {'database': database.split('://')[0]},
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'commit': git_commit(),
+        },
+        'setup': {'generation_seconds': generation_time, 'database_load_seconds': load_time},
+        'results': results,
+        'process_peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+    with open(args.output, 'w') as file:
+        json.dump(output, file, indent=4)
+    print(json.dumps(results, indent=4))
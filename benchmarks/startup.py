@@ -0,0 +1,67 @@
+"""Benchmark of the cold start of a web worker: the time to import main and analyze the first query, and the resident
+memory after it. "before" also imports the scraper and uses the analyzer of its vectorizer, like the web workers did when
+main imported arxiv_scraper. "after" uses the analyzer artifact, a temporary one with a lemma table of --lemmas entries.
+Every measurement is a new python process. Run from the repository root (main reads config.json from there):
+python -m benchmarks.startup [--runs 5] [--lemmas 200000] [--query TEXT]"""
+from analyzer import Analyzer
+import numpy as np
+import subprocess
+import tempfile
+import argparse
+import json
+import sys
+import os
+
+WORKER = """
+import time, json, sys
+start = time.perf_counter()
+import analyzer
+analyzer.ANALYZER_PATH = sys.argv[2]
+import main
+if sys.argv[1] == 'before':
+    from arxiv_scraper import vectorizer
+    analyze = vectorizer.build_analyzer()
+else:
+    analyze = analyzer.get_analyzer()
+analyze(sys.argv[3])
+elapsed = time.perf_counter() - start
+heavy = [name for name in ('sklearn', 'nltk', 'fitz') if name in sys.modules]
+# ru_maxrss would include the peak of the parent process, linux keeps it across exec
+rss = next(int(line.split()[1]) for line in open('/proc/self/status') if line.startswith('VmRSS'))
+print(json.dumps({'seconds': elapsed, 'rss_mib': rss / 1024, 'heavy': heavy}))
+"""
+
+def measure(mode, path, query, runs):
+    results = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, '-c', WORKER, mode, path, query], capture_output=True, text=True, check=True
+        ).stdout.strip().splitlines()[-1]
+        results.append(json.loads(output))
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--lemmas', type=int, default=200000)
+    parser.add_argument('--query', default="Transformers for reinforcement learning")
+    args = parser.parse_args()
+
+    from arxiv_scraper import vectorizer, tokenizer
+    from nltk.tokenize.casual import HANG_RE
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'analyzer.json.gz')
+        pattern = tokenizer.PHONE_WORD_RE
+        lemmas = {f"token{i}s": f"token{i}" for i in range(args.lemmas)}
+        Analyzer((pattern.pattern, pattern.flags), (HANG_RE.pattern, HANG_RE.flags), vectorizer.get_stop_words(), lemmas).save(path)
+
+        # The first run of every mode warms up the disk cache, it isn't counted
+        for mode in ['before', 'after']:
+            measure(mode, path, args.query, 1)
+            results = measure(mode, path, args.query, args.runs)
+            seconds = np.array([result['seconds'] for result in results])
+            rss = np.array([result['rss_mib'] for result in results])
+            print(
+                f"{mode:>6}: cold start {np.median(seconds):.2f}s (min {seconds.min():.2f}s), RSS {np.median(rss):.0f} MiB, "
+                f"heavy modules loaded: {', '.join(results[0]['heavy']) or 'none'}"
+            )
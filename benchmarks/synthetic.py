@@ -0,0 +1,94 @@
+"""Synthetic arXiv-like corpus for the benchmarks: papers, users, tokenized documents and a database loaded with them."""
+from vectors import SparseVector
+from datetime import datetime, timedelta
+import numpy as np
+import os
+
+MAX_VECTOR_LENGTH = 1000
+TOPIC_SIZE = 2000
+
+class Corpus:
+    """Papers are mixtures of 1-3 topics, every topic is a Zipf distribution over its own subset of the terms, so the
+    term frequencies and the similarities between papers look like the real ones. Term ids start at 1, like in the Term table."""
+
+    def __init__(self, n_terms=50000, n_topics=100, seed=0):
+        self.n_terms = n_terms
+        self.n_topics = n_topics
+        self.generator = np.random.default_rng(seed)
+        self.topic_terms = [self.generator.choice(n_terms, TOPIC_SIZE, replace=False) + 1 for _ in range(n_topics)]
+        self.zipf = 1 / np.arange(1, TOPIC_SIZE + 1)
+        self.zipf /= self.zipf.sum()
+        # Terms with lower ids are more common in the whole corpus, so they get lower idf
+        self.idf = 1 + np.log((n_terms + 1) / np.arange(1, n_terms + 2))
+
+    def tokens(self, length):
+        """Term ids of a document of [length] tokens."""
+        topics = self.generator.choice(self.n_topics, self.generator.integers(1, 4), replace=False)
+        return np.concatenate([
+            self.topic_terms[t][self.generator.choice(TOPIC_SIZE, length // len(topics), p=self.zipf)] for t in topics
+        ])
+
+    def papers(self, n_papers, length=3000, days=365):
+        """Returns a list of (id, updated_date, SparseVector) tuples with L2 normalized tf-idf weights."""
+        now = datetime.now()
+        papers = []
+        for i in range(n_papers):
+            ids, counts = np.unique(self.tokens(length), return_counts=True)
+            weights = counts * self.idf[ids]
+            if len(ids) > MAX_VECTOR_LENGTH:
+                top = np.sort(np.argsort(-weights, kind='stable')[:MAX_VECTOR_LENGTH])
+                ids, weights = ids[top], weights[top]
+            weights /= np.linalg.norm(weights)
+            date = now - timedelta(minutes=int(self.generator.integers(0, 60 * 24 * days)))
+            papers.append((i + 1, date, SparseVector(ids, weights)))
+        return papers
+
+    def users(self, papers, n_users, likes=5):
+        """Users that liked a few random papers, their vectors are the sums of the paper vectors."""
+        users = []
+        for _ in range(n_users):
+            liked = [papers[i][2] for i in self.generator.choice(len(papers), likes, replace=False)]
+            ids = np.concatenate([vector.ids for vector in liked])
+            weights = np.concatenate([vector.weights for vector in liked])
+            ids, inverse = np.unique(ids, return_inverse=True)
+            users.append(SparseVector(ids, np.bincount(inverse, weights=weights)))
+        return users
+
+    def documents(self, n_documents, length=3000):
+        """Tokenized documents (lists of term names) for the vectorization benchmarks."""
+        return [[f"term{t}" for t in self.tokens(length)] for _ in range(n_documents)]
+
+def load_database(db, papers, users, password, batch=5000):
+    """Inserts the terms, [papers] and [users] into the database. Needs an app context with empty tables."""
+    from database import Term, Paper, User
+    n_terms = max((int(vector.ids.max()) for _, _, vector in papers if len(vector)), default=0)
+    for start in range(1, n_terms + 1, batch):
+        db.session.execute(db.insert(Term), [{'id': i, 'term': f"term{i}"} for i in range(start, min(start + batch, n_terms + 1))])
+    for start in range(0, len(papers), batch):
+        db.session.execute(db.insert(Paper), [{
+            'id': id, 'title': f"Synthetic paper {id}", 'authors': "A. Author, B. Author", 'abstract': "Abstract " * 150,
+            'pdf_link': f"http://arxiv.org/pdf/{id}", 'site_link': f"http://arxiv.org/abs/{id}", 'vector': vector, 'updated_date': date
+        } for id, date, vector in papers[start:start + batch]])
+    for start in range(0, len(users), batch):
+        db.session.execute(db.insert(User), [{
+            'email': f"user{i}@example.com", 'password': password, 'auth': True, 'vector': vector
+        } for i, vector in enumerate(users[start:start + batch], start)])
+    db.session.commit()
+
+def use_directory(directory):
+    """Points the files that the app saves (the vocabulary, the search, ANN and LSA indexes, the published paper matrix
+    and the text store) at [directory], so a benchmark never overwrites the ones of the server."""
+    from vocabulary import vocabulary
+    from search_index import search_index
+    from ann import ann_index
+    from lsa import lsa_index
+    from ranking import engine
+    from text_store import text_store
+    vocabulary.path = os.path.join(directory, 'vocabulary.npz')
+    vocabulary.loaded = False
+    search_index.path = os.path.join(directory, 'search_index')
+    ann_index.path = os.path.join(directory, 'ann_index.npz')
+    lsa_index.path = os.path.join(directory, 'lsa')
+    text_store.path = os.path.join(directory, 'text_store')
+    if engine.path is not None:
+        engine.path = os.path.join(directory, 'engine')
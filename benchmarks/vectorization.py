@@ -0,0 +1,56 @@
+"""Benchmark of arxiv_scraper.paper_vectors, which selects the top weights of every row of the tf-idf CSR matrix, against
+the original implementation that converts the whole matrix to a dense array. Reports the time and the peak memory of a
+batch of synthetic documents, and checks that both give the same vectors.
+Run from the repository root: python -m benchmarks.vectorization [--documents 500] [--terms 200000] [--length 3000]"""
+from arxiv_scraper import paper_vectors, MAX_VECTOR_LENGTH
+from vectors import SparseVector
+from vocabulary import Vocabulary
+from benchmarks.synthetic import Corpus
+import numpy as np
+import tracemalloc
+import argparse
+import time
+
+def reference_paper_vectors(result):
+    """The original implementation, it densifies the documents x vocabulary matrix."""
+    vectors = []
+    result = result.toarray()
+    for row in result:
+        terms = np.argsort(-row, kind='stable')[:MAX_VECTOR_LENGTH]
+        terms = np.sort(terms[row[terms] > 0])
+        vectors.append(SparseVector(terms, row[terms]))
+    return vectors
+
+def measure(function, matrix):
+    tracemalloc.start()
+    start = time.perf_counter()
+    vectors = function(matrix)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak, vectors
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--documents', type=int, default=500)
+    parser.add_argument('--terms', type=int, default=200000)
+    parser.add_argument('--length', type=int, default=3000)
+    args = parser.parse_args()
+
+    documents = Corpus(n_terms=args.terms).documents(args.documents, args.length)
+    vocabulary = Vocabulary()
+    vocabulary.add_documents(documents)
+    matrix = vocabulary.transform(documents)
+    # The synthetic vocabulary only has the terms of the batch, the real one has every term seen so far
+    matrix.resize(matrix.shape[0], max(matrix.shape[1], args.terms))
+    print(f"{matrix.shape[0]} documents x {matrix.shape[1]} terms, {matrix.nnz} stored weights ({matrix.data.nbytes / 2**20:.1f} MiB)")
+
+    results = {}
+    for name, function in [('dense', reference_paper_vectors), ('sparse', paper_vectors)]:
+        elapsed, peak, vectors = measure(function, matrix)
+        results[name] = vectors
+        print(f"{name:>7}: {elapsed:6.2f}s, peak {peak / 2**20:8.1f} MiB, {matrix.shape[0] / elapsed:8.0f} documents/s")
+    same = all(
+        np.array_equal(a.ids, b.ids) and np.array_equal(a.weights, b.weights) for a, b in zip(results['dense'], results['sparse'])
+    )
+    print(f"Same vectors: {same}")
@@ -0,0 +1,53 @@
+"""Build the analyzer artifact that the web workers use for the search queries and the interest chips (see analyzer.py).
+The texts of the papers in the text store are tokenized and lemmatized in a pool of processes, and every token whose lemma
+is different from the token and is a term of the vocabulary goes into the lemma table, together with the tokens of the
+interest chips. Run it again after a while, so the table has the tokens of the new papers.
+Usage: python build_analyzer.py [--processes N] [--output PATH]"""
+from main import app, LABELS
+from database import db, Paper
+from arxiv_scraper import vectorizer, vocabulary, tokenizer, lemmatize_tokens, parse_arxiv_id
+from analyzer import Analyzer, ANALYZER_PATH
+from nltk.tokenize.casual import HANG_RE
+from text_store import text_store
+from multiprocessing import Pool
+import argparse
+import time
+import os
+
+def lemma_pairs(text):
+    """Returns the tokens of the [text] whose lemma is different, with their lemmas. The same steps as text_normalization
+    on a lowercased text. Runs in a worker process."""
+    tokens = [token for token in tokenizer.tokenize(text.lower()) if len(token) > 1 and any(map(lambda x: x.isalpha(), token))]
+    tokens = list(dict.fromkeys(tokens))
+    return {token: lemma for token, lemma in zip(tokens, lemmatize_tokens(tokens)) if token != lemma}
+
+def text_pairs(site_link):
+    text = text_store.get_text(*parse_arxiv_id(site_link))
+    return lemma_pairs(text) if text is not None else {}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--processes', type=int, default=os.cpu_count())
+    parser.add_argument('--output', default=ANALYZER_PATH)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    with app.app_context():
+        site_links = db.session.execute(db.select(Paper.site_link)).scalars().all()
+    chips = lemma_pairs(" ".join(LABELS))
+    lemmas = dict(chips)
+    with Pool(args.processes) as pool:
+        for pairs in pool.imap_unordered(text_pairs, site_links, chunksize=16):
+            lemmas.update(pairs)
+    # Lemmas that aren't terms of the vocabulary can't match any paper, except the ones of the interest chips that are
+    # added to the Term table at the sign up
+    vocabulary.ensure_loaded()
+    lemmas = {token: lemma for token, lemma in lemmas.items() if lemma in vocabulary.index or token in chips}
+
+    tokenizer_pattern = tokenizer.PHONE_WORD_RE if tokenizer.match_phone_numbers else tokenizer.WORD_RE
+    analyzer = Analyzer(
+        (tokenizer_pattern.pattern, tokenizer_pattern.flags), (HANG_RE.pattern, HANG_RE.flags),
+        vectorizer.get_stop_words(), lemmas
+    )
+    analyzer.save(args.output)
+    print(f"Saved an analyzer with {len(lemmas)} lemmas from {len(site_links)} papers in {time.perf_counter() - start:.1f}s")
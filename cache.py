@@ -0,0 +1,112 @@
+"""LRU caches of ranked results (paper ids and scores) with a time to live and a memory limit, and of pre-rendered html
+fragments."""
+from collections import OrderedDict
+import threading
+import time
+
+class RankedCache:
+    """Maps a key to a (ids, scores) pair of numpy arrays and the number of results they were cut from. The least recently
+    used entries are evicted when the total size of the arrays goes over [max_bytes], and entries older than [ttl] seconds
+    are treated as missing."""
+
+    def __init__(self, max_bytes=64 * 2**20, ttl=600):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Returns the cached (ids, scores, total) or None."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or time.monotonic() - entry[2] > self.ttl:
+                if entry is not None:
+                    self.remove(key)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0], entry[1], entry[3]
+
+    def put(self, key, ids, scores, total=None):
+        """Caches the [ids] and [scores], the first ones of [total] results (by default all of them)."""
+        size = ids.nbytes + scores.nbytes
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (ids, scores, time.monotonic(), len(ids) if total is None else total)
+            self.size += size
+            while self.size > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+
+    def remove(self, key):
+        """Removes the entry, the caller holds the lock."""
+        ids, scores, _, _ = self.entries.pop(key)
+        self.size -= ids.nbytes + scores.nbytes
+
+    def invalidate(self, predicate):
+        """Removes all the entries whose key satisfies the [predicate]."""
+        with self.lock:
+            for key in [key for key in self.entries if predicate(key)]:
+                self.remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self.entries),
+                'bytes': self.size,
+            }
+
+class FragmentCache:
+    """Maps a key to a pre-rendered fragment, the least recently used ones are evicted above [max_entries]."""
+
+    def __init__(self, max_entries=20000):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            fragment = self.entries.get(key)
+            if fragment is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return fragment
+
+    def put(self, key, fragment):
+        with self.lock:
+            self.entries[key] = fragment
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries)}
+
+# Rankings of the home page, the keys are (user email, time option, sort option)
+feed_cache = RankedCache()
+# Rankings of the search page shared by all the users, the keys are (normalized query, sort option, search index version)
+search_cache = RankedCache()
+# Html of the paper cards without the relevance indicator and the like state, the keys are paper ids
+card_cache = FragmentCache()
@@ -2,4 +2,20 @@
 from main import app, db
 
 with app.app_context():
-    db.create_all()
\ No newline at end of file
+    db.create_all()
+    # create_all() skips the tables that already exist, so the indexes added to them later are created here
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+    # The nullable columns added later to the existing tables are added here too
+    inspector = db.inspect(db.engine)
+    preparer = db.engine.dialect.identifier_preparer
+    for table in db.metadata.sorted_tables:
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing and column.nullable:
+                with db.engine.begin() as connection:
+                    connection.execute(db.text(
+                        f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN {preparer.format_column(column)} "
+                        f"{column.type.compile(db.engine.dialect)}"
+                    ))
@@ -1,13 +1,36 @@
 from flask_sqlalchemy import SQLAlchemy
+from vectors import SparseVector
+from metrics import stage
+import numpy as np
 
 db = SQLAlchemy()
 
+class VectorType(db.TypeDecorator):
+    """Stores a SparseVector as a binary blob of int32 term ids followed by float32 weights."""
+    impl = db.LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return value.to_bytes()
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        with stage('deserialize'):
+            return SparseVector.from_bytes(value)
+
 table = db.Table(
     'table',
     db.Column('paper_id', db.Integer, db.ForeignKey('paper.id'), primary_key=True),
     db.Column('user_email', db.String(320), db.ForeignKey('user.email'), primary_key=True)
 )
 
+class Term(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    term = db.Column(db.String(300), unique=True, nullable=False)
+
 class Paper(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(300), nullable=False)
@@ -15,15 +38,38 @@ class Paper(db.Model):
     abstract = db.Column(db.String(1920), nullable=False)
     pdf_link = db.Column(db.String(40))
     site_link = db.Column(db.String(40), nullable=False)
-    vector = db.Column(db.PickleType, nullable=False)
-    updated_date = db.Column(db.DateTime, nullable=False)
+    vector = db.Column(VectorType, nullable=False)
+    updated_date = db.Column(db.DateTime, nullable=False, index=True)
 
 class User(db.Model):
     email = db.Column(db.String(320), primary_key=True)
     password = db.Column(db.String(72), nullable=False)
     auth = db.Column(db.Boolean, default=False, nullable=False)
-    vector = db.Column(db.PickleType, nullable=False)
-    liked_papers = db.relationship("Paper", secondary=table, lazy='subquery', backref=db.backref('users', lazy=True))
+    vector = db.Column(VectorType, nullable=False)
+    # The interests picked at the sign up (a weight of 1 for every term), the profile is rebuilt from them. None for the
+    # users who signed up before they were stored
+    interests = db.Column(VectorType)
+    # UTC time of the last change of the profile (vector and likes), the cached pages of the user are older than it
+    profile_updated = db.Column(db.DateTime)
+    # Dense float32 profile of the "lsa" recommender, updated by the likes, and the version of the LSA components it was
+    # made with. It's projected from [vector] again when the components change
+    embedding = db.Column(db.LargeBinary)
+    embedding_version = db.Column(db.BigInteger)
+    # UTC time the user unsubscribed from the email digest with the link in a digest, None while they get it
+    digest_unsubscribed = db.Column(db.DateTime)
+    # Loaded only when it's used, the pages check the likes with liked_paper_ids()
+    liked_papers = db.relationship("Paper", secondary=table, lazy='select', backref=db.backref('users', lazy=True))
+    # Ids of the liked papers, read on the first call of liked_paper_ids(). The user is loaded again on every request
+    liked_ids = None
+
+    def liked_paper_ids(self):
+        """Returns the ids of the papers the user liked as a frozenset, read from the association table without loading
+        the papers."""
+        if self.liked_ids is None:
+            self.liked_ids = frozenset(db.session.execute(
+                db.select(table.c.paper_id).where(table.c.user_email == self.email)
+            ).scalars())
+        return self.liked_ids
 
     def is_active(self):
         return True
@@ -35,4 +81,94 @@ class User(db.Model):
         return self.auth
     
     def is_anonymous(self):
-        return False
\ No newline at end of file
+        return False
+
+class Feed(db.Model):
+    """The best papers for a user in one time period of the home page, precomputed by the nightly ranking job.
+    [papers] and [scores] are the int64 paper ids and float32 cosine scores (sorted by the score), [newest_paper] is the
+    id of the newest paper at the time of the ranking, so the feeds older than the last download are ignored.
+    [profile_updated] is the one of the user's profile it was ranked with, a feed ranked before a like is ignored too."""
+    user_email = db.Column(db.String(320), db.ForeignKey('user.email'), primary_key=True)
+    time_option = db.Column(db.Integer, primary_key=True)
+    papers = db.Column(db.LargeBinary, nullable=False)
+    scores = db.Column(db.LargeBinary, nullable=False)
+    newest_paper = db.Column(db.Integer, nullable=False)
+    profile_updated = db.Column(db.DateTime)
+
+    def ranking(self):
+        """Returns the paper ids and scores as numpy arrays (read-only views of the blobs)."""
+        return np.frombuffer(self.papers, dtype=np.int64), np.frombuffer(self.scores, dtype=np.float32)
+
+class NeighbourList(db.Model):
+    """The most similar papers of a paper, shown on its /similar page. [papers] and [scores] are the int64 paper ids and
+    float32 cosine scores (sorted by the score), [threshold] is the score a new paper has to beat to enter the list (0 while
+    the list isn't full) and [epoch] is the vocabulary epoch of the vectors the scores come from."""
+    paper_id = db.Column(db.Integer, db.ForeignKey('paper.id'), primary_key=True)
+    papers = db.Column(db.LargeBinary, nullable=False)
+    scores = db.Column(db.LargeBinary, nullable=False)
+    threshold = db.Column(db.Float, nullable=False)
+    epoch = db.Column(db.Integer, nullable=False)
+
+    def ranking(self):
+        """Returns the paper ids and scores as numpy arrays (read-only views of the blobs)."""
+        return np.frombuffer(self.papers, dtype=np.int64), np.frombuffer(self.scores, dtype=np.float32)
+
+class Digest(db.Model):
+    """The last email digest sent to a user. [newest_paper] is the id of the newest paper of the download it was made
+    for, so running the digest job again skips the users who already got theirs."""
+    user_email = db.Column(db.String(320), db.ForeignKey('user.email'), primary_key=True)
+    newest_paper = db.Column(db.Integer, nullable=False)
+    sent_date = db.Column(db.DateTime, nullable=False)
+
+class Ingestion(db.Model):
+    """Ingestion log of the arXiv scraper, one row per arXiv article (id without the version). [state] is how far the
+    newest listed [version] got: listed, fetched, extracted, vectorized (the paper is in the database), committed (the
+    vocabulary with its document frequencies is saved too) or published (the indexes, the feeds and the digests were
+    updated with it). [attempts] counts the runs that tried to ingest it."""
+    arxiv_id = db.Column(db.String(40), primary_key=True)
+    version = db.Column(db.Integer, nullable=False)
+    state = db.Column(db.String(10), nullable=False)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    updated_date = db.Column(db.DateTime, nullable=False)
+    paper_id = db.Column(db.Integer, db.ForeignKey('paper.id'))
+
+class IngestionCursor(db.Model):
+    """Start index of the first page of the arXiv listing that still has unfinished articles, for the run that downloads
+    the papers since [starting_date]. A crashed run continues from there instead of listing everything again."""
+    starting_date = db.Column(db.DateTime, primary_key=True)
+    start_index = db.Column(db.Integer, default=0, nullable=False)
+    finished = db.Column(db.Boolean, default=False, nullable=False)
+
+def get_term_ids(terms, create=False):
+    """Returns a dict term -> id for the [terms] that are in the Term table. If [create] is True the missing terms are
+    added to the table (the caller commits them). Needs an app context."""
+    terms = [term for term in dict.fromkeys(terms) if len(term) <= 300]
+    ids = {}
+    # Querying in chunks, so the IN clause doesn't get too long
+    for i in range(0, len(terms), 500):
+        chunk = terms[i:i+500]
+        ids.update(db.session.execute(db.select(Term.term, Term.id).where(Term.term.in_(chunk))).all())
+    if create:
+        new_terms = [Term(term=term) for term in terms if term not in ids]
+        db.session.add_all(new_terms)
+        db.session.flush()
+        ids.update((term.term, term.id) for term in new_terms)
+    return ids
+
+# States of the ingested papers that are in the database but weren't published yet
+UNPUBLISHED_STATES = ('vectorized', 'committed')
+
+def unpublished_paper_ids():
+    """Returns the ids of the papers in the database that the indexes, the feeds and the digests weren't updated with,
+    including the ones added by a run that crashed before it published them. Needs an app context."""
+    return list(db.session.execute(
+        db.select(Ingestion.paper_id).where(Ingestion.state.in_(UNPUBLISHED_STATES), Ingestion.paper_id.is_not(None))
+    ).scalars())
+
+def mark_published(paper_ids):
+    """Marks the papers with [paper_ids] as published, after everything was updated with them (the caller commits)."""
+    for i in range(0, len(paper_ids), 500):
+        db.session.execute(
+            db.update(Ingestion).where(Ingestion.paper_id.in_(paper_ids[i:i+500]), Ingestion.state.in_(UNPUBLISHED_STATES))
+            .values(state='published')
+        )
@@ -0,0 +1,262 @@
+"""Email digest of the new papers, sent to every user after the nightly download. Only the papers of the download are
+scored: the profiles of a chunk of users are stacked into a sparse matrix and multiplied with the rows of the new papers,
+one sparse x sparse product per chunk. The digests are rendered with templates that are compiled once and delivered by a
+pool of SMTP connections, a message that fails is retried on a new connection. Every delivered digest is recorded, so
+running the job again skips the users who already got theirs.
+Run it by hand with: python digest.py [--hours 24]"""
+from concurrent.futures import ThreadPoolExecutor
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.utils import parseaddr
+from itsdangerous import URLSafeSerializer, BadSignature
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+from database import db, User, Paper, Digest
+from ranking import engine
+from metrics import digest_deliveries
+from scipy.sparse import csr_matrix
+from datetime import datetime
+import numpy as np
+import resource
+import smtplib
+import logging
+import queue
+import time
+import os
+
+# Number of papers in a digest, papers below MIN_SCORE are left out (a user without any gets no email)
+DIGEST_LENGTH = 10
+MIN_SCORE = 0.05
+# Number of users scored and sent together, the digests of a chunk are recorded when all of them are delivered
+USER_CHUNK = 1024
+SMTP_CONNECTIONS = 4
+SMTP_TIMEOUT = 30
+RETRIES = 2
+# Seconds before the first retry, doubled for every next one
+RETRY_DELAY = 1.0
+TEMPLATES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+
+def user_matrix(vectors, n_terms):
+    """Stacks the SparseVectors of the users into a CSR matrix with [n_terms] columns and returns it with the norms of
+    the whole vectors. Terms that don't appear in any paper only contribute to the norms."""
+    norms = np.array([vector.norm() for vector in vectors])
+    vectors = [(vector.ids[vector.ids < n_terms], vector.weights[vector.ids < n_terms]) for vector in vectors]
+    indptr = np.zeros(len(vectors) + 1, dtype=np.int64)
+    np.cumsum([len(ids) for ids, _ in vectors], out=indptr[1:])
+    indices = np.concatenate([ids for ids, _ in vectors] or [np.zeros(0, dtype=np.int32)])
+    data = np.concatenate([weights for _, weights in vectors] or [np.zeros(0, dtype=np.float32)])
+    return csr_matrix((data, indices, indptr), shape=(len(vectors), n_terms)), norms
+
+def best_papers(scores, k=DIGEST_LENGTH, min_score=MIN_SCORE):
+    """Returns the columns of the [k] best scores of every row that are above [min_score], sorted by the score. Ties are
+    broken by the column, like in RankingEngine.top_k."""
+    rankings = []
+    for row in scores:
+        candidates = np.flatnonzero(row > min_score)
+        if k < len(candidates):
+            candidates = candidates[np.argpartition(-row[candidates], k)[:k]]
+        rankings.append(candidates[np.lexsort((candidates, -row[candidates]))])
+    return rankings
+
+class SMTPPool:
+    """Up to [connections] SMTP connections shared by the threads that send the messages. A connection that fails is
+    closed and the message is sent again on a new one."""
+
+    def __init__(self, host, port, username=None, password=None, starttls=False, connections=SMTP_CONNECTIONS):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.connections = connections
+        self.idle = queue.LifoQueue()
+
+    def connect(self):
+        connection = smtplib.SMTP(self.host, self.port, timeout=SMTP_TIMEOUT)
+        if self.starttls:
+            connection.starttls()
+        if self.username:
+            connection.login(self.username, self.password)
+        return connection
+
+    def send(self, sender, message):
+        """Sends the (recipient, message bytes) [message] from [sender], returns True if it was delivered."""
+        recipient, content = message
+        for attempt in range(RETRIES + 1):
+            if attempt > 0:
+                digest_deliveries.inc(status='retried')
+                time.sleep(RETRY_DELAY * 2 ** (attempt - 1))
+            try:
+                connection = self.idle.get_nowait()
+            except queue.Empty:
+                connection = None
+            try:
+                if connection is None:
+                    connection = self.connect()
+                connection.sendmail(sender, [recipient], content)
+            except smtplib.SMTPRecipientsRefused:
+                # The address is wrong, sending it again won't help
+                self.idle.put(connection)
+                logging.error(f"The digest to {recipient} was refused")
+                break
+            except (smtplib.SMTPException, OSError):
+                logging.exception(f"Couldn't send the digest to {recipient}")
+                if connection is not None:
+                    try:
+                        connection.close()
+                    except OSError:
+                        pass
+                continue
+            self.idle.put(connection)
+            digest_deliveries.inc(status='sent')
+            return True
+        digest_deliveries.inc(status='failed')
+        return False
+
+    def close(self):
+        while not self.idle.empty():
+            connection = self.idle.get_nowait()
+            try:
+                connection.quit()
+            except (smtplib.SMTPException, OSError):
+                connection.close()
+
+class DigestMailer:
+    """Sends the digests through the SMTP server at [host] (the digests are off while it's None). [site_url] is the
+    address of the website used in the links of the digests, [secret_key] signs the unsubscribe links."""
+
+    def __init__(self):
+        self.host = None
+        self.port = 25
+        self.username = None
+        self.password = None
+        self.starttls = False
+        self.sender = 'GradientDigest <digest@localhost>'
+        self.site_url = 'http://localhost:5000'
+        self.connections = SMTP_CONNECTIONS
+        self.environment = None
+        self.secret_key = None
+
+    def templates(self):
+        """The plain text and the html templates of the digest, compiled on the first call."""
+        if self.environment is None:
+            self.environment = Environment(loader=FileSystemLoader(TEMPLATES_PATH), autoescape=select_autoescape(['html']))
+        return self.environment.get_template('digest.txt'), self.environment.get_template('digest.html')
+
+    def unsubscribe_url(self, email):
+        """The link that unsubscribes [email] from the digest, signed so nobody else can unsubscribe them."""
+        return f"{self.site_url}/unsubscribe/{URLSafeSerializer(self.secret_key, salt='unsubscribe').dumps(email)}"
+
+    def unsubscribe_email(self, token):
+        """The email of the unsubscribe link with [token], None if the signature doesn't match."""
+        try:
+            return URLSafeSerializer(self.secret_key, salt='unsubscribe').loads(token)
+        except BadSignature:
+            return None
+
+    def message(self, email, papers, date, templates):
+        """Returns the digest with the ranked [papers] for [email] as a (recipient, message bytes) tuple."""
+        text_template, html_template = templates
+        unsubscribe_url = self.unsubscribe_url(email)
+        context = {'papers': papers, 'date': date, 'site_url': self.site_url, 'unsubscribe_url': unsubscribe_url}
+        # The legacy MIME classes are about twice as fast as EmailMessage, which matters for thousands of digests
+        message = MIMEMultipart('alternative')
+        message['Subject'] = f"Your GradientDigest for {date:%B %d, %Y}"
+        message['From'] = self.sender
+        message['To'] = email
+        message['List-Unsubscribe'] = f"<{unsubscribe_url}>"
+        message.attach(MIMEText(text_template.render(context), 'plain', 'utf-8'))
+        message.attach(MIMEText(html_template.render(context), 'html', 'utf-8'))
+        return email, message.as_bytes()
+
+    def send(self, new_ids, now=None, chunk=USER_CHUNK):
+        """Emails every user with a profile who didn't unsubscribe the best of the papers with [new_ids]. Needs an app context and a loaded
+        ranking engine. Returns the number of sent, failed and skipped (no paper above MIN_SCORE) digests."""
+        engine.ensure_loaded()
+        with engine.lock:
+            matrix, norms = engine.matrix, engine.norms
+        rows = engine.rows(new_ids)
+        rows = rows[rows >= 0]
+        stats = {'sent': 0, 'failed': 0, 'skipped': 0}
+        if len(rows) == 0:
+            return stats
+        # Only the rows of the new papers are scored, transposed once for all the chunks
+        papers_matrix = matrix[rows].T.tocsr()
+        paper_norms = norms[rows]
+        ids = engine.ids[rows]
+        newest_paper = int(ids.max())
+        papers = {}
+        for i in range(0, len(ids), 500):
+            papers.update((row.id, row) for row in db.session.execute(
+                db.select(Paper.id, Paper.title, Paper.authors, Paper.site_link, Paper.pdf_link)
+                .where(Paper.id.in_(ids[i:i+500].tolist()))
+            ))
+        now = now or datetime.now()
+        templates = self.templates()
+
+        done = set(db.session.execute(db.select(Digest.user_email).where(Digest.newest_paper == newest_paper)).scalars())
+        # The users who haven't picked their interests yet have an empty profile
+        users = [
+            (email, vector) for email, vector in db.session.execute(
+                db.select(User.email, User.vector).where(User.digest_unsubscribed.is_(None)).order_by(User.email)
+            )
+            if email not in done and len(vector)
+        ]
+        logging.info(f"Sending digests of {len(ids)} new papers to {len(users)} users ({len(done)} already sent)")
+
+        start = time.perf_counter()
+        pool = SMTPPool(self.host, self.port, self.username, self.password, self.starttls, self.connections)
+        # The envelope sender is the address without the display name
+        sender = parseaddr(self.sender)[1]
+        with ThreadPoolExecutor(self.connections) as executor:
+            for first in range(0, len(users), chunk):
+                users_chunk = users[first:first + chunk]
+                vectors, user_norms = user_matrix([vector for _, vector in users_chunk], papers_matrix.shape[0])
+                denominator = user_norms[:, None] * paper_norms[None, :]
+                products = (vectors @ papers_matrix).toarray()
+                scores = np.divide(products, denominator, out=np.zeros(products.shape), where=denominator > 0)
+
+                emails, messages = [], []
+                for (email, _), user_scores, best in zip(users_chunk, scores, best_papers(scores)):
+                    if len(best) == 0:
+                        stats['skipped'] += 1
+                        continue
+                    ranked = [(papers[ids[i]], float(user_scores[i])) for i in best]
+                    emails.append(email)
+                    messages.append(self.message(email, ranked, now, templates))
+                delivered = list(executor.map(pool.send, [sender] * len(messages), messages))
+
+                sent = [email for email, ok in zip(emails, delivered) if ok]
+                if sent:
+                    db.session.execute(db.delete(Digest).where(Digest.user_email.in_(sent)))
+                    db.session.execute(db.insert(Digest), [
+                        {'user_email': email, 'newest_paper': newest_paper, 'sent_date': now} for email in sent
+                    ])
+                    # Committing every chunk, so an interrupted run keeps the delivered digests
+                    db.session.commit()
+                stats['sent'] += len(sent)
+                stats['failed'] += len(delivered) - len(sent)
+        pool.close()
+
+        elapsed = time.perf_counter() - start
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        logging.info(
+            f"Sent {stats['sent']} digests ({stats['failed']} failed, {stats['skipped']} without papers) in {elapsed:.1f}s "
+            f"({stats['sent'] / elapsed if elapsed else 0:.1f} digests/s), peak RSS {peak_rss / 1024:.0f} MiB"
+        )
+        return stats
+
+digest_mailer = DigestMailer()
+
+if __name__ == '__main__':
+    from main import app
+    from datetime import timedelta
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hours', type=int, default=24, help="send the papers updated in the last HOURS hours")
+    args = parser.parse_args()
+    with app.app_context():
+        if digest_mailer.host is None:
+            raise SystemExit("Set SMTP_HOST in config.json to send the digests")
+        since = datetime.now() - timedelta(hours=args.hours)
+        new_ids = db.session.execute(db.select(Paper.id).where(Paper.updated_date >= since)).scalars().all()
+        digest_mailer.send(new_ids)
@@ -0,0 +1,135 @@
+"""Nightly ranking job that precomputes the home page feeds, so the first visit after a download doesn't have to score the
+new papers. The users are scored against all the papers in chunks (one sparse x sparse matrix product per chunk) by a pool
+of processes, and the best [feed_length] papers of every time period are stored in the Feed table. The workers map the
+published paper matrix (or share the one of the parent process), it's never copied to them.
+The job can be stopped at any time, running it again skips the users whose feeds are already up to date.
+Run it by hand with: python feeds.py"""
+from concurrent.futures import ProcessPoolExecutor
+from database import db, User, Feed
+from ranking import engine, RankingEngine
+from scipy.sparse import csr_matrix
+from datetime import datetime
+import multiprocessing
+import numpy as np
+import resource
+import logging
+import time
+import os
+
+# Number of papers stored for every user and time period
+FEED_LENGTH = 1000
+# Number of users scored at once by a worker, the worker holds a users x papers array of scores
+USER_CHUNK = 64
+WORKERS = os.cpu_count() or 1
+
+# The paper matrix of the worker processes, set by init_ranker
+worker_state = None
+
+def init_ranker(path, generation, arrays, starts, feed_length):
+    """Maps the published [generation] under [path], or uses the (matrix, norms, ids) [arrays] of the parent process (the
+    workers are forked, so they are shared copy-on-write) if [generation] is None. The lock of the parent's engine is
+    never taken, a request thread could have held it when the worker was forked."""
+    global worker_state
+    if generation is not None:
+        worker_engine = RankingEngine(path)
+        worker_engine.map(generation)
+        arrays = (worker_engine.matrix, worker_engine.norms, worker_engine.ids)
+    worker_state = (*arrays, starts, feed_length)
+
+def rank_users(vectors):
+    """Takes a list of (term ids, weights) user profiles and returns, for every user and every time period starting at
+    the rows in [starts], the (paper ids, scores) of the best papers. Runs in a worker process."""
+    matrix, norms, ids, starts, feed_length = worker_state
+    # The profiles as a users x terms CSR block, the terms that don't appear in any paper only contribute to the norm
+    inside = [term_ids < matrix.shape[1] for term_ids, _ in vectors]
+    indptr = np.zeros(len(vectors) + 1, dtype=np.int64)
+    np.cumsum([mask.sum() for mask in inside], out=indptr[1:])
+    block = csr_matrix((
+        np.concatenate([weights[mask] for (_, weights), mask in zip(vectors, inside)]).astype(np.float32),
+        np.concatenate([term_ids[mask] for (term_ids, _), mask in zip(vectors, inside)]),
+        indptr
+    ), shape=(len(vectors), matrix.shape[1]))
+    user_norms = np.array([np.sqrt(weights.astype(np.float64) @ weights) for _, weights in vectors])
+    denominator = (user_norms[:, None] * norms[None, :]).astype(np.float32)
+    products = (matrix @ block.T).T.toarray()
+    scores = np.divide(products, denominator, out=np.zeros(denominator.shape, dtype=np.float32), where=denominator > 0)
+
+    rankings = []
+    for user_scores in scores:
+        feeds = []
+        for start in starts:
+            window = user_scores[start:]
+            if feed_length < len(window):
+                best = np.argpartition(-window, feed_length)[:feed_length]
+            else:
+                best = np.arange(len(window))
+            # Ties are broken by the row order, like in RankingEngine.top_k
+            best = best[np.lexsort((best, -window[best]))]
+            feeds.append((ids[start + best], window[best]))
+        rankings.append(feeds)
+    return rankings
+
+def precompute_feeds(deltas, now=None, feed_length=FEED_LENGTH, chunk=USER_CHUNK, workers=WORKERS):
+    """Ranks the papers for every user with a profile and every time period (now - delta for the [deltas]) and stores
+    the feeds. Needs an app context and a loaded ranking engine."""
+    engine.ensure_loaded()
+    with engine.lock:
+        matrix, norms, ids = engine.matrix, engine.norms, engine.ids
+        # The workers map the published arrays if the engine holds them (it wasn't built again since it was published)
+        generation = engine.generation if engine.path and engine.version == engine.generation else None
+    if len(ids) == 0:
+        return
+    newest_paper = int(ids.max())
+    now = now or datetime.now()
+    starts = [engine.window(now - delta) for delta in deltas]
+
+    # The users that already have all their feeds for the current papers and their current profile were ranked by an
+    # interrupted run
+    done = set(db.session.execute(
+        db.select(Feed.user_email).join(User, User.email == Feed.user_email)
+        .where(Feed.newest_paper == newest_paper, Feed.profile_updated.is_not_distinct_from(User.profile_updated))
+        .group_by(Feed.user_email).having(db.func.count() == len(deltas))
+    ).scalars())
+    # The time of the last profile change is stored with the feeds, a like during the job makes them outdated
+    users = [
+        (email, vector, updated) for email, vector, updated in db.session.execute(
+            db.select(User.email, User.vector, User.profile_updated).order_by(User.email)
+        )
+        if email not in done and len(vector)
+    ]
+    chunks = [users[i:i+chunk] for i in range(0, len(users), chunk)]
+    logging.info(f"Ranking feeds of {len(users)} users ({len(done)} already done) against {len(ids)} papers")
+
+    start = time.perf_counter()
+    ranked = 0
+    with ProcessPoolExecutor(
+        workers, mp_context=multiprocessing.get_context('fork'), initializer=init_ranker,
+        initargs=(engine.path, generation, (matrix, norms, ids) if generation is None else None, starts, feed_length)
+    ) as pool:
+        tasks = ([(vector.ids, vector.weights) for _, vector, _ in users_chunk] for users_chunk in chunks)
+        for users_chunk, rankings in zip(chunks, pool.map(rank_users, tasks)):
+            emails = [email for email, _, _ in users_chunk]
+            db.session.execute(db.delete(Feed).where(Feed.user_email.in_(emails)))
+            db.session.execute(db.insert(Feed), [
+                {
+                    'user_email': email, 'time_option': option, 'papers': papers.astype(np.int64).tobytes(),
+                    'scores': scores.astype(np.float32).tobytes(), 'newest_paper': newest_paper,
+                    'profile_updated': updated
+                }
+                for (email, _, updated), feeds in zip(users_chunk, rankings) for option, (papers, scores) in enumerate(feeds)
+            ])
+            # Committing every chunk, so an interrupted run keeps the finished users
+            db.session.commit()
+            ranked += len(users_chunk)
+
+    elapsed = time.perf_counter() - start
+    peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    logging.info(
+        f"Ranked feeds of {ranked} users in {elapsed:.1f}s ({ranked / elapsed if elapsed else 0:.1f} users/s), "
+        f"peak RSS {peak_rss / 1024:.0f} MiB"
+    )
+
+if __name__ == '__main__':
+    from main import app, TIME_OPTIONS_DELTAS
+    with app.app_context():
+        precompute_feeds(TIME_OPTIONS_DELTAS)
@@ -0,0 +1,35 @@
+"""Dedicated ingestion process for the shared serving mode (SERVING_MODE = "shared"). It is the only process that downloads
+the papers: every day at 00:30 in the arXiv timezone it runs download_papers(), which publishes the new paper matrix for
+the web workers. On start it saves the indexes and publishes the current papers, so the workers have something to map.
+Run exactly one of it next to the web workers: python ingest.py [--now]"""
+from main import app, download_papers, update_indexes, ARXIV_TIMEZONE, SERVING_MODE
+from apscheduler.schedulers.blocking import BlockingScheduler
+from ranking import engine
+from search_index import search_index
+from ann import ann_index
+from lsa import lsa_index
+import argparse
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--now', action='store_true', help="download the papers once and exit")
+    args = parser.parse_args()
+
+    # In the single mode the web server downloads the papers itself
+    if SERVING_MODE != "shared":
+        raise SystemExit('The ingestion process only runs with SERVING_MODE = "shared"')
+    # This is the process that builds and saves the indexes the web workers load
+    search_index.read_only = False
+    ann_index.read_only = False
+    lsa_index.read_only = False
+
+    if args.now:
+        download_papers()
+    else:
+        with app.app_context():
+            engine.refresh()
+            update_indexes([], engine.epoch)
+            engine.publish(engine.epoch)
+        scheduler = BlockingScheduler()
+        scheduler.add_job(download_papers, trigger="cron", hour=0, minute=30, timezone=ARXIV_TIMEZONE)
+        scheduler.start()
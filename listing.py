@@ -0,0 +1,140 @@
+"""Asynchronous listing of the arXiv Atom feed used by the arXiv scraper.
+The pages of the listing are requested by an asyncio event loop in a background thread. While one page is being consumed
+the next ones are already downloaded, parsed and validated, and the requests to the API are at least [interval] seconds
+apart. The pages are still given to the consumer in order, because the listing is sorted by the update date."""
+from metrics import scraper_stage_seconds, scraper_failures
+from collections import deque
+import dateutil.parser
+import feedparser
+import itertools
+import threading
+import asyncio
+import aiohttp
+import logging
+import time
+
+# Number of articles in one page of the listing (the API allows up to 2000)
+PAGE_SIZE = 200
+# Number of pages that are requested ahead of the one being consumed
+PREFETCH_PAGES = 3
+# Minimum number of seconds between two requests to the API, arXiv asks for 3
+LISTING_INTERVAL = 3.0
+PAGE_TIMEOUT = 60
+RETRIES = 1
+
+def parse_article(entry):
+    """Converts an entry of the feed to an article dict, returns None if the entry doesn't have the expected structure."""
+    try:
+        links = entry['links']
+        article = {
+            'pdf_link': links[1]['href'],
+            'site_link': links[0]['href'],
+            'title': entry['title'],
+            'abstract': entry['summary'],
+            'authors': ", ".join(author['name'] for author in entry['authors']),
+            'updated_date': dateutil.parser.isoparse(entry['updated']),
+        }
+    except (KeyError, IndexError, TypeError, ValueError):
+        logging.error(f"The structure of the API response is invalid: {entry.get('id', 'an entry without an id')}")
+        return None
+    if not all(isinstance(article[key], str) for key in ('pdf_link', 'site_link', 'title', 'abstract')):
+        logging.error(f"The structure of the API response is invalid: {entry.get('id', 'an entry without an id')}")
+        return None
+    return article
+
+def parse_page(content):
+    """Parses a page of the Atom feed, returns the number of its entries and the list of the valid articles. Runs in a
+    thread of the event loop's executor."""
+    entries = feedparser.parse(content)['entries']
+    return len(entries), [article for article in map(parse_article, entries) if article is not None]
+
+class AtomListing:
+    """Iterates over the pages of the listing at [url] (which ends with the search query) from the article number
+    [start_index]. Every page is a (start index, valid articles) tuple, the iteration stops at the first empty page or after
+    [max_pages] pages. A page that couldn't be downloaded is treated as the end of the listing."""
+
+    def __init__(self, url, start_index=0, page_size=PAGE_SIZE, prefetch=PREFETCH_PAGES, interval=LISTING_INTERVAL, max_pages=None):
+        self.url = url
+        self.start_index = start_index
+        self.page_size = page_size
+        self.prefetch = prefetch
+        self.interval = interval
+        self.max_pages = max_pages
+        self.next_slot = 0.0
+
+    def page_url(self, start_index):
+        return self.url + f'&sortBy=lastUpdatedDate&start={start_index}&max_results={self.page_size}'
+
+    async def wait_slot(self):
+        # Everything runs in the one event loop thread, so the slots don't need a lock
+        now = time.monotonic()
+        slot = max(now, self.next_slot)
+        self.next_slot = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def fetch_page(self, session, start_index):
+        """Downloads and parses the page starting at [start_index], returns the number of its entries and its articles, or
+        None if it failed."""
+        for attempt in range(RETRIES + 1):
+            if attempt > 0:
+                logging.error("There was a problem with downloading a page of the listing, trying again...")
+            await self.wait_slot()
+            start = time.perf_counter()
+            try:
+                async with session.get(self.page_url(start_index)) as response:
+                    response.raise_for_status()
+                    content = await response.read()
+                page = await asyncio.get_running_loop().run_in_executor(None, parse_page, content)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                scraper_failures.inc(stage='feed')
+                continue
+            scraper_stage_seconds.observe(time.perf_counter() - start, stage='feed')
+            return page
+        logging.error(f"Couldn't download the page of the listing from the article number {start_index}")
+        return None
+
+    async def next_page(self, session, pending, start_indices):
+        # Keeping [prefetch] pages in flight, the pages are started in order so they also get the rate limit slots in order
+        while len(pending) < self.prefetch + 1:
+            start_index = next(start_indices)
+            pending.append((start_index, asyncio.ensure_future(self.fetch_page(session, start_index))))
+        start_index, task = pending.popleft()
+        return start_index, await task
+
+    async def close(self, session, pending):
+        for _, task in pending:
+            task.cancel()
+        await asyncio.gather(*(task for _, task in pending), return_exceptions=True)
+        await session.close()
+        await asyncio.get_running_loop().shutdown_default_executor()
+
+    def __iter__(self):
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+
+        def call(coroutine):
+            return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+
+        async def open_session():
+            return aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=PAGE_TIMEOUT))
+
+        session = call(open_session())
+        pending = deque()
+        start_indices = itertools.count(self.start_index, self.page_size)
+        try:
+            pages = 0
+            while self.max_pages is None or pages < self.max_pages:
+                start_index, page = call(self.next_page(session, pending, start_indices))
+                if page is None or page[0] == 0:
+                    return
+                articles = page[1]
+                yield start_index, articles
+                pages += 1
+        finally:
+            # The consumer can stop early (at the first article that is too old), the prefetched pages are dropped
+            call(self.close(session, pending))
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
@@ -0,0 +1,290 @@
+"""Dense low-rank (LSA) embeddings of the papers and the user profiles, used for the recommendations instead of the sparse
+cosine when RECOMMENDER_BACKEND is "lsa". A truncated SVD of the tf-idf vectors of the papers maps every term to a few
+hundred dense weights, so papers that use related terms end up close even when they share few of them.
+The SVD is trained incrementally: a batch of new papers is merged into the current singular values and vectors through
+the eigendecomposition of a small Gram matrix, so a download never refits the whole corpus. The embeddings of the papers
+are kept in one contiguous float32 array in the row order of the ranking engine (sorted by date), scoring a profile
+against a time period is a single matrix-vector product over its rows.
+The arrays are published as generations of .npy files like the paper matrix, the web workers map them read-only, so the
+components and the embeddings are in memory once whatever the number of workers."""
+from scipy.sparse import csr_matrix, diags
+from ranking import engine, to_datetime64, write_generation, read_generation
+from recommender import ALPHA, BETA
+from metrics import stage
+import numpy as np
+import threading
+import logging
+import time
+
+LSA_PATH = 'lsa'
+ARRAYS = ['components', 'singular', 'vectors', 'ids', 'merged', 'meta']
+DIMENSIONS = 256
+# Number of papers merged into the SVD at once, the Gram matrix of a merge has (DIMENSIONS + BATCH)^2 entries
+BATCH = 2048
+# Number of papers projected at once, it bounds the memory of the sparse x dense products
+PROJECT_CHUNK = 8192
+# Directions with smaller squared singular values are numerical noise
+EPSILON = 1e-9
+
+def normalize(vectors):
+    """L2 normalizes the last axis, zero vectors stay zero."""
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+
+def merge(components, singular, matrix, dimensions):
+    """Returns the components and the singular values of the rank [dimensions] SVD of the rows of the CSR [matrix] stacked
+    under the current approximation diag(singular) @ components.T. [components] is the terms x rank matrix of the right
+    singular vectors, new terms (columns of [matrix] past its rows) start at zero."""
+    n_terms = max(len(components), matrix.shape[1])
+    if len(components) < n_terms:
+        components = np.vstack([components, np.zeros((n_terms - len(components), components.shape[1]), dtype=np.float32)])
+    if matrix.shape[1] < n_terms:
+        matrix = matrix.copy()
+        matrix.resize((matrix.shape[0], n_terms))
+    rank = len(singular)
+    # The Gram matrix of the stacked rows, the components are orthonormal so the old rows only add diag(singular^2)
+    projected = (matrix @ components).astype(np.float64)
+    gram = np.empty((rank + matrix.shape[0], rank + matrix.shape[0]))
+    gram[:rank, :rank] = np.diag(singular ** 2)
+    gram[:rank, rank:] = singular[:, None] * projected.T
+    gram[rank:, :rank] = gram[:rank, rank:].T
+    gram[rank:, rank:] = (matrix @ matrix.T).toarray()
+    eigenvalues, eigenvectors = np.linalg.eigh(gram)
+    top = np.argsort(-eigenvalues)[:dimensions]
+    top = top[eigenvalues[top] > EPSILON]
+    new_singular = np.sqrt(eigenvalues[top])
+    eigenvectors = eigenvectors[:, top] / new_singular
+    # The right singular vectors of the stacked rows are their transpose times the left ones, scaled by 1 / singular
+    rotation = (singular[:, None] * eigenvectors[:rank]).astype(np.float32)
+    new_components = components @ rotation + matrix.T @ eigenvectors[rank:].astype(np.float32)
+    return np.ascontiguousarray(new_components, dtype=np.float32), new_singular
+
+class LsaIndex:
+    """Truncated SVD of the papers of a RankingEngine. [components] is the terms x dimensions projection of the tf-idf
+    vectors (the right singular vectors) and [singular] the singular values. [vectors] are the normalized embeddings of
+    the papers in the row order of the engine, with their [ids] and [dates]. The generations are published under [path],
+    if it's None nothing is saved."""
+
+    def __init__(self, engine, path=LSA_PATH, dimensions=DIMENSIONS):
+        self.engine = engine
+        self.path = path
+        self.dimensions = dimensions
+        self.lock = threading.Lock()
+        self.loaded = False
+        # The web workers of the shared serving mode only map the generations published by the ingestion process
+        self.read_only = False
+        # Changes with the components, the user embeddings stored for another version are projected again
+        self.version = 0
+        # The vocabulary epoch of the vectors the SVD was trained on, the engine version the embeddings are aligned with
+        # and the sorted ids of the papers merged into the SVD
+        self.epoch = 0
+        self.engine_version = None
+        self.merged = np.zeros(0, dtype=np.int64)
+        self.components = np.zeros((0, dimensions), dtype=np.float32)
+        self.singular = np.zeros(0)
+        self.vectors = np.zeros((0, dimensions), dtype=np.float32)
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.dates = np.zeros(0, dtype='datetime64[us]')
+
+    def batches(self, matrix, norms, rows):
+        """The L2 normalized [rows] of the engine's [matrix] in batches of BATCH rows, so long papers don't dominate."""
+        for first in range(0, len(rows), BATCH):
+            batch = rows[first:first + BATCH]
+            scale = np.divide(1, norms[batch], out=np.zeros(len(batch)), where=norms[batch] > 0)
+            yield csr_matrix(diags(scale.astype(np.float32)) @ matrix[batch])
+
+    def fit(self, epoch):
+        """Trains the SVD from scratch on all the papers of the engine (from the oldest) and projects them."""
+        self.engine.ensure_loaded()
+        with self.engine.lock:
+            matrix, norms, ids = self.engine.matrix, self.engine.norms, self.engine.ids
+        start = time.perf_counter()
+        components, singular = np.zeros((0, 0), dtype=np.float32), np.zeros(0)
+        for batch in self.batches(matrix, norms, np.arange(matrix.shape[0])):
+            components, singular = merge(components, singular, batch, self.dimensions)
+        with self.lock:
+            self.components, self.singular, self.merged = components, singular, np.sort(ids)
+            self.epoch, self.version = epoch, time.time_ns()
+            self.loaded = True
+        self.align(force=True)
+        self.save()
+        logging.info(
+            f"LSA trained on {matrix.shape[0]} papers with {len(singular)} dimensions in {time.perf_counter() - start:.1f}s"
+        )
+
+    def update(self, new_ids, epoch):
+        """Merges the papers with [new_ids] (they have to be in the engine already) into the SVD and projects all the
+        papers again, the embeddings of the old components don't match the new ones. A paper that was merged before (a
+        new version of it) isn't merged twice, its embedding is projected from the new vector. The SVD is trained from
+        scratch if the papers were re-weighted (the vocabulary [epoch] changed)."""
+        if not self.loaded:
+            self.load()
+        if not self.loaded or self.epoch != epoch:
+            self.fit(epoch)
+            return
+        rows = self.engine.rows(new_ids)
+        rows = rows[rows >= 0]
+        with self.engine.lock:
+            matrix, norms, ids = self.engine.matrix, self.engine.norms, self.engine.ids
+        with self.lock:
+            components, singular, merged = self.components, self.singular, self.merged
+        rows = np.sort(rows[~np.isin(ids[rows], merged)])
+        start = time.perf_counter()
+        for batch in self.batches(matrix, norms, rows):
+            components, singular = merge(components, singular, batch, self.dimensions)
+        with self.lock:
+            self.components, self.singular, self.merged = components, singular, np.union1d(merged, ids[rows])
+            self.version = time.time_ns()
+        self.align(force=True)
+        self.save()
+        logging.info(f"LSA updated with {len(rows)} papers in {time.perf_counter() - start:.1f}s")
+
+    def project(self, matrix):
+        """Returns the embeddings (not normalized) of the rows of the CSR [matrix] of tf-idf vectors."""
+        with self.lock:
+            components = self.components
+        embeddings = np.zeros((matrix.shape[0], components.shape[1]), dtype=np.float32)
+        for first in range(0, matrix.shape[0], PROJECT_CHUNK):
+            chunk = matrix[first:first + PROJECT_CHUNK]
+            # Terms that are newer than the SVD have no components
+            if chunk.shape[1] > len(components):
+                chunk = chunk[:, :len(components)]
+            elif chunk.shape[1] < len(components):
+                chunk.resize((chunk.shape[0], len(components)))
+            embeddings[first:first + PROJECT_CHUNK] = chunk @ components
+        return embeddings
+
+    def project_vector(self, vector):
+        """Returns the embedding (not normalized) of a SparseVector, a weighted sum of the components of its terms."""
+        with self.lock:
+            components = self.components
+        inside = vector.ids < len(components)
+        return vector.weights[inside] @ components[vector.ids[inside]]
+
+    def align(self, force=False):
+        """Puts the embeddings in the row order of the engine after it changed. The papers that are new to the index are
+        projected with the current components (folded in), with [force] all the papers are projected again."""
+        with self.engine.lock:
+            matrix, ids, dates, version = self.engine.matrix, self.engine.ids, self.engine.dates, self.engine.version
+        if version == self.engine_version and not force:
+            return
+        with self.lock:
+            old_ids, old_vectors = (self.ids, self.vectors) if not force else (self.ids[:0], self.vectors[:0])
+            dimensions = self.components.shape[1]
+        # The published embeddings are in the row order of the published engine, they stay mapped
+        if np.array_equal(old_ids, ids) and old_vectors.shape[1] == dimensions:
+            with self.lock:
+                self.dates, self.engine_version = dates, version
+            return
+        vectors = np.empty((len(ids), dimensions), dtype=np.float32)
+        known = np.zeros(len(ids), dtype=bool)
+        if len(old_ids) and old_vectors.shape[1] == dimensions:
+            order = np.argsort(old_ids)
+            found = order[np.minimum(np.searchsorted(old_ids, ids, sorter=order), len(old_ids) - 1)]
+            known = old_ids[found] == ids
+            vectors[known] = old_vectors[found[known]]
+        missing = np.flatnonzero(~known)
+        with stage('projection'):
+            vectors[missing] = normalize(self.project(matrix[missing]))
+        with self.lock:
+            self.vectors, self.ids, self.dates, self.engine_version = vectors, ids, dates, version
+
+    def save(self):
+        if self.path is None:
+            return
+        with self.lock:
+            arrays = {
+                'components': self.components, 'singular': self.singular, 'vectors': self.vectors, 'ids': self.ids,
+                'merged': self.merged, 'meta': np.array([self.epoch, self.version], dtype=np.int64)
+            }
+        write_generation(self.path, arrays)
+
+    def load(self):
+        """Maps the arrays of the current generation read-only. Returns False if nothing was published yet."""
+        if self.path is None:
+            return False
+        generation, arrays = read_generation(self.path, ARRAYS)
+        if generation is None:
+            return False
+        with self.lock:
+            self.components, self.singular = arrays['components'], arrays['singular']
+            self.vectors, self.ids, self.merged = arrays['vectors'], arrays['ids'], arrays['merged']
+            self.epoch, self.version = int(arrays['meta'][0]), int(arrays['meta'][1])
+            self.engine_version = None
+            self.loaded = True
+        return True
+
+    def ensure_loaded(self, epoch):
+        """Maps the SVD and the embeddings, or trains the SVD if nothing was published yet or the generation is older than
+        the vocabulary [epoch], and aligns the embeddings with the engine. A read only index is never trained, returns
+        False if there is nothing to map yet."""
+        if not self.loaded:
+            self.load()
+            if self.read_only and self.loaded and self.epoch != epoch:
+                logging.warning(f"LSA embeddings {self.path} are from epoch {self.epoch} instead of {epoch}")
+        # The papers were re-weighted or vectorized again while the server was stopped
+        if not self.loaded or (self.epoch != epoch and not self.read_only):
+            if self.read_only:
+                logging.warning(f"LSA embeddings {self.path} not found, they are published by the ingestion process")
+                return False
+            self.fit(epoch)
+            return True
+        self.engine.ensure_loaded()
+        self.align()
+        return True
+
+    def user_embedding(self, user):
+        """The embedding (not normalized) of the [user]'s profile: the stored one if it was made with the current
+        components, otherwise the projection of the sparse profile."""
+        if user.embedding is not None and user.embedding_version == self.version:
+            return np.frombuffer(user.embedding, dtype=np.float32)
+        return self.project_vector(user.vector)
+
+    def update_profile(self, user, updates, alpha=ALPHA, beta=BETA):
+        """Applies the list of (paper vector, liked) [updates] to the [user]'s embedding with the formula of the sparse
+        profile, as axpy operations: a like is E' = alpha * E + beta * D and an unlike E' = (E - beta * D) / alpha, where D
+        is the embedding of the paper. Unlike the sparse profile nothing is pruned. Returns the new embedding."""
+        embedding = np.array(self.user_embedding(user), dtype=np.float32)
+        for vector, liked in updates:
+            document = self.project_vector(vector)
+            if liked:
+                embedding *= alpha
+                embedding += beta * document
+            else:
+                embedding -= beta * document
+                embedding /= alpha
+        return embedding
+
+    def score(self, embedding, since=None):
+        """Returns the ids and the cosine scores (in the embedding space) of all the papers updated since [since]."""
+        with self.lock:
+            vectors, ids, dates = self.vectors, self.ids, self.dates
+        start = int(np.searchsorted(dates, to_datetime64(since), side='left')) if since is not None else 0
+        query = normalize(np.asarray(embedding, dtype=np.float32))
+        if len(query) != vectors.shape[1]:
+            return ids[start:], np.zeros(len(ids) - start, dtype=np.float32)
+        return ids[start:], vectors[start:] @ query
+
+    def top_k(self, embedding, k, since=None):
+        """Returns the ids and scores of the [k] papers closest to the [embedding], sorted by the score."""
+        with stage('scoring'):
+            ids, scores = self.score(embedding, since)
+        with stage('sorting'):
+            if k < len(scores):
+                candidates = np.argpartition(-scores, k)[:k]
+            else:
+                candidates = np.arange(len(scores))
+            # Ties are broken by the row order, like in RankingEngine.top_k
+            order = candidates[np.lexsort((candidates, -scores[candidates]))]
+        return ids[order], scores[order]
+
+    def score_rows(self, embedding, rows):
+        """Returns the cosine scores of the papers in the given rows of the engine."""
+        with self.lock:
+            vectors = self.vectors
+        query = normalize(np.asarray(embedding, dtype=np.float32))
+        if len(query) != vectors.shape[1]:
+            return np.zeros(len(rows), dtype=np.float32)
+        return vectors[rows] @ query
+
+lsa_index = LsaIndex(engine)
@@ -1,19 +1,36 @@
 from flask_login import LoginManager, login_required, login_user, logout_user, user_logged_out, current_user
-from flask import Flask, render_template, redirect, url_for, flash, session, request
+from flask import Flask, render_template, redirect, url_for, flash, session, request, make_response
 from wtforms import SubmitField, PasswordField, EmailField
 from wtforms.validators import DataRequired, Email, Length
 from flask_wtf import FlaskForm
-from database import db, User, Paper
+from database import db, User, Paper, Feed, table, get_term_ids, unpublished_paper_ids, mark_published
+from vectors import SparseVector
 from flask_session import Session
-from arxiv_scraper import get_papers, vectorizer
+from analyzer import get_analyzer
 from datetime import datetime, timedelta, timezone
 from apscheduler.schedulers.background import BackgroundScheduler
-from recommender import update_user_profile, cosine
+from recommender import update_user_profile_batch, cosine
+from ranking import engine, ENGINE_PATH
+from cache import feed_cache, search_cache, card_cache
+from search_index import search_index
+from ann import ann_index
+from lsa import lsa_index
+from feeds import precompute_feeds
+from neighbours import neighbour_table
+from digest import digest_mailer
+from text_store import text_store
+from metrics import stage, search_seconds, init_app as init_metrics
+from werkzeug.http import is_resource_modified
+from markupsafe import Markup
+from collections import Counter
+from functools import lru_cache
 from math import ceil
 import logging
 import bcrypt
+import hashlib
 import json
 import atexit
+import time
 import os
 
 app = Flask(__name__)
@@ -21,18 +38,58 @@ app = Flask(__name__)
 # ---------------------------------------------------------
 # App configuration
 app.config.from_file('config.json', load=json.load)
+# Settings can be overridden with FLASK_ prefixed environment variables (e.g. FLASK_SQLALCHEMY_DATABASE_URI)
+app.config.from_prefixed_env()
 if not app.debug:
     logging.basicConfig(
         level=logging.DEBUG,
         format='%(asctime)s | %(filename)s:%(lineno)s:%(levelname)s | %(message)s'
     )
 
+# The recommendations are computed by scoring every paper ("exact"), with the approximate nearest neighbour index ("ann")
+# or with the dense LSA embeddings of the papers and the profiles ("lsa"). "exact" is the plain cosine of the tf-idf vectors
+RECOMMENDER_BACKEND = app.config.get("RECOMMENDER_BACKEND", "exact")
+ann_index.probes = app.config.get("ANN_PROBES", ann_index.probes)
+ann_index.path = app.config.get("ANN_PATH", ann_index.path)
+lsa_index.path = app.config.get("LSA_PATH", lsa_index.path)
+lsa_index.dimensions = app.config.get("LSA_DIMENSIONS", lsa_index.dimensions)
+search_cache.max_bytes = app.config.get("SEARCH_CACHE_MAX_BYTES", search_cache.max_bytes)
+
+# "single": one process serves the requests and downloads the papers with the background scheduler. "shared": several web
+# workers map the paper matrix published by the dedicated ingestion process (python ingest.py) and never download anything
+SERVING_MODE = app.config.get("SERVING_MODE", "single")
+if SERVING_MODE == "shared":
+    engine.path = app.config.get("ENGINE_PATH", ENGINE_PATH)
+    # The indexes are built and saved by the ingestion process before it publishes the papers, the workers only load them
+    search_index.read_only = True
+    ann_index.read_only = True
+    lsa_index.read_only = True
+
+# The extracted texts (and the pdfs if TEXT_STORE_PDFS is set) are kept for re-vectorizing the papers without downloading them
+text_store.path = app.config.get("TEXT_STORE_PATH", text_store.path)
+text_store.max_bytes = app.config.get("TEXT_STORE_MAX_BYTES", text_store.max_bytes)
+text_store.keep_pdfs = app.config.get("TEXT_STORE_PDFS", text_store.keep_pdfs)
+
+# The email digest of the new papers is sent after every download if SMTP_HOST is set
+digest_mailer.host = app.config.get("SMTP_HOST", digest_mailer.host)
+digest_mailer.port = app.config.get("SMTP_PORT", digest_mailer.port)
+digest_mailer.username = app.config.get("SMTP_USERNAME", digest_mailer.username)
+digest_mailer.password = app.config.get("SMTP_PASSWORD", digest_mailer.password)
+digest_mailer.starttls = app.config.get("SMTP_STARTTLS", digest_mailer.starttls)
+digest_mailer.connections = app.config.get("SMTP_CONNECTIONS", digest_mailer.connections)
+digest_mailer.sender = app.config.get("DIGEST_SENDER", digest_mailer.sender)
+digest_mailer.site_url = app.config.get("SITE_URL", digest_mailer.site_url)
+digest_mailer.secret_key = app.config.get("SECRET_KEY")
+
 # Creating server session to store account info of users that didn't complete the sign up
 app.config["SESSION_SQLALCHEMY"] = db
 Session(app)
 
 db.init_app(app)
 
+# Request timings, the /metrics endpoint and the per request profiler
+init_metrics(app)
+
 # ---------------------------------------------------------
 # Flask-login stuff
 login_manager = LoginManager()
@@ -43,6 +100,18 @@ login_manager.login_view = "login"
 def user_loader(user_id):
     return db.session.get(User, user_id)
 
+# In the shared mode the worker swaps to the newest paper matrix published by the ingestion process, the rankings and
+# indexes built from the old one are dropped
+@app.before_request
+def swap_engine():
+    if engine.ensure_current():
+        feed_cache.clear()
+        search_cache.clear()
+        card_cache.clear()
+        search_index.loaded = False
+        ann_index.built = False
+        lsa_index.loaded = False
+
 # Remove session variables when logging out, it prevents someone from using a loophole to login without password through interests page
 @user_logged_out.connect
 def remove_session(*e, **extra):
@@ -51,16 +120,45 @@ def remove_session(*e, **extra):
 # ---------------------------------------------------------
 # Scheduling the arXiv scraper
 ARXIV_TIMEZONE = timezone.utc
+def update_indexes(new_ids, epoch):
+    """Adds the papers with [new_ids] (they have to be in the engine already) to the search index and to the index of the
+    recommender backend, and saves them. Needs an app context."""
+    search_index.update(new_ids, epoch)
+    if RECOMMENDER_BACKEND == "ann":
+        ann_index.update(new_ids)
+    if RECOMMENDER_BACKEND == "lsa":
+        lsa_index.update(new_ids, epoch)
+
 def download_papers():
     """Download all the papers released since yesterday."""
     with app.app_context():
         today = datetime.now(ARXIV_TIMEZONE)
         yesterday = today - timedelta(days=1)
         yesterday = yesterday.replace(hour=0, minute=0, second=0, microsecond=0)
+        # The scraping stack (scikit-learn, NLTK and PyMuPDF) is only loaded by the process that downloads the papers
+        from arxiv_scraper import get_papers
         get_papers(yesterday)
+        # The papers of a previous run that crashed before it published them are published with the new ones, they are
+        # marked only after everything was updated
+        new_ids = unpublished_paper_ids()
+        engine.refresh()
+        # The indexes are saved before the new papers are published, so the workers that swap to them load the new files
+        update_indexes(new_ids, engine.epoch)
+        if engine.path:
+            engine.publish(engine.epoch)
+        feed_cache.clear()
+        search_cache.clear()
+        card_cache.clear()
+        neighbour_table.update(new_ids, engine.epoch)
+        precompute_feeds(TIME_OPTIONS_DELTAS)
+        if digest_mailer.host:
+            digest_mailer.send(new_ids)
+        mark_published(new_ids)
+        db.session.commit()
 
 # This prevents scheduling the function twice in the debug mode. More info: https://stackoverflow.com/questions/14874782/apscheduler-in-flask-executes-twice
-if not app.debug and os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+# In the shared mode the papers are downloaded by the ingestion process only
+if not app.debug and os.environ.get('WERKZEUG_RUN_MAIN') == 'true' and SERVING_MODE != "shared":
     scheduler = BackgroundScheduler()
     # Download papers everyday at 00:30 AM in arxiv timezone (they work in 24 hour cycles)
     scheduler.add_job(download_papers, trigger="cron", hour=0, minute=30, timezone=ARXIV_TIMEZONE)
@@ -119,7 +217,7 @@ def sign_up():
             email = form.email.data,
             password = bcrypt.hashpw(form.password.data.encode('utf8'), bcrypt.gensalt()),
             auth=False,
-            vector=dict(),
+            vector=SparseVector(),
         )
         db.session.add(new_user)
         try:
@@ -148,19 +246,22 @@ def interests():
     if request.method == 'POST':
         at_least_one_toggled = False
         # Getting data from the form to the database
-        analyzer = vectorizer.build_analyzer()
-        vector = dict()
+        analyzer = get_analyzer()
+        tokens = []
         for chip in request.form:
             if chip != "interests_submit" and request.form[chip] == 'on':
                 at_least_one_toggled = True
-                tokens = analyzer(chip)
-                for token in tokens:
-                    vector[token] = 1
+                tokens += analyzer(chip)
         if not at_least_one_toggled:
             flash("You must select at least one field")
         else:
             user = db.session.get(User, session['email'])
-            user.vector = vector
+            # The interests may contain terms that aren't in any paper yet, so they are added to the Term table
+            term_ids = get_term_ids(tokens, create=True)
+            user.interests = SparseVector(sorted(term_ids.values()), [1] * len(term_ids))
+            user.vector = user.interests
+            user.profile_updated = datetime.now(timezone.utc).replace(tzinfo=None)
+            user.embedding = None
             try:
                 db.session.commit()
                 flash("Updated interests")
@@ -182,24 +283,165 @@ def display_date(date):
     return months[date.month-1] + " " + str(date.year)
 
 TIME_OPTIONS_TABLE = ["Day", "Week", "2 Weeks", "Month", "3 Months", "6 Months", "Year"]
+TIME_OPTIONS_DELTAS = [
+    timedelta(days=2), timedelta(weeks=1), timedelta(weeks=2), timedelta(weeks=4), timedelta(weeks=13), timedelta(weeks=26), 
+    timedelta(weeks=52)
+]
 PAGE_LENGTH = 20
+# Number of pages of search results ranked after the requested one
+SEARCH_MARGIN = 4
+
+def load_page(ids, relevances, page):
+    """Loads from the database only the papers that are displayed on the [page], in the order given by [ids]."""
+    page_ids = [int(id) for id in ids[(page-1)*PAGE_LENGTH:page*PAGE_LENGTH]] if page > 0 else []
+    page_relevances = [float(r) for r in relevances[(page-1)*PAGE_LENGTH:page*PAGE_LENGTH]] if page > 0 else []
+    papers = {p.id: p for p in Paper.query.filter(Paper.id.in_(page_ids)).options(db.defer(Paper.vector)).all()}
+    return [papers[id] for id in page_ids], page_relevances
+
+def load_date_page(since, page, after=None):
+    """Loads the papers updated since [since] that are displayed on the [page] when sorted by date (newest first), and their
+    relevance scores. If [after] is the id of the last paper of the previous page, the page is found with keyset pagination
+    on the (updated_date, id) index, otherwise with an offset."""
+    query = Paper.query.filter(Paper.updated_date >= since).order_by(Paper.updated_date.desc(), Paper.id.desc())
+    previous = db.session.get(Paper, after, options=[db.load_only(Paper.updated_date)]) if after is not None else None
+    if previous is not None:
+        query = query.filter(db.or_(
+            Paper.updated_date < previous.updated_date,
+            db.and_(Paper.updated_date == previous.updated_date, Paper.id < previous.id)
+        ))
+    elif page > 0:
+        query = query.offset((page-1)*PAGE_LENGTH)
+    else:
+        return [], []
+    # The vectors are scored by the engine, so they aren't loaded and deserialized by every worker
+    papers = query.options(db.defer(Paper.vector)).limit(PAGE_LENGTH).all()
+    engine.ensure_loaded()
+    with stage('scoring'):
+        rows = engine.rows([p.id for p in papers])
+        if RECOMMENDER_BACKEND == "lsa" and lsa_index.ensure_loaded(engine.epoch):
+            scores = lsa_index.score_rows(lsa_index.user_embedding(current_user), rows[rows >= 0])
+        else:
+            scores = engine.score_rows(current_user.vector, rows[rows >= 0])
+        found = iter(scores.tolist())
+        # The papers downloaded after the engine was refreshed are scored from their own vectors
+        relevances = [
+            next(found) if row >= 0 else cosine(current_user.vector, p.vector) if len(current_user.vector) and len(p.vector) else 0
+            for p, row in zip(papers, rows)
+        ]
+    return papers, relevances
+
+# Colors of the relevance indicator of the paper cards for the scores above the thresholds, from the most relevant
+RELEVANCE_COLORS = [(0.1, "#FF0D0D"), (0.05, "#FF4E11"), (0.02, "#FF8E15"), (0.01, "#FAB733"), (0.005, "#ACB334")]
+LOW_RELEVANCE_COLOR = "#69B34C"
+# Stands for the indicator color and the like state in the cached cards
+CARD_MARKER = "\x00"
+
+def render_cards(papers, relevances, liked_ids):
+    """Returns the html of the cards of the [papers]. Every card is rendered once and cached split around its relevance
+    indicator and like button, so a page only joins strings."""
+    template = app.jinja_env.get_template("paper_card.html")
+    cards = []
+    for paper, relevance in zip(papers, relevances):
+        color = next((color for threshold, color in RELEVANCE_COLORS if relevance > threshold), LOW_RELEVANCE_COLOR)
+        checked = "checked" if paper.id in liked_ids else ""
+        parts = card_cache.get(paper.id)
+        if parts is None:
+            parts = template.render(paper=paper, color=CARD_MARKER, checked=CARD_MARKER).split(CARD_MARKER)
+            if len(parts) != 3:
+                # The text of the paper has the marker, the card isn't cached
+                cards.append(template.render(paper=paper, color=color, checked=checked))
+                continue
+            card_cache.put(paper.id, parts)
+        cards.append(parts[0] + color + parts[1] + checked + parts[2])
+    return Markup("\n".join(cards))
+
+def page_validators(*versions):
+    """Returns the ETag and the Last-Modified time of the current user's page, or (None, None) if it can't be
+    revalidated. The page changes with the URL (the path and the query string), the papers (the version of the engine and
+    the other [versions]), the user and their profile, and every hour as the time periods of the feed move."""
+    # The flashed messages are shown only once
+    if session.get('_flashes'):
+        return None, None
+    engine.ensure_loaded()
+    hour = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    profile_updated = current_user.profile_updated.replace(tzinfo=timezone.utc) if current_user.profile_updated else hour
+    validator = "|".join(
+        str(part) for part in (request.full_path, engine.version, *versions, current_user.get_id(), profile_updated, hour)
+    )
+    etag = hashlib.blake2b(validator.encode("utf8"), digest_size=16).hexdigest()
+    return etag, max(engine.modified or hour, profile_updated, hour)
+
+def not_modified(validators):
+    """True if the browser already has the page with the [validators] (see page_validators())."""
+    etag, last_modified = validators
+    return etag is not None and not is_resource_modified(request.environ, etag=etag, last_modified=last_modified)
+
+def with_validators(response, validators):
+    """Sets the ETag and Last-Modified [validators] on the [response] of a page, the browser revalidates it every time."""
+    etag, last_modified = validators
+    if etag is not None:
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    return response
+
+def stored_feed(time_option, since, page):
+    """Returns the ids and scores of the current user's feed precomputed by the nightly job (without the papers that
+    left the time period since then), or None if it's out of date or too short for the [page]."""
+    feed = db.session.get(Feed, (current_user.email, time_option))
+    if feed is None or len(engine.ids) == 0 or feed.newest_paper != int(engine.ids.max()):
+        return None
+    # The profile changed while the nightly job was ranking the old one
+    if feed.profile_updated != current_user.profile_updated:
+        return None
+    ids, relevances = feed.ranking()
+    # The rows of the engine are sorted by date, so the time period is a lower bound on the row number
+    keep = engine.rows(ids) >= max(engine.window(since), 0)
+    ids, relevances = ids[keep], relevances[keep]
+    if page * PAGE_LENGTH > len(ids) and len(ids) < engine.count(since):
+        return None
+    return ids, relevances
+
 @app.route('/', methods=['GET', 'POST'])
 @login_required
 def home_page():
     if request.method == 'POST':
-        # The user liked an article
-        for name in request.json:
-            paper = db.session.get(Paper, int(name))
-            if request.json[name]:
-                current_user.liked_papers.append(paper)
-                current_user.vector = update_user_profile(current_user.vector, paper.vector, 0.95, 0.05, 0.02)
-            else:
-                current_user.liked_papers.remove(paper)
-                current_user.vector = update_user_profile(current_user.vector, paper.vector, 1/0.95, -0.05, 0)
-            try:
-                db.session.commit()
-            except:
-                db.session.rollback()
+        # The user liked or unliked articles, all of them are applied to the profile at once and committed together
+        likes = {int(name): bool(liked) for name, liked in request.json.items()}
+        vectors = dict(db.session.execute(db.select(Paper.id, Paper.vector).where(Paper.id.in_(likes))).all())
+        liked_ids = current_user.liked_paper_ids()
+        added, removed, updates = [], [], []
+        for paper_id, liked in likes.items():
+            vector = vectors.get(paper_id)
+            # Liking a paper twice (or unliking one that isn't liked) would count it twice in the profile
+            if vector is None or liked == (paper_id in liked_ids):
+                continue
+            (added if liked else removed).append(paper_id)
+            updates.append((vector, liked))
+        # The likes are written to the association table directly, so the liked papers are never loaded
+        if added:
+            db.session.execute(db.insert(table), [{'paper_id': paper_id, 'user_email': current_user.email} for paper_id in added])
+        if removed:
+            db.session.execute(db.delete(table).where(table.c.user_email == current_user.email, table.c.paper_id.in_(removed)))
+        # The vocabulary epoch of the papers comes from the engine
+        engine.ensure_loaded()
+        if RECOMMENDER_BACKEND == "lsa" and lsa_index.ensure_loaded(engine.epoch):
+            current_user.embedding = lsa_index.update_profile(current_user, updates).tobytes()
+            current_user.embedding_version = lsa_index.version
+        else:
+            # The embedding is projected from the updated sparse profile when it's used
+            current_user.embedding = None
+        current_user.vector = update_user_profile_batch(current_user.vector, updates)
+        current_user.profile_updated = datetime.now(timezone.utc).replace(tzinfo=None)
+        # The user's profile has changed, so their cached and precomputed rankings are outdated
+        db.session.execute(db.delete(Feed).where(Feed.user_email == current_user.email))
+        try:
+            db.session.commit()
+            current_user.liked_ids = liked_ids.union(added).difference(removed)
+        except:
+            db.session.rollback()
+        feed_cache.invalidate(lambda key: key[0] == current_user.email)
 
     # Getting the named parameters from the URL
     time_option = request.args.get("time", default=0, type=int)
@@ -207,37 +449,54 @@ def home_page():
     page        = request.args.get('page', default=1, type=int)
 
     # Filtering the results by time period
-    match time_option:
-        case 0:
-            papers = Paper.query.filter(Paper.updated_date >= datetime.now() - timedelta(days=2)).all()
-        case 1:
-            papers = Paper.query.filter(Paper.updated_date >= datetime.now() - timedelta(weeks=1)).all()
-        case 2:
-            papers = Paper.query.filter(Paper.updated_date >= datetime.now() - timedelta(weeks=2)).all()
-        case 3:
-            papers = Paper.query.filter(Paper.updated_date >= datetime.now() - timedelta(weeks=4)).all()
-        case 4:
-            papers = Paper.query.filter(Paper.updated_date >= datetime.now() - timedelta(weeks=13)).all()
-        case 5:
-            papers = Paper.query.filter(Paper.updated_date >= datetime.now() - timedelta(weeks=26)).all()
-        case 6:
-            papers = Paper.query.filter(Paper.updated_date >= datetime.now() - timedelta(weeks=52)).all()
-        case _:
-            flash("Wrong URL")
-            return redirect(url_for('home_page'))
-
-    # Assigning relevance scores to papers
-    papers = [[p, cosine(current_user.vector, p.vector)] for p in papers]
-    
-    # Sort the papers
+    if time_option not in range(len(TIME_OPTIONS_DELTAS)):
+        flash("Wrong URL")
+        return redirect(url_for('home_page'))
+    since = datetime.now() - TIME_OPTIONS_DELTAS[time_option]
+    if sort_option not in ("Relevance", "Date"):
+        flash("Wrong URL")
+        return redirect(url_for('home_page'))
+
+    # A browser that has the page already gets 304 before anything is ranked
+    validators = page_validators() if request.method == 'GET' else (None, None)
+    if not_modified(validators):
+        return with_validators(make_response("", 304), validators)
+
     match sort_option:
         case "Relevance":
-            papers.sort(key=lambda x: x[1], reverse=True)
+            # Assigning relevance scores to papers and sorting them. The whole ranking is cached, so the next pages are
+            # served without scoring the papers again. The first pages are usually precomputed by the nightly job. The cache
+            # of every worker process is its own, the time of the last profile change in the key keeps the workers that
+            # didn't handle a like from serving the old ranking
+            key = (current_user.email, current_user.profile_updated, time_option, sort_option)
+            cached = feed_cache.get(key)
+            engine.ensure_loaded()
+            # The precomputed feeds are ranked by the exact cosine
+            stored = stored_feed(time_option, since, page) if cached is None and RECOMMENDER_BACKEND != "lsa" else None
+            if cached is not None:
+                ids, relevances, _ = cached
+            elif stored is not None:
+                # The precomputed feed only has the best papers, the number of pages comes from the whole time period
+                ids, relevances = stored
+            else:
+                if RECOMMENDER_BACKEND == "ann" and ann_index.ensure_built():
+                    ids, relevances = ann_index.top_k(current_user.vector, engine.count(since), since)
+                elif RECOMMENDER_BACKEND == "lsa" and lsa_index.ensure_loaded(engine.epoch):
+                    ids, relevances = lsa_index.top_k(lsa_index.user_embedding(current_user), engine.count(since), since)
+                else:
+                    ids, relevances = engine.top_k(current_user.vector, engine.count(since), since)
+                feed_cache.put(key, ids, relevances)
+            number_of_pages = ceil((engine.count(since) if stored is not None else len(ids)) / PAGE_LENGTH)
+            papers, relevances = load_page(ids, relevances, page)
+            next_cursor = None
         case "Date":
-            papers.sort(key=lambda x: x[0].updated_date, reverse=True)
-        case _:
-            flash("Wrong URL")
-            return redirect(url_for('home_page'))
+            # The papers are sorted by the database, only the displayed ones are scored
+            number_of_results = db.session.execute(
+                db.select(db.func.count()).select_from(Paper).where(Paper.updated_date >= since)
+            ).scalar()
+            number_of_pages = ceil(number_of_results / PAGE_LENGTH)
+            papers, relevances = load_date_page(since, page, request.args.get('after', type=int))
+            next_cursor = papers[-1].id if papers else None
 
     # Assigning correct page numbers
     page_number_1 = page - 1
@@ -247,26 +506,41 @@ def home_page():
         page_number_1 = page
         page_number_2 = page + 1
         page_number_3 = page + 2
-    if page == ceil(len(papers) / PAGE_LENGTH):
+    if page == number_of_pages:
         page_number_1 = page - 2
         page_number_2 = page - 1
         page_number_3 = page
         
-    return render_template(
-        "index.html",
-        current_page=page,
-        page_number_1=page_number_1,
-        page_number_2=page_number_2,
-        page_number_3=page_number_3,
-        number_of_pages=ceil(len(papers) / PAGE_LENGTH),
-        papers=[x[0] for x in papers][(page-1)*PAGE_LENGTH:page*PAGE_LENGTH],
-        relevances=[x[1] for x in papers][(page-1)*PAGE_LENGTH:page*PAGE_LENGTH],
-        time_options=TIME_OPTIONS_TABLE,
-        time=time_option,
-        sort=sort_option,
-        # Passing the zip function, bacause the jinja engine doesn't import it by default
-        zip=zip
-    )
+    with stage('render'):
+        response = make_response(render_template(
+            "index.html",
+            current_page=page,
+            page_number_1=page_number_1,
+            page_number_2=page_number_2,
+            page_number_3=page_number_3,
+            number_of_pages=number_of_pages,
+            cards=render_cards(papers, relevances, current_user.liked_paper_ids()),
+            papers=papers,
+            time_options=TIME_OPTIONS_TABLE,
+            time=time_option,
+            sort=sort_option,
+            next_cursor=next_cursor
+        ))
+    return with_validators(response, validators)
+
+def normalize_query(query):
+    """Queries that only differ in the case and the whitespace have the same terms, so they share the cached results."""
+    return " ".join(query.lower().split())
+
+QUERY_VECTOR_CACHE_SIZE = 4096
+
+@lru_cache(maxsize=QUERY_VECTOR_CACHE_SIZE)
+def query_vector(query, version):
+    """Returns the SparseVector of a normalized [query]. New terms come only with new papers, so the vectors are memoized
+    for the [version] of the search index."""
+    counts = Counter(get_analyzer()(query))
+    # Terms that aren't in the Term table can't match any paper, so they are dropped
+    return SparseVector.from_dict(counts, get_term_ids(counts))
 
 @app.route('/search', methods=['GET'])
 @login_required
@@ -274,35 +548,42 @@ def search():
     # Getting the named parameters from the URL
     sort_option = request.args.get("sort", default="Relevance", type=str)
     page        = request.args.get('page', default=1, type=int)
-    query       = request.args.get('query', type=str)
+    query       = request.args.get('query', default="", type=str)
 
-    if len(query) == 0:
+    if len(normalize_query(query)) == 0:
         flash("Wrong query")
         return redirect(url_for('home_page'))
+    if sort_option not in ("Relevance", "Date"):
+        flash("Wrong URL")
+        return redirect(url_for('home_page'))
 
-    analyzer = vectorizer.build_analyzer()
-    query_vector = analyzer(query)
-    vector = {}
-    for token in query_vector:
-        if token in vector:
-            vector[token] += 1
-        else:
-            vector[token] = 1
-
-    papers = Paper.query.all()
-
-    # Assigning relevance scores to papers
-    papers = [[p, cosine(vector, p.vector)] for p in papers]
-    
-    # Sort the papers
-    match sort_option:
-        case "Relevance":
-            papers.sort(key=lambda x: x[1], reverse=True)
-        case "Date":
-            papers.sort(key=lambda x: x[0].updated_date, reverse=True)
-        case _:
-            flash("Wrong URL")
-            return redirect(url_for('home_page'))
+    # The ranking is cached for the version of the search index, so the next pages and the same query from other users are
+    # served without scoring the papers again. Only the papers up to SEARCH_MARGIN pages after the requested one are
+    # sorted, a page past them ranks the papers again. Adding papers changes the version
+    engine.ensure_loaded()
+    search_index.ensure_loaded(engine.epoch)
+    validators = page_validators(search_index.version)
+    if not_modified(validators):
+        return with_validators(make_response("", 304), validators)
+    start = time.perf_counter()
+    key = (normalize_query(query), sort_option, search_index.version)
+    cached = search_cache.get(key)
+    if cached is not None and len(cached[0]) < min(page * PAGE_LENGTH, cached[2]):
+        cached = None
+    if cached is not None:
+        ids, relevances, total = cached
+    else:
+        vector = query_vector(key[0], key[2])
+        depth = (max(page, 1) + SEARCH_MARGIN) * PAGE_LENGTH
+        match sort_option:
+            case "Relevance":
+                ids, relevances, total = search_index.ranking(vector, depth)
+            case "Date":
+                ids, relevances, total = search_index.newest(vector, depth)
+        search_cache.put(key, ids, relevances, total)
+    search_seconds.observe(time.perf_counter() - start, cache='hit' if cached is not None else 'miss')
+    number_of_pages = ceil(total / PAGE_LENGTH)
+    papers, relevances = load_page(ids, relevances, page)
 
     # Assigning correct page numbers
     page_number_1 = page - 1
@@ -312,27 +593,55 @@ def search():
         page_number_1 = page
         page_number_2 = page + 1
         page_number_3 = page + 2
-    if page == ceil(len(papers) / PAGE_LENGTH):
+    if page == number_of_pages:
         page_number_1 = page - 2
         page_number_2 = page - 1
         page_number_3 = page
         
+    with stage('render'):
+        response = make_response(render_template(
+            "search.html",
+            query=query,
+            current_page=page,
+            page_number_1=page_number_1,
+            page_number_2=page_number_2,
+            page_number_3=page_number_3,
+            number_of_pages=number_of_pages,
+            cards=render_cards(papers, relevances, current_user.liked_paper_ids()),
+            papers=papers,
+            time_options=TIME_OPTIONS_TABLE,
+            sort=sort_option
+        ))
+    return with_validators(response, validators)
+
+@app.route('/similar/<int:paper_id>', methods=['GET'])
+@login_required
+def similar(paper_id):
+    paper = db.session.get(Paper, paper_id, options=[db.defer(Paper.vector)])
+    if paper is None:
+        flash("Wrong URL")
+        return redirect(url_for('home_page'))
+
+    # The list was precomputed when the papers were downloaded (or on the first visit), so the page is one row of the table
+    # and one page of papers
+    engine.ensure_loaded()
+    neighbours = neighbour_table.lookup(paper_id, engine.epoch)
+    ids, relevances = neighbours if neighbours is not None else ([], [])
+    papers, relevances = load_page(ids, relevances, 1)
+
     return render_template(
-        "search.html",
-        query=query,
-        current_page=page,
-        page_number_1=page_number_1,
-        page_number_2=page_number_2,
-        page_number_3=page_number_3,
-        number_of_pages=ceil(len(papers) / PAGE_LENGTH),
-        papers=[x[0] for x in papers][(page-1)*PAGE_LENGTH:page*PAGE_LENGTH],
-        relevances=[x[1] for x in papers][(page-1)*PAGE_LENGTH:page*PAGE_LENGTH],
-        time_options=TIME_OPTIONS_TABLE,
-        sort=sort_option,
-        # Passing the zip function, bacause the jinja engine doesn't import it by default
-        zip=zip
+        "similar.html",
+        source=paper,
+        cards=render_cards(papers, relevances, current_user.liked_paper_ids()),
+        papers=papers,
+        time_options=TIME_OPTIONS_TABLE
     )
 
+@app.route('/cache-stats')
+@login_required
+def cache_stats():
+    return {'feed': feed_cache.stats(), 'search': search_cache.stats(), 'cards': card_cache.stats()}
+
 @app.route('/logout')
 @login_required
 def logout():
@@ -350,6 +659,21 @@ def logout_interests():
     flash("Logged out successfully")
     return redirect(url_for("login"))
 
+# The link at the bottom of every digest, it works without logging in
+@app.route('/unsubscribe/<token>')
+def unsubscribe(token):
+    email = digest_mailer.unsubscribe_email(token)
+    user = db.session.get(User, email) if email else None
+    if not user:
+        flash("The unsubscribe link is invalid")
+    else:
+        if user.digest_unsubscribed is None:
+            user.digest_unsubscribed = datetime.now(timezone.utc).replace(tzinfo=None)
+            db.session.commit()
+            logging.info(f"User with email: {user.email} unsubscribed from the digest")
+        flash("You won't get the email digest anymore")
+    return redirect(url_for("login"))
+
 @app.route('/about')
 def about():
     if current_user.is_authenticated:
@@ -0,0 +1,219 @@
+"""Instrumentation of the web app and the scraper. Counters and histograms are kept in memory and served in the Prometheus
+text format by the /metrics endpoint. The time of every request is split into stages (database queries, vector
+deserialization, scoring, sorting and template rendering), which are also sent in the Server-Timing header. A sampling
+profiler can be switched on for a single request by adding ?_profile=1 to its URL, the response is then replaced by the
+sampled stacks in the collapsed format of flamegraph.pl."""
+from flask import Response, g, has_request_context, request
+from sqlalchemy.engine import Engine
+from sqlalchemy import event
+from contextlib import contextmanager
+from collections import Counter as StackCounter
+import threading
+import time
+import sys
+import os
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# /metrics and the profiler only answer requests from these addresses. Behind a reverse proxy on the same host every
+# request comes from 127.0.0.1, so the proxy has to block them
+LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+PROFILER_INTERVAL = 0.001
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in values)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
+
+class Counter:
+    """A counter for every combination of the values of the [labels]."""
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(self.labels, key)} {value}")
+        return lines
+
+class Histogram:
+    """Counts the observed values in BUCKETS for every combination of the values of the [labels]."""
+
+    def __init__(self, name, description, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # Label values -> [counts of the buckets (not cumulative, the last one is +Inf), sum]
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        bucket = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        with self.lock:
+            counts = self.values.setdefault(key, [[0] * (len(self.buckets) + 1), 0.0])
+            counts[0][bucket] += 1
+            counts[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        names = self.labels + ('le',)
+        with self.lock:
+            for key, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{format_labels(names, key + (bound,))} {cumulative}")
+                lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {total}")
+                lines.append(f"{self.name}_count{format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+http_requests = Counter('http_requests_total', "HTTP requests by endpoint and status code", ('endpoint', 'status'))
+request_seconds = Histogram('http_request_duration_seconds', "Duration of the HTTP requests", ('endpoint',))
+request_stage_seconds = Histogram(
+    'http_request_stage_seconds', "Time spent in each stage of a request (summed over the request)", ('endpoint', 'stage')
+)
+db_queries = Counter('db_queries_total', "Database queries by the endpoint that made them", ('endpoint',))
+search_seconds = Histogram(
+    'search_duration_seconds', "Time to get the ranked results of a search, by the outcome of the search cache", ('cache',)
+)
+scraper_stage_seconds = Histogram(
+    'scraper_stage_seconds', "Time of one item (a listing page, a pdf or a batch of papers) in each stage of the scraper",
+    ('stage',)
+)
+scraper_failures = Counter('scraper_failures_total', "Items that failed in each stage of the scraper", ('stage',))
+digest_deliveries = Counter(
+    'digest_deliveries_total', "Delivery attempts of the email digests by their outcome (sent, retried or failed)", ('status',)
+)
+METRICS = [
+    http_requests, request_seconds, request_stage_seconds, db_queries, search_seconds, scraper_stage_seconds, scraper_failures,
+    digest_deliveries
+]
+
+def add_stage_time(name, seconds):
+    """Adds [seconds] to the [name] stage of the current request. Outside of a request it does nothing."""
+    if has_request_context():
+        stages = g.setdefault('stages', {})
+        stages[name] = stages.get(name, 0.0) + seconds
+
+@contextmanager
+def stage(name):
+    """Times the block as the [name] stage of the current request."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_stage_time(name, time.perf_counter() - start)
+
+# Every query of every engine is timed, the queries made outside of a request (e.g. by the scraper) aren't recorded
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    context.query_start = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    add_stage_time('db', time.perf_counter() - context.query_start)
+    if has_request_context():
+        g.queries = g.get('queries', 0) + 1
+
+class SamplingProfiler:
+    """Samples the stack of one thread every [interval] seconds from a background thread, and counts the stacks."""
+
+    def __init__(self, thread_id, interval=PROFILER_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = StackCounter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def sample(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def collapsed(self):
+        """Returns the stacks in the collapsed format: one 'frame;frame;frame count' line per stack."""
+        return '\n'.join(f"{stack} {count}" for stack, count in self.stacks.most_common()) + '\n'
+
+def is_local():
+    return request.remote_addr in LOCAL_ADDRESSES
+
+def init_app(app):
+    """Times the requests of the [app] and adds the /metrics endpoint."""
+
+    @app.before_request
+    def start_request():
+        g.request_start = time.perf_counter()
+        if request.args.get('_profile') == '1' and is_local():
+            g.profiler = SamplingProfiler(threading.get_ident())
+            g.profiler.start()
+
+    @app.after_request
+    def finish_request(response):
+        if 'request_start' not in g:
+            return response
+        endpoint = request.endpoint or 'unknown'
+        elapsed = time.perf_counter() - g.request_start
+        stages = g.get('stages', {})
+        http_requests.inc(endpoint=endpoint, status=response.status_code)
+        request_seconds.observe(elapsed, endpoint=endpoint)
+        for name, seconds in stages.items():
+            request_stage_seconds.observe(seconds, endpoint=endpoint, stage=name)
+        db_queries.inc(g.get('queries', 0), endpoint=endpoint)
+        response.headers['Server-Timing'] = ', '.join(
+            [f"{name};dur={seconds * 1000:.2f}" for name, seconds in stages.items()] + [f"total;dur={elapsed * 1000:.2f}"]
+        )
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            profiler.stop()
+            return Response(profiler.collapsed(), mimetype='text/plain')
+        return response
+
+    @app.teardown_request
+    def stop_profiler(exception):
+        # The response of a request that failed isn't replaced, but the sampling thread still has to stop
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            profiler.stop()
+
+    @app.route('/metrics')
+    def metrics():
+        if not is_local():
+            return Response(status=404)
+        lines = []
+        for metric in METRICS:
+            lines.extend(metric.render())
+        return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
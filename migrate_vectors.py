@@ -0,0 +1,52 @@
+"""Convert the pickled paper and user vectors (term -> weight dicts) to the binary SparseVector format.
+Run it once after updating from a version that stored the vectors with PickleType. The Term table is created if needed.
+If the vocabulary has no documents yet, its document frequencies are seeded from the stored paper vectors, so the idf of
+the next downloads counts the papers that are already in the database."""
+from main import app
+from database import db, Paper, User, Term, get_term_ids
+from vocabulary import vocabulary
+from vectors import SparseVector
+import pickle
+
+def migrate(model, key):
+    # Reading the raw bytes, the VectorType would try to decode the pickled data
+    rows = db.session.execute(db.select(key, db.type_coerce(model.vector, db.LargeBinary))).all()
+    converted = 0
+    for row_key, blob in rows:
+        # The vectors that are already binary are skipped
+        try:
+            vector = pickle.loads(blob)
+        except Exception:
+            continue
+        if not isinstance(vector, dict):
+            continue
+        vector = SparseVector.from_dict(vector, get_term_ids(vector, create=True))
+        db.session.execute(db.update(model).where(key == row_key).values(vector=vector))
+        converted += 1
+    db.session.commit()
+    print(f"Converted {converted} of {len(rows)} rows in the {model.__tablename__} table")
+
+def seed_vocabulary():
+    """Counts the document frequencies of the terms in the stored paper vectors. The vectors only keep the
+    MAX_VECTOR_LENGTH highest weights and drop the terms pruned by MAX_DF, so it's a lower bound of the real counts. The
+    stored vectors are taken as weighted with the resulting idf."""
+    vocabulary.ensure_loaded()
+    if vocabulary.n_documents > 0:
+        print(f"The vocabulary already has {vocabulary.n_documents} documents, it isn't seeded")
+        return
+    vocabulary.add_terms(dict(db.session.execute(db.select(Term.term, Term.id)).all()))
+    n_documents = 0
+    for vector in db.session.execute(db.select(Paper.vector)).scalars():
+        inside = vector.ids[vector.ids < len(vocabulary.df)]
+        vocabulary.df[inside] += 1
+        n_documents += 1
+    vocabulary.n_documents = n_documents
+    vocabulary.weighted_idf = vocabulary.idf()
+    vocabulary.save()
+    print(f"Seeded the vocabulary with {n_documents} papers and {int((vocabulary.df > 0).sum())} terms")
+
+with app.app_context():
+    db.create_all()
+    migrate(Paper, Paper.id)
+    migrate(User, User.email)
+    seed_vocabulary()
@@ -0,0 +1,180 @@
+"""Precomputed table of the most similar papers of every paper, shown on the /similar page. The cosine scores are computed
+in blocks: one sparse product of the whole paper matrix with the vectors of a block of papers, and the best papers of every
+row are picked from the nonzero scores of the product without making it dense. After a download only the new papers are
+scored, the lists of the old papers that a new paper enters are merged and the lists that had an old version of an updated
+paper are scored again. A page reads a single row of the NeighbourList table, a paper without a list gets it on the first
+lookup."""
+from database import db, NeighbourList
+from sqlalchemy.exc import IntegrityError
+from ranking import engine
+import numpy as np
+import logging
+import time
+
+# Length of the lists, one page of the /similar page
+NEIGHBOURS = 20
+# Number of papers scored by one matrix product
+BLOCK = 256
+
+def best_rows(rows, scores, k):
+    """Returns the [k] rows with the best positive [scores] (the scores of the [rows]) and their scores, sorted by the
+    score. Ties are broken by the row order."""
+    positive = np.flatnonzero(scores > 0)
+    if k < len(positive):
+        positive = positive[np.argpartition(-scores[positive], k)[:k]]
+    best = positive[np.lexsort((rows[positive], -scores[positive]))]
+    return rows[best], scores[best]
+
+def scan(matrix, norms, rows, k=NEIGHBOURS, thresholds=None, block=BLOCK):
+    """Scores the papers in [rows] (rows of [matrix]) against all the papers, [block] rows at a time. Yields for every block
+    the (row, neighbour rows, scores) lists of its rows, and if [thresholds] (the threshold of the list of every row) is
+    given, the (old rows, rows, scores) pairs where a paper of the block enters the list of a paper that isn't in [rows]."""
+    rows = np.asarray(rows, dtype=np.int64)
+    outside = np.ones(matrix.shape[0], dtype=bool)
+    outside[rows] = False
+    for first in range(0, len(rows), block):
+        block_rows = rows[first:first+block]
+        # A block x papers CSR matrix, the papers that share no term with a row of the block have no entry
+        products = (matrix @ matrix[block_rows].T).T.tocsr()
+        owners = np.repeat(np.arange(len(block_rows)), np.diff(products.indptr))
+        columns = products.indices.astype(np.int64)
+        denominator = (norms[columns] * norms[block_rows][owners]).astype(np.float32)
+        scores = np.divide(
+            products.data, denominator, out=np.zeros(denominator.shape, dtype=np.float32), where=denominator > 0
+        )
+        # A paper isn't its own neighbour
+        scores[columns == block_rows[owners]] = 0
+
+        lists = []
+        for i, row in enumerate(block_rows):
+            start, end = products.indptr[i], products.indptr[i+1]
+            lists.append((row, *best_rows(columns[start:end], scores[start:end], k)))
+        pairs = None
+        if thresholds is not None:
+            entered = (scores > thresholds[columns]) & outside[columns]
+            pairs = (columns[entered], block_rows[owners[entered]], scores[entered])
+        yield lists, pairs
+
+class NeighbourTable:
+    """Keeps the NeighbourList table in sync with the papers of the ranking engine."""
+
+    def __init__(self, k=NEIGHBOURS, block=BLOCK):
+        self.k = k
+        self.block = block
+
+    def lookup(self, paper_id, epoch):
+        """Returns the ids and scores of the most similar papers of the paper, or None if it isn't in the ranking engine. A
+        paper without a list (the table wasn't built yet or the paper is newer than it) gets it scored and stored. Needs an
+        app context."""
+        neighbours = db.session.get(NeighbourList, paper_id)
+        if neighbours is not None:
+            return neighbours.ranking()
+        engine.ensure_loaded()
+        with engine.lock:
+            matrix, norms, ids = engine.matrix, engine.norms, engine.ids
+        rows = engine.rows([paper_id])
+        if rows[0] < 0:
+            return None
+        lists, _ = next(scan(matrix, norms, rows, self.k, block=1))
+        _, best, scores = lists[0]
+        db.session.add(NeighbourList(**self.values(paper_id, ids[best], scores, epoch)))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Another worker stored it first
+            db.session.rollback()
+        return ids[best], scores
+
+    def values(self, paper_id, papers, scores, epoch):
+        threshold = float(scores[-1]) if len(scores) == self.k else 0.0
+        return {
+            'paper_id': paper_id, 'papers': papers.astype(np.int64).tobytes(), 'scores': scores.astype(np.float32).tobytes(),
+            'threshold': threshold, 'epoch': epoch
+        }
+
+    def update(self, new_ids, epoch):
+        """Adds the lists of the papers with [new_ids] (new papers, or new versions of old ones) and of the papers that have
+        no list yet, and merges the new papers into the lists of the old ones. The lists that have one of [new_ids] are
+        scored again, the new version of a paper can fall below the rest of the list. The whole table is rebuilt if the
+        papers were re-weighted since the last update. Needs an app context and a loaded ranking engine."""
+        engine.ensure_loaded()
+        with engine.lock:
+            matrix, norms, ids = engine.matrix, engine.norms, engine.ids
+        start = time.perf_counter()
+
+        stored_epoch = db.session.execute(db.select(NeighbourList.epoch).limit(1)).scalar()
+        if stored_epoch is not None and stored_epoch != epoch:
+            db.session.execute(db.delete(NeighbourList))
+            db.session.commit()
+        stored = db.session.execute(db.select(NeighbourList.paper_id, NeighbourList.threshold)).all()
+        stored_rows = engine.rows([paper_id for paper_id, _ in stored])
+        valid = stored_rows >= 0
+        has_list = np.zeros(len(ids), dtype=bool)
+        has_list[stored_rows[valid]] = True
+        thresholds = np.zeros(len(ids), dtype=np.float32)
+        thresholds[stored_rows[valid]] = np.array([threshold for _, threshold in stored], dtype=np.float32)[valid]
+
+        new_rows = engine.rows(new_ids)
+        new_rows = new_rows[new_rows >= 0]
+        # Only the papers that had a list can be in the lists of others, i.e. the updated ones
+        updated_ids = ids[new_rows[has_list[new_rows]]]
+        containing = []
+        if len(updated_ids):
+            for paper_id, papers in db.session.execute(
+                db.select(NeighbourList.paper_id, NeighbourList.papers).execution_options(yield_per=5000)
+            ):
+                if np.isin(np.frombuffer(papers, dtype=np.int64), updated_ids).any():
+                    containing.append(paper_id)
+        containing_rows = engine.rows(containing)
+        rows = np.union1d(np.union1d(new_rows, np.flatnonzero(~has_list)), containing_rows[containing_rows >= 0])
+        if len(rows) == 0:
+            return
+
+        pairs = []
+        is_new = np.zeros(len(ids), dtype=bool)
+        is_new[new_rows] = True
+        for lists, block_pairs in scan(matrix, norms, rows, self.k, thresholds, self.block):
+            block_ids = [int(ids[row]) for row, _, _ in lists]
+            db.session.execute(db.delete(NeighbourList).where(NeighbourList.paper_id.in_(block_ids)))
+            db.session.execute(db.insert(NeighbourList), [
+                self.values(int(ids[row]), ids[best], scores, epoch) for row, best, scores in lists
+            ])
+            db.session.commit()
+            # The other papers that are scored again didn't change, they are already in the lists they belong to
+            entered = is_new[block_pairs[1]]
+            pairs.append(tuple(array[entered] for array in block_pairs))
+
+        # Merging the new papers into the lists they enter, the old entries of the new papers are dropped first
+        old = np.concatenate([p[0] for p in pairs])
+        new = np.concatenate([p[1] for p in pairs])
+        scores = np.concatenate([p[2] for p in pairs])
+        order = np.argsort(old, kind='stable')
+        old, new, scores = old[order], new[order], scores[order]
+        affected, starts = np.unique(old, return_index=True)
+        ends = np.append(starts[1:], len(old))
+        new_paper_ids = ids[new_rows]
+        for first in range(0, len(affected), 500):
+            chunk = range(first, min(first + 500, len(affected)))
+            lists = {
+                neighbours.paper_id: neighbours for neighbours in db.session.execute(
+                    db.select(NeighbourList).where(NeighbourList.paper_id.in_([int(ids[affected[i]]) for i in chunk]))
+                ).scalars()
+            }
+            values = []
+            for i in chunk:
+                paper_id = int(ids[affected[i]])
+                papers, paper_scores = lists[paper_id].ranking()
+                keep = ~np.isin(papers, new_paper_ids)
+                neighbour_rows = np.concatenate([engine.rows(papers[keep]), new[starts[i]:ends[i]]])
+                neighbour_scores = np.concatenate([paper_scores[keep], scores[starts[i]:ends[i]]])
+                best = np.lexsort((neighbour_rows, -neighbour_scores))[:self.k]
+                values.append(self.values(paper_id, ids[neighbour_rows[best]], neighbour_scores[best], epoch))
+            db.session.execute(db.update(NeighbourList), values)
+            db.session.commit()
+        logging.info(
+            f"Neighbour lists of {len(rows)} papers computed ({len(containing)} had an updated paper) and {len(affected)} "
+            f"lists updated in "
+            f"{time.perf_counter() - start:.1f}s"
+        )
+
+neighbour_table = NeighbourTable()
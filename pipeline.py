@@ -0,0 +1,190 @@
+"""Concurrent PDF download and text extraction pipeline used by the arXiv scraper.
+The PDFs are downloaded by a pool of threads sharing one HTTP session, and converted to text and tokenized
+in a pool of processes. The number of PDFs waiting in each stage is bounded, so a slow stage stops the other one."""
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
+from metrics import scraper_stage_seconds, scraper_failures
+import threading
+import requests
+import fitz
+import logging
+import time
+import os
+
+FETCH_WORKERS = 4
+EXTRACT_WORKERS = os.cpu_count() or 1
+# Maximum number of PDFs waiting in each stage
+MAX_PENDING_FETCHES = 8
+MAX_PENDING_EXTRACTIONS = 2 * EXTRACT_WORKERS
+# Minimum number of seconds between two requests to the same host
+HOST_INTERVAL = 1.0
+RETRIES = 1
+
+class RateLimiter:
+    """Makes sure that requests to the same host are at least [interval] seconds apart."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.next_slot = {}
+
+    def wait(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+class StageStats:
+    """Counts the items, bytes and busy time of one stage of the pipeline."""
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.items = 0
+        self.failures = 0
+        self.bytes = 0
+        self.busy = 0.0
+
+    def record(self, seconds, size=0, failed=False):
+        with self.lock:
+            self.busy += seconds
+            if failed:
+                self.failures += 1
+            else:
+                self.items += 1
+                self.bytes += size
+
+    def report(self, wall_time):
+        return (
+            f"{self.name}: {self.items} done, {self.failures} failed, {self.items / wall_time if wall_time else 0:.2f} items/s, "
+            f"{self.bytes / 2**20 / wall_time if wall_time else 0:.2f} MiB/s, {self.busy:.1f}s busy"
+        )
+
+# The analyzer of the extraction worker processes, set by init_extractor
+worker_analyzer = None
+
+def init_extractor(vectorizer):
+    global worker_analyzer
+    worker_analyzer = vectorizer.build_analyzer()
+
+def extract(content):
+    """Converts the pdf to text and tokenizes it. Runs in a worker process, returns the text, the tokens and the seconds
+    spent on the extraction and on the normalization."""
+    start = time.perf_counter()
+    with fitz.open("pdf", content) as document:
+        text = chr(12).join([page.get_text() for page in document])
+    extracted = time.perf_counter()
+    return text, worker_analyzer(text), extracted - start, time.perf_counter() - extracted
+
+def analyze(text):
+    """Tokenizes a text that was already extracted. Runs in a worker process."""
+    start = time.perf_counter()
+    return text, worker_analyzer(text), 0.0, time.perf_counter() - start
+
+class Pipeline:
+    """Downloads and converts the pdfs of the articles. Use run() to stream the results."""
+
+    def __init__(self, vectorizer, fetch_workers=FETCH_WORKERS, extract_workers=EXTRACT_WORKERS, host_interval=HOST_INTERVAL):
+        self.vectorizer = vectorizer
+        self.fetch_workers = fetch_workers
+        self.extract_workers = extract_workers
+        self.rate_limiter = RateLimiter(host_interval)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=fetch_workers, pool_maxsize=fetch_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.fetch_stats = StageStats("PDF download")
+        self.extract_stats = StageStats("Text extraction")
+        # Number of articles whose text was already extracted by an earlier run
+        self.cached = 0
+
+    def fetch(self, link):
+        """Downloads the pdf, returns its content or None if it couldn't be downloaded."""
+        for attempt in range(RETRIES + 1):
+            if attempt > 0:
+                logging.error("There was a problem with downloading the pdf, trying again...")
+            self.rate_limiter.wait(link)
+            start = time.perf_counter()
+            try:
+                response = self.session.get(link)
+                logging.info(f"Attempted to download the pdf, status code: {response.status_code}")
+            except Exception:
+                self.fetch_stats.record(time.perf_counter() - start, failed=True)
+                scraper_failures.inc(stage='download')
+                continue
+            scraper_stage_seconds.observe(time.perf_counter() - start, stage='download')
+            if response.status_code == 200:
+                self.fetch_stats.record(time.perf_counter() - start, len(response.content))
+                return response.content
+            self.fetch_stats.record(time.perf_counter() - start, failed=True)
+            scraper_failures.inc(stage='download')
+        logging.error(f"Couldn't download the pdf from this link: {link}")
+        return None
+
+    def run(self, articles, progress=None, cached_text=None):
+        """Takes an iterable of article dicts (with a 'pdf_link' key) and yields (article, text, tokens) tuples
+        in the order in which they are finished. Articles that couldn't be downloaded or converted are skipped.
+        [progress] is called with (article, 'fetched', pdf content) when the pdf is downloaded and with
+        (article, 'failed', None) when it's skipped, from the thread that iterates over the results.
+        [cached_text] takes an article and returns its text if it was extracted before, then the pdf isn't downloaded."""
+        start = time.perf_counter()
+        articles = iter(articles)
+        exhausted = False
+        pending_fetches = {}
+        pending_extractions = {}
+        with ThreadPoolExecutor(self.fetch_workers) as fetch_pool, \
+             ProcessPoolExecutor(self.extract_workers, initializer=init_extractor, initargs=(self.vectorizer,)) as extract_pool:
+            while True:
+                # New downloads are started only if both stages have room for them (backpressure)
+                while not exhausted and len(pending_fetches) < MAX_PENDING_FETCHES \
+                        and len(pending_fetches) + len(pending_extractions) < MAX_PENDING_FETCHES + MAX_PENDING_EXTRACTIONS:
+                    article = next(articles, None)
+                    if article is None:
+                        exhausted = True
+                        break
+                    text = cached_text(article) if cached_text is not None else None
+                    if text is not None:
+                        self.cached += 1
+                        pending_extractions[extract_pool.submit(analyze, text)] = article
+                        continue
+                    pending_fetches[fetch_pool.submit(self.fetch, article['pdf_link'])] = article
+                if not pending_fetches and not pending_extractions:
+                    break
+
+                done, _ = wait(list(pending_fetches) + list(pending_extractions), return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in pending_fetches:
+                        article = pending_fetches.pop(future)
+                        content = future.result()
+                        if content is not None:
+                            pending_extractions[extract_pool.submit(extract, content)] = article
+                        if progress is not None:
+                            progress(article, 'fetched' if content is not None else 'failed', content)
+                        continue
+                    article = pending_extractions.pop(future)
+                    try:
+                        text, tokens, extraction_seconds, normalization_seconds = future.result()
+                    except Exception:
+                        logging.error(f"Couldn't convert the pdf from this link: {article['pdf_link']}")
+                        self.extract_stats.record(0, failed=True)
+                        scraper_failures.inc(stage='extraction')
+                        if progress is not None:
+                            progress(article, 'failed', None)
+                        continue
+                    self.extract_stats.record(extraction_seconds + normalization_seconds, len(text))
+                    # The texts from the store are only normalized
+                    if extraction_seconds:
+                        scraper_stage_seconds.observe(extraction_seconds, stage='extraction')
+                    scraper_stage_seconds.observe(normalization_seconds, stage='normalization')
+                    logging.info(f"Succesfully converted the pdf from this link: {article['pdf_link']}")
+                    yield article, text, tokens
+
+        wall_time = time.perf_counter() - start
+        logging.info(f"Pipeline finished in {wall_time:.1f}s")
+        logging.info(self.fetch_stats.report(wall_time))
+        logging.info(self.extract_stats.report(wall_time))
+        logging.info(f"Texts from the store: {self.cached}")
@@ -0,0 +1,237 @@
+"""In-memory ranking engine. All the paper vectors are kept in a single CSR matrix, so scoring
+a user's profile (or a search query) against every paper is one sparse matrix-vector product.
+With several web worker processes the arrays can be shared: the ingestion process publishes them as .npy files in a new
+generation directory and swaps a symlink to it, and the workers map the current generation read-only."""
+from database import db, Paper
+from vocabulary import vocabulary
+from scipy.sparse import csr_matrix
+from metrics import stage
+from datetime import datetime, timezone
+import numpy as np
+import threading
+import logging
+import shutil
+import time
+import os
+
+ENGINE_PATH = 'engine'
+# Seconds between two checks of the published generation by a worker
+CHECK_INTERVAL = 2.0
+# Number of generations kept on the disk, the workers that still map an older one keep their (deleted) files mapped
+KEEP_GENERATIONS = 2
+ARRAYS = ['data', 'indices', 'indptr', 'norms', 'ids', 'dates', 'id_order']
+
+def current_generation(path):
+    """Returns the name of the generation the 'current' symlink under [path] points to, or None."""
+    try:
+        return os.readlink(os.path.join(path, 'current'))
+    except FileNotFoundError:
+        return None
+
+def write_generation(path, arrays):
+    """Writes the (name -> array) [arrays] as .npy files to a new generation directory under [path] and points the
+    'current' symlink to it, so the readers swap to it all at once. Returns the name of the generation."""
+    generation = f"generation-{time.time_ns()}"
+    directory = os.path.join(path, generation)
+    os.makedirs(directory)
+    for name, array in arrays.items():
+        np.save(os.path.join(directory, f"{name}.npy"), array)
+    # Replacing the symlink is atomic, a reader sees either the old or the new generation
+    temporary = os.path.join(path, f"current.{os.getpid()}.{threading.get_ident()}.tmp")
+    if os.path.lexists(temporary):
+        os.remove(temporary)
+    os.symlink(generation, temporary)
+    os.replace(temporary, os.path.join(path, 'current'))
+
+    generations = sorted(name for name in os.listdir(path) if name.startswith('generation-'))
+    for name in generations[:-KEEP_GENERATIONS]:
+        shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+    return generation
+
+def read_generation(path, names, generation=None):
+    """Maps the arrays with the [names] of the [generation] (by default the current one) under [path] read-only. Returns
+    the generation and a (name -> array) dict, or (None, None) if nothing was published yet."""
+    generation = generation or current_generation(path)
+    if generation is None:
+        return None, None
+    directory = os.path.join(path, generation)
+    return generation, {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode='r') for name in names}
+
+def to_datetime64(date):
+    """Converts a python datetime to numpy datetime64. The timezone is dropped the same way the database drops it."""
+    return np.datetime64(date.replace(tzinfo=None), 'us')
+
+class RankingEngine:
+    """Keeps the paper vectors as rows of a CSR matrix (sorted by the updated date) together with their L2 norms,
+    ids and dates. The engine is rebuilt from the database with refresh(). If [path] is set the arrays are shared through
+    the generations published there (see publish() and ensure_current())."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.loaded = False
+        # The published generation that is mapped, the vocabulary epoch of its vectors and the time of the last check
+        self.generation = None
+        self.epoch = 0
+        self.checked = 0.0
+        # Changes with every build or mapped generation, with the time of the change. The ETags of the pages come from it
+        self.version = None
+        self.modified = None
+        self.matrix = csr_matrix((0, 0), dtype=np.float32)
+        self.norms = np.zeros(0)
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.dates = np.zeros(0, dtype='datetime64[us]')
+        self.id_order = np.zeros(0, dtype=np.int64)
+
+    def build(self, papers):
+        """Builds the matrix from an iterable of (id, updated_date, vector) tuples."""
+        papers = sorted(papers, key=lambda x: (x[1].replace(tzinfo=None), x[0]))
+        # The columns of the matrix are the term ids
+        indptr = np.zeros(len(papers) + 1, dtype=np.int64)
+        np.cumsum([len(p[2]) for p in papers], out=indptr[1:])
+        indices = np.concatenate([p[2].ids for p in papers] or [np.zeros(0, dtype=np.int32)])
+        data = np.concatenate([p[2].weights for p in papers] or [np.zeros(0, dtype=np.float32)])
+        n_terms = int(indices.max()) + 1 if len(indices) else 0
+
+        matrix = csr_matrix((data, indices, indptr), shape=(len(papers), n_terms))
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1, dtype=np.float64)).ravel())
+        ids = np.array([p[0] for p in papers], dtype=np.int64)
+        dates = np.array([to_datetime64(p[1]) for p in papers], dtype='datetime64[us]')
+        id_order = np.argsort(ids)
+
+        # Swapping the whole state at once, so the requests that are being served never see a half built engine
+        with self.lock:
+            self.matrix, self.norms, self.ids, self.dates, self.id_order = matrix, norms, ids, dates, id_order
+            self.version, self.modified = f"build-{time.time_ns()}", datetime.now(timezone.utc)
+            self.loaded = True
+
+    def refresh(self):
+        """Reloads all the paper vectors from the database and the vocabulary epoch they were weighted with. Needs an app
+        context."""
+        rows = db.session.execute(db.select(Paper.id, Paper.updated_date, Paper.vector)).all()
+        self.build(rows)
+        self.epoch = vocabulary.stored_epoch()
+        logging.info(f"Ranking engine refreshed with {len(rows)} papers and {self.matrix.shape[1]} terms")
+
+    def ensure_loaded(self):
+        if not self.loaded and not (self.path and self.map()):
+            self.refresh()
+
+    def current_generation(self):
+        return current_generation(self.path)
+
+    def publish(self, epoch):
+        """Writes the arrays to a new generation directory under [path] and points the 'current' symlink to it, so the
+        workers swap to it all at once. [epoch] is the vocabulary epoch of the vectors."""
+        with self.lock:
+            matrix, norms, ids, dates, id_order = self.matrix, self.norms, self.ids, self.dates, self.id_order
+        generation = write_generation(self.path, {
+            'data': matrix.data, 'indices': matrix.indices, 'indptr': matrix.indptr, 'norms': norms, 'ids': ids,
+            'dates': dates, 'id_order': id_order,
+            'meta': np.array([matrix.shape[0], matrix.shape[1], epoch], dtype=np.int64)
+        })
+        with self.lock:
+            self.generation, self.epoch = generation, epoch
+            # The same version as the workers that map it, the arrays are the published ones until the next build
+            self.version = generation
+            self.modified = datetime.fromtimestamp(int(generation.split('-')[1]) / 1e9, timezone.utc)
+        logging.info(f"Ranking engine published as {generation}")
+
+    def map(self, generation=None):
+        """Maps the arrays of the [generation] (by default the current one) read-only. Returns False if nothing was
+        published yet."""
+        generation, arrays = read_generation(self.path, ARRAYS + ['meta'], generation)
+        if generation is None:
+            return False
+        n_papers, n_terms, epoch = arrays['meta']
+        matrix = csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=(int(n_papers), int(n_terms)), copy=False)
+        with self.lock:
+            self.matrix, self.norms, self.ids = matrix, arrays['norms'], arrays['ids']
+            self.dates, self.id_order = arrays['dates'], arrays['id_order']
+            self.generation, self.epoch = generation, int(epoch)
+            # The generations are named after the time they were published, so every worker gets the same version
+            self.version = generation
+            self.modified = datetime.fromtimestamp(int(generation.split('-')[1]) / 1e9, timezone.utc)
+            self.loaded = True
+        logging.info(f"Ranking engine mapped {generation} with {n_papers} papers")
+        return True
+
+    def ensure_current(self):
+        """Maps the newest published generation if it changed since the last check (at most every CHECK_INTERVAL
+        seconds). Returns True if the engine was swapped."""
+        if not self.path or time.monotonic() - self.checked < CHECK_INTERVAL:
+            return False
+        self.checked = time.monotonic()
+        generation = self.current_generation()
+        if generation is None or generation == self.generation:
+            return False
+        return self.map()
+
+    def window(self, since=None):
+        """Returns the index of the first row with updated_date >= [since]."""
+        if since is None:
+            return 0
+        return int(np.searchsorted(self.dates, to_datetime64(since), side='left'))
+
+    def query_vector(self, vector):
+        """Converts a SparseVector to a dense array over the matrix columns and returns it with its norm.
+        Terms that don't appear in any paper only contribute to the norm."""
+        query = np.zeros(self.matrix.shape[1])
+        inside = vector.ids < len(query)
+        query[vector.ids[inside]] = vector.weights[inside]
+        return query, vector.norm()
+
+    def score(self, vector, since=None):
+        """Returns the ids, dates and cosine scores of all the papers updated since [since] (or all papers if None)."""
+        with self.lock:
+            matrix, norms, ids, dates = self.matrix, self.norms, self.ids, self.dates
+            start = self.window(since)
+            query, norm = self.query_vector(vector)
+        # A view of the rows of the time period, slicing the matrix with matrix[start:] would copy them
+        window = csr_matrix(
+            (matrix.data[matrix.indptr[start]:], matrix.indices[matrix.indptr[start]:], matrix.indptr[start:] - matrix.indptr[start]),
+            shape=(matrix.shape[0] - start, matrix.shape[1]), copy=False
+        )
+        dot_products = window @ query
+        denominator = norms[start:] * norm
+        scores = np.divide(dot_products, denominator, out=np.zeros_like(dot_products), where=denominator > 0)
+        return ids[start:], dates[start:], scores
+
+    def top_k(self, vector, k, since=None):
+        """Returns the ids and scores of the [k] most similar papers, sorted by the score."""
+        with stage('scoring'):
+            ids, _, scores = self.score(vector, since)
+        with stage('sorting'):
+            if k < len(scores):
+                candidates = np.argpartition(-scores, k)[:k]
+            else:
+                candidates = np.arange(len(scores))
+            # Ties are broken by the row order, the same way a stable sort of the whole list would do it
+            order = candidates[np.lexsort((candidates, -scores[candidates]))]
+        return ids[order], scores[order]
+
+    def rows(self, ids):
+        """Returns the matrix rows of the papers with the given [ids], or -1 for the papers that aren't in the engine."""
+        with self.lock:
+            paper_ids, id_order = self.ids, self.id_order
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(paper_ids) == 0:
+            return np.full(len(ids), -1, dtype=np.int64)
+        positions = np.searchsorted(paper_ids, ids, sorter=id_order)
+        rows = id_order[np.minimum(positions, len(paper_ids) - 1)]
+        return np.where(paper_ids[rows] == ids, rows, -1)
+
+    def score_rows(self, vector, rows):
+        """Returns the cosine scores of the papers in the given matrix [rows]."""
+        with self.lock:
+            matrix, norms = self.matrix, self.norms
+            query, norm = self.query_vector(vector)
+        dot_products = matrix[rows] @ query
+        denominator = norms[rows] * norm
+        return np.divide(dot_products, denominator, out=np.zeros_like(dot_products), where=denominator > 0)
+
+    def count(self, since=None):
+        """Returns the number of papers updated since [since]."""
+        return len(self.ids) - self.window(since)
+
+engine = RankingEngine()
@@ -0,0 +1,38 @@
+"""Rebuild the user profiles from scratch out of their liked papers, e.g. after the paper vectors were re-weighted or
+when many likes and unlikes left a profile drifting away from its papers.
+The profile starts from the interests picked at the sign up (a weight of 1 for every term). For the users who signed up
+before they were stored they are recovered by unliking all the liked papers. The order of the likes isn't stored, the
+papers are liked in the order of their ids (the order they were downloaded in).
+Usage: python rebuild_profiles.py [EMAIL ...]"""
+from main import app
+from database import db, User, Feed
+from recommender import update_user_profile_batch, rebuild_user_profile
+from vectors import SparseVector
+from datetime import datetime, timezone
+import sys
+
+def interests(vector, liked_vectors):
+    """The terms left with a weight close to 1 after unliking the papers are the interests. It loses the interests that
+    were pruned after many likes, it's only used for the users whose interests aren't stored."""
+    vector = update_user_profile_batch(vector, [(liked, False) for liked in reversed(liked_vectors)])
+    ids = vector.ids[vector.weights >= 0.5]
+    return SparseVector(ids, [1] * len(ids))
+
+with app.app_context():
+    query = db.select(User)
+    if len(sys.argv) > 1:
+        query = query.where(User.email.in_(sys.argv[1:]))
+    rebuilt = 0
+    for user in db.session.execute(query).scalars():
+        if not user.liked_papers:
+            continue
+        liked_vectors = [paper.vector for paper in sorted(user.liked_papers, key=lambda p: p.id)]
+        base = user.interests if user.interests is not None else interests(user.vector, liked_vectors)
+        user.vector = rebuild_user_profile(liked_vectors, base)
+        user.profile_updated = datetime.now(timezone.utc).replace(tzinfo=None)
+        # The dense profile is projected from the rebuilt one
+        user.embedding = None
+        db.session.execute(db.delete(Feed).where(Feed.user_email == user.email))
+        rebuilt += 1
+    db.session.commit()
+    print(f"Rebuilt {rebuilt} user profiles")
@@ -1,33 +1,80 @@
+from vectors import SparseVector
+import numpy as np
+
+# Parameters of the profile update when a user likes a paper, unliking it applies the inverse scaling
+ALPHA = 0.95
+BETA = 0.05
+GAMMA = 0.02
+
 def update_user_profile(user_vector, document_vector, alpha, beta, gamma):
     """Takes the user's profle (user's vector) and updates it with the document vector using the formula: \n
     P' = alpha * P + beta * D.
     """
-    
-    for key in user_vector:
-        user_vector[key] *= alpha
-    for key in document_vector:
-        if key not in user_vector:
-            user_vector[key] = beta * document_vector[key]
-        else:
-            user_vector[key] += beta * document_vector[key]
+    ids = np.union1d(user_vector.ids, document_vector.ids)
+    weights = np.zeros(len(ids))
+    weights[np.searchsorted(ids, user_vector.ids)] += alpha * user_vector.weights
+    weights[np.searchsorted(ids, document_vector.ids)] += beta * document_vector.weights
 
     # Delete very low weights
-    user_vector = {k: v for k,v in user_vector.items() if v >= gamma}
+    keep = weights >= gamma
+
+    return SparseVector(ids[keep], weights[keep])
+
+def update_user_profile_batch(user_vector, updates, alpha=ALPHA, beta=BETA, gamma=GAMMA):
+    """Applies a list of (document vector, liked) [updates] to the user's profile in order. A like is
+    P' = alpha * P + beta * D (pruned at gamma) and an unlike is its inverse P' = (P - beta * D) / alpha (pruned at 0),
+    the same as calling update_user_profile() once per update. \n
+    The profile is kept in one array of weights for the whole batch, and every step only touches the terms that are in
+    the profile or in the document. The weights stay in float64 until the end, so the likes and unlikes
+    don't pile up the float32 rounding and the 1/alpha multiplication of every step.
+    """
+    if not updates:
+        return user_vector
+    # The weights are indexed by the term id directly, np.zeros doesn't touch the memory of the unused terms
+    columns = np.concatenate([vector.ids for vector, _ in updates]).astype(np.int64)
+    data = beta * np.concatenate([vector.weights for vector, _ in updates]).astype(np.float64)
+    indptr = np.zeros(len(updates) + 1, dtype=np.int64)
+    np.cumsum([len(vector) for vector, _ in updates], out=indptr[1:])
+    size = max(int(columns.max(initial=-1)), int(user_vector.ids.max(initial=-1))) + 1
+
+    weights = np.zeros(size)
+    # The terms in the profile (in no particular order) and a mask of them
+    active = user_vector.ids.astype(np.int64)
+    weights[active] = user_vector.weights
+    present = np.zeros(size, dtype=bool)
+    present[active] = True
+
+    for i, (_, liked) in enumerate(updates):
+        document = columns[indptr[i]:indptr[i+1]]
+        new = document[~present[document]]
+        present[new] = True
+        active = np.concatenate([active, new])
+        if liked:
+            weights[active] *= alpha
+            weights[document] += data[indptr[i]:indptr[i+1]]
+        else:
+            # Removing the document before dividing by alpha, so the unlike cancels the like exactly
+            weights[document] -= data[indptr[i]:indptr[i+1]]
+            weights[active] /= alpha
+        # Delete very low weights (and the negative ones after an unlike)
+        keep = weights[active] >= (gamma if liked else 0)
+        removed = active[~keep]
+        weights[removed] = 0
+        present[removed] = False
+        active = active[keep]
+
+    active.sort()
+    return SparseVector(active, weights[active])
 
-    return user_vector
+def rebuild_user_profile(liked_vectors, base=None, alpha=ALPHA, beta=BETA, gamma=GAMMA):
+    """Builds the profile from scratch by liking the [liked_vectors] in order, starting from the [base] profile
+    (or an empty one). It removes any drift left by the likes and unlikes, and follows re-weighted paper vectors."""
+    return update_user_profile_batch(
+        base if base is not None else SparseVector(), [(vector, True) for vector in liked_vectors], alpha, beta, gamma
+    )
 
 def cosine(vector1, vector2):
     """Calculates the cosine measure between two vectors."""
-    vector1_length = 0
-    vector2_length = 0
-    dot_product = 0
-    for key in vector1:
-        vector1_length += vector1[key]**2
-        if key in vector2:
-            dot_product += vector1[key] * vector2[key]
-    for key in vector2:
-        vector2_length += vector2[key]**2
-    vector1_length = vector1_length**0.5
-    vector2_length = vector2_length**0.5
-    return dot_product/(vector1_length*vector2_length)
-    
\ No newline at end of file
+    _, index1, index2 = np.intersect1d(vector1.ids, vector2.ids, assume_unique=True, return_indices=True)
+    dot_product = float(np.dot(vector1.weights[index1].astype(np.float64), vector2.weights[index2]))
+    return dot_product/(vector1.norm()*vector2.norm())
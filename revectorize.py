@@ -0,0 +1,110 @@
+"""Vectorize all the papers again from the texts in the text store, without any network access. Use it after changing the
+tokenizer, the stop words or MAX_VECTOR_LENGTH, while the server is stopped (it keeps its own copy of the vocabulary).
+The vocabulary is built from scratch. The first pass tokenizes the texts in a pool of processes and counts the document
+frequencies, the term counts are written to temporary files. The second pass reads them back through memory maps, weighs
+them with the new idf and updates the paper vectors. Papers whose text isn't in the store keep their old vectors.
+The user profiles can be rebuilt from the new vectors with rebuild_profiles.py afterwards.
+Usage: python revectorize.py [--processes N]"""
+from main import app, update_indexes
+from database import db, Paper, Feed, get_term_ids
+from arxiv_scraper import vectorizer, vocabulary, paper_vectors, parse_arxiv_id
+from pipeline import init_extractor
+from text_store import text_store
+from ranking import engine
+from search_index import search_index
+from ann import ann_index
+from lsa import lsa_index
+from vocabulary import Vocabulary
+from scipy.sparse import csr_matrix
+from multiprocessing import Pool
+import numpy as np
+import argparse
+import tempfile
+import logging
+import pipeline
+import time
+import os
+
+# Number of papers counted and updated together
+CHUNK = 256
+
+def tokenize(site_link):
+    """Reads the text of the paper from the store and tokenizes it. Runs in a worker process."""
+    text = text_store.get_text(*parse_arxiv_id(site_link))
+    return pipeline.worker_analyzer(text) if text is not None else None
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--processes', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    with app.app_context(), tempfile.TemporaryDirectory() as directory:
+        papers = db.session.execute(db.select(Paper.id, Paper.site_link).order_by(Paper.id)).all()
+        new_vocabulary = Vocabulary(epoch=vocabulary.stored_epoch() + 1)
+        paper_ids = []
+        indptr = [0]
+        start = time.perf_counter()
+
+        # First pass: document frequencies, the term counts of every paper are appended to the temporary files
+        with open(os.path.join(directory, 'indices'), 'wb') as indices_file, \
+             open(os.path.join(directory, 'counts'), 'wb') as counts_file, \
+             Pool(args.processes, initializer=init_extractor, initargs=(vectorizer,)) as pool:
+
+            def spill(chunk):
+                documents = [tokens for _, tokens in chunk]
+                new_vocabulary.add_documents(documents, assign_ids=lambda terms: get_term_ids(terms, create=True))
+                db.session.commit()
+                counts = new_vocabulary.counts(documents)
+                indices_file.write(counts.indices.astype(np.int32).tobytes())
+                counts_file.write(counts.data.astype(np.int32).tobytes())
+                indptr.extend(indptr[-1] + counts.indptr[1:])
+                paper_ids.extend(paper_id for paper_id, _ in chunk)
+
+            chunk = []
+            results = pool.imap(tokenize, [site_link for _, site_link in papers], chunksize=16)
+            for (paper_id, _), tokens in zip(papers, results):
+                if tokens is None:
+                    continue
+                chunk.append((paper_id, tokens))
+                if len(chunk) == CHUNK:
+                    spill(chunk)
+                    chunk = []
+            if chunk:
+                spill(chunk)
+        logging.info(f"Tokenized {len(paper_ids)} papers in {time.perf_counter() - start:.1f}s, {len(papers) - len(paper_ids)} aren't in the store")
+
+        # Second pass: the vectors are weighted with the final idf
+        new_vocabulary.weighted_idf = new_vocabulary.idf()
+        indptr = np.array(indptr, dtype=np.int64)
+        if len(paper_ids) and indptr[-1] > 0:
+            indices = np.memmap(os.path.join(directory, 'indices'), dtype=np.int32, mode='r')
+            counts = np.memmap(os.path.join(directory, 'counts'), dtype=np.int32, mode='r')
+            for first in range(0, len(paper_ids), CHUNK):
+                last = min(first + CHUNK, len(paper_ids))
+                begin, end = indptr[first], indptr[last]
+                matrix = csr_matrix(
+                    (counts[begin:end], indices[begin:end], indptr[first:last+1] - begin),
+                    shape=(last - first, len(new_vocabulary))
+                )
+                vectors = paper_vectors(new_vocabulary.weigh(matrix))
+                db.session.execute(db.update(Paper), [
+                    {'id': paper_id, 'vector': vector} for paper_id, vector in zip(paper_ids[first:last], vectors)
+                ])
+                db.session.commit()
+            del indices, counts
+        new_vocabulary.save()
+        # The precomputed feeds were ranked with the old vectors
+        db.session.execute(db.delete(Feed))
+        db.session.commit()
+        # In the shared serving mode the web workers swap to the new vectors when they are published, the indexes they
+        # load are rebuilt first
+        if engine.path:
+            search_index.read_only = False
+            ann_index.read_only = False
+            lsa_index.read_only = False
+            engine.refresh()
+            update_indexes([], new_vocabulary.epoch)
+            engine.publish(new_vocabulary.epoch)
+
+        elapsed = time.perf_counter() - start
+        print(f"Vectorized {len(paper_ids)} of {len(papers)} papers in {elapsed:.1f}s ({len(paper_ids) / elapsed if elapsed else 0:.1f} papers/s)")
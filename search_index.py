@@ -0,0 +1,236 @@
+"""Inverted index used by the search page. For every term it keeps the posting list of (paper id, weight), so a query
+only touches the postings of its own terms. The index is updated incrementally after new papers are downloaded and
+saved to disk as a generation of .npy files (like the paper matrix of the ranking engine), which the web workers map
+read-only instead of keeping their own copy of the postings. The generation keeps the number of papers and the largest
+paper id, an index that is behind the database (the papers were committed but the index wasn't saved) gets the missing
+papers when it's loaded or updated."""
+from database import db, Paper
+from ranking import to_datetime64, write_generation, read_generation
+from metrics import stage
+import numpy as np
+import threading
+import logging
+
+SEARCH_INDEX_PATH = 'search_index'
+ARRAYS = ['term_ptr', 'papers', 'weights', 'doc_ids', 'doc_norms', 'doc_dates', 'meta']
+
+def best_order(keys, ids, k=None):
+    """Returns the positions of the [k] largest [keys] (all of them if None), sorted by the key and then by the id. Only
+    the candidates that can be in the first [k] are sorted, they are selected with a partition."""
+    candidates = np.arange(len(keys))
+    if k is not None and k < len(keys):
+        kth = np.partition(keys, len(keys) - k)[len(keys) - k]
+        # The ties of the k-th key are all kept, the ids decide which of them make it
+        candidates = np.flatnonzero(keys >= kth)
+    return candidates[np.lexsort((ids[candidates], -keys[candidates]))][:k]
+
+class InvertedIndex:
+    """Posting lists stored in CSC layout: the postings of term t are papers[term_ptr[t]:term_ptr[t+1]] and
+    weights[term_ptr[t]:term_ptr[t+1]]. The L2 norms and dates of the documents are kept in arrays sorted by paper id."""
+
+    def __init__(self, path=SEARCH_INDEX_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.loaded = False
+        # The web workers of the shared serving mode only load the file saved by the ingestion process
+        self.read_only = False
+        # Incremented every time the postings change, the cached search results of older versions are outdated
+        self.version = 0
+        # The vocabulary epoch the weights come from, the index is rebuilt when the papers are re-weighted
+        self.epoch = 0
+        # Number of papers and largest paper id in the index, compared with the Paper table to find a stale index
+        self.count = 0
+        self.max_id = 0
+        self.term_ptr = np.zeros(1, dtype=np.int64)
+        self.papers = np.zeros(0, dtype=np.int64)
+        self.weights = np.zeros(0, dtype=np.float32)
+        self.doc_ids = np.zeros(0, dtype=np.int64)
+        self.doc_norms = np.zeros(0)
+        self.doc_dates = np.zeros(0, dtype='datetime64[us]')
+
+    def build(self, rows, epoch, base=None):
+        """Adds the (id, updated_date, vector) [rows] to the postings of [base] (a tuple of the index arrays, or None
+        to start from an empty index). Papers that are already in [base] are replaced. Only the new postings are sorted,
+        they are inserted at the ends of the runs of their terms, after the postings that were there."""
+        ids = np.array([row[0] for row in rows], dtype=np.int64)
+        terms = np.concatenate([row[2].ids for row in rows] or [np.zeros(0, dtype=np.int32)]).astype(np.int64)
+        papers = np.repeat(ids, [len(row[2]) for row in rows])
+        weights = np.concatenate([row[2].weights for row in rows] or [np.zeros(0, dtype=np.float32)])
+        norms = np.array([row[2].norm() for row in rows])
+        dates = np.array([to_datetime64(row[1]) for row in rows], dtype='datetime64[us]')
+        order = np.argsort(terms, kind='stable')
+        terms, papers, weights = terms[order], papers[order], weights[order]
+        order = np.argsort(ids)
+        ids, norms, dates = ids[order], norms[order], dates[order]
+
+        if base is None:
+            base = (np.zeros(1, dtype=np.int64), papers[:0], weights[:0], ids[:0], norms[:0], dates[:0])
+        term_ptr, old_papers, old_weights, doc_ids, doc_norms, doc_dates = base
+        counts = np.diff(term_ptr)
+        replaced = np.isin(doc_ids, ids)
+        # The postings of the papers that are replaced are dropped from their runs, the postings are only scanned for them
+        # when there are any
+        if replaced.any():
+            removed = np.flatnonzero(np.isin(old_papers, doc_ids[replaced]))
+            counts = counts - np.bincount(np.searchsorted(term_ptr, removed, side='right') - 1, minlength=len(counts))
+            old_papers, old_weights = np.delete(old_papers, removed), np.delete(old_weights, removed)
+        # A new posting goes to the end of the run of its term, the terms the index doesn't have yet are at the end
+        ends = np.append(np.cumsum(counts), len(old_papers))
+        positions = ends[np.minimum(terms, len(counts))]
+        papers = np.insert(old_papers, positions, papers)
+        weights = np.insert(old_weights, positions, weights)
+        n_terms = max(len(counts), (int(terms[-1]) + 1) if len(terms) else 0)
+        counts = np.bincount(terms, minlength=n_terms) + np.pad(counts, (0, n_terms - len(counts)))
+        term_ptr = np.zeros(n_terms + 1, dtype=np.int64)
+        np.cumsum(counts, out=term_ptr[1:])
+
+        doc_ids, doc_norms, doc_dates = doc_ids[~replaced], doc_norms[~replaced], doc_dates[~replaced]
+        positions = np.searchsorted(doc_ids, ids)
+        ids = np.insert(doc_ids, positions, ids)
+        norms = np.insert(doc_norms, positions, norms)
+        dates = np.insert(doc_dates, positions, dates)
+
+        with self.lock:
+            self.term_ptr, self.papers, self.weights = term_ptr, papers, weights
+            self.doc_ids, self.doc_norms, self.doc_dates = ids, norms, dates
+            self.epoch = epoch
+            self.count, self.max_id = len(ids), int(ids.max()) if len(ids) else 0
+            self.version += 1
+            self.loaded = True
+
+    def state(self):
+        with self.lock:
+            return self.term_ptr, self.papers, self.weights, self.doc_ids, self.doc_norms, self.doc_dates
+
+    def rebuild(self, epoch):
+        """Builds the index from all the papers in the database. Needs an app context."""
+        rows = db.session.execute(db.select(Paper.id, Paper.updated_date, Paper.vector)).all()
+        self.build(rows, epoch)
+        self.save()
+        logging.info(f"Search index rebuilt with {len(rows)} papers and {len(self.papers)} postings")
+
+    def missing_ids(self):
+        """Returns the ids of the papers in the database that aren't in the index, or None if the index has papers that
+        aren't in the database anymore. An index with the same number of papers and largest id as the Paper table costs
+        one query. Needs an app context."""
+        count, max_id = db.session.execute(db.select(db.func.count(Paper.id), db.func.max(Paper.id))).one()
+        if count == self.count and (max_id or 0) == self.max_id:
+            return []
+        ids = np.array(db.session.execute(db.select(Paper.id)).scalars().all(), dtype=np.int64)
+        with self.lock:
+            doc_ids = self.doc_ids
+        known = np.isin(ids, doc_ids)
+        if known.sum() != len(doc_ids):
+            return None
+        return ids[~known].tolist()
+
+    def update(self, ids, epoch):
+        """Adds the papers with the given [ids] and the ones the index is missing to the index. If the papers were
+        re-weighted since the index was built (the vocabulary epoch changed) the whole index is rebuilt. Needs an app
+        context."""
+        self.ensure_loaded(epoch)
+        missing = self.missing_ids()
+        if epoch != self.epoch or missing is None:
+            self.rebuild(epoch)
+            return
+        ids = list(ids) + missing
+        rows = db.session.execute(db.select(Paper.id, Paper.updated_date, Paper.vector).where(Paper.id.in_(ids))).all()
+        self.build(rows, epoch, self.state())
+        self.save()
+        logging.info(f"Search index updated with {len(rows)} papers")
+
+    def save(self):
+        """Writes the index as a new generation under [path], the workers map it when they swap to the published papers."""
+        term_ptr, papers, weights, doc_ids, doc_norms, doc_dates = self.state()
+        write_generation(self.path, {
+            'term_ptr': term_ptr, 'papers': papers, 'weights': weights, 'doc_ids': doc_ids, 'doc_norms': doc_norms,
+            'doc_dates': doc_dates, 'meta': np.array([self.epoch, self.count, self.max_id], dtype=np.int64)
+        })
+
+    def load(self):
+        """Maps the arrays of the current generation read-only. Returns False if nothing was saved yet."""
+        generation, arrays = read_generation(self.path, ARRAYS)
+        if generation is None:
+            return False
+        with self.lock:
+            self.term_ptr, self.papers, self.weights = arrays['term_ptr'], arrays['papers'], arrays['weights']
+            self.doc_ids, self.doc_norms, self.doc_dates = arrays['doc_ids'], arrays['doc_norms'], arrays['doc_dates']
+            self.epoch, self.count, self.max_id = (int(value) for value in arrays['meta'])
+            self.version += 1
+            self.loaded = True
+        return True
+
+    def ensure_loaded(self, epoch):
+        """Maps the saved index, or builds it if nothing was saved yet or the index is older than the vocabulary [epoch].
+        A read only index is never built, it stays empty until the ingestion process saves it. Needs an app context."""
+        if self.loaded:
+            return
+        if not self.load():
+            if self.read_only:
+                logging.warning(f"Search index {self.path} not found, it is built by the ingestion process")
+                return
+            self.rebuild(epoch)
+            return
+        # The papers were re-weighted or vectorized again while the server was stopped
+        if self.epoch != epoch:
+            if self.read_only:
+                logging.warning(f"Search index {self.path} is from epoch {self.epoch} instead of {epoch}")
+                return
+            self.rebuild(epoch)
+            return
+        # The papers were committed but the index wasn't saved, the missing ones are added (a read only index isn't saved)
+        missing = self.missing_ids()
+        if missing is None:
+            logging.warning(f"Search index {self.path} has papers that aren't in the database")
+            if not self.read_only:
+                self.rebuild(epoch)
+        elif missing:
+            rows = db.session.execute(
+                db.select(Paper.id, Paper.updated_date, Paper.vector).where(Paper.id.in_(missing))
+            ).all()
+            self.build(rows, epoch, self.state())
+            if not self.read_only:
+                self.save()
+            logging.info(f"Search index {self.path} was missing {len(rows)} papers")
+
+    def search(self, vector):
+        """Returns the ids, dates and cosine scores of all the papers that share at least one term with the query."""
+        term_ptr, papers, weights, doc_ids, doc_norms, doc_dates = self.state()
+        query_ids = vector.ids[vector.ids < len(term_ptr) - 1]
+        query_weights = vector.weights[vector.ids < len(term_ptr) - 1]
+        if len(query_ids) == 0 or vector.norm() == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype='datetime64[us]'), np.zeros(0)
+
+        # Accumulating the dot products from the posting lists of the query terms
+        starts, ends = term_ptr[query_ids], term_ptr[query_ids + 1]
+        matched = np.concatenate([papers[s:e] for s, e in zip(starts, ends)])
+        contributions = np.concatenate([
+            weights[s:e].astype(np.float64) * w for s, e, w in zip(starts, ends, query_weights)
+        ])
+        ids, inverse = np.unique(matched, return_inverse=True)
+        dot_products = np.bincount(inverse, weights=contributions, minlength=len(ids))
+
+        rows = np.searchsorted(doc_ids, ids)
+        denominator = doc_norms[rows] * vector.norm()
+        scores = np.divide(dot_products, denominator, out=np.zeros_like(dot_products), where=denominator > 0)
+        return ids, doc_dates[rows], scores
+
+    def ranking(self, vector, k=None):
+        """Returns the ids and scores of the [k] best matching papers (all of them if None) sorted by the score, and the
+        number of matching papers. Ties are broken by the id."""
+        with stage('scoring'):
+            ids, _, scores = self.search(vector)
+        with stage('sorting'):
+            order = best_order(scores, ids, k)
+        return ids[order], scores[order], len(ids)
+
+    def newest(self, vector, k=None):
+        """Returns the ids and scores of the [k] newest matching papers (all of them if None) sorted by the date, and the
+        number of matching papers. Ties are broken by the id."""
+        with stage('scoring'):
+            ids, dates, scores = self.search(vector)
+        with stage('sorting'):
+            order = best_order(dates.view(np.int64), ids, k)
+        return ids[order], scores[order], len(ids)
+
+search_index = InvertedIndex()
@@ -0,0 +1,39 @@
+"""Fixtures of the tests: the app with its database and every file it saves in a temporary directory, loaded with a small
+synthetic corpus. The queries are tokenized by an analyzer without lemmas, so the tests don't need the NLTK data or the
+analyzer artifact. Run from the repository root: python -m pytest"""
+import os
+import pytest
+import numpy as np
+
+PASSWORD = 'password'
+
+@pytest.fixture(scope='session')
+def app(tmp_path_factory):
+    directory = tmp_path_factory.mktemp('app')
+    # main.py reads FLASK_* variables from the environment when it's imported
+    os.environ['FLASK_SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{directory / 'test.db'}"
+    from main import app, db
+    from database import table
+    from benchmarks.synthetic import Corpus, load_database, use_directory
+    from analyzer import Analyzer
+    import analyzer
+    import bcrypt
+    use_directory(str(directory))
+    analyzer.analyzer = Analyzer((r"\w+(?:['\-]\w+)*", 0), (r"([^a-zA-Z0-9])\1{3,}", 0), [], {})
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    corpus = Corpus(n_terms=5000)
+    papers = corpus.papers(1000, length=300)
+    users = corpus.users(papers, 1)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        load_database(db, papers, users, bcrypt.hashpw(PASSWORD.encode(), bcrypt.gensalt(rounds=4)))
+        liked = np.random.default_rng(0).choice(len(papers), 300, replace=False) + 1
+        db.session.execute(db.insert(table), [{'paper_id': int(i), 'user_email': "user0@example.com"} for i in liked])
+        db.session.commit()
+    return app
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
@@ -0,0 +1,17 @@
+"""The unsubscribe links of the email digest."""
+from digest import digest_mailer
+from database import db, User
+
+def test_unsubscribe(app, client):
+    url = digest_mailer.unsubscribe_url("user0@example.com")
+    path = url[len(digest_mailer.site_url):]
+    # A link with a changed signature doesn't unsubscribe anybody
+    assert client.get(path[:-1] + ('A' if path[-1] != 'A' else 'B')).status_code == 302
+    with app.app_context():
+        assert db.session.get(User, "user0@example.com").digest_unsubscribed is None
+    assert client.get(path).status_code == 302
+    with app.app_context():
+        user = db.session.get(User, "user0@example.com")
+        assert user.digest_unsubscribed is not None
+        user.digest_unsubscribed = None
+        db.session.commit()
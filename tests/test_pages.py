@@ -0,0 +1,35 @@
+"""Revalidation of the feed and search pages with their ETags."""
+from conftest import PASSWORD
+from database import db, User, Paper
+from datetime import datetime
+import re
+
+def test_etag_depends_on_url(client):
+    client.post('/login', data={'email': "user0@example.com", 'password': PASSWORD})
+    # The first page after the login shows the flashed message, it can't be revalidated
+    client.get('/?page=1')
+    etag = client.get('/?page=1').headers['ETag']
+    assert client.get('/?page=1', headers={'If-None-Match': etag}).status_code == 304
+    assert client.get('/?page=2', headers={'If-None-Match': etag}).status_code == 200
+    assert client.get('/?page=1&time=6', headers={'If-None-Match': etag}).status_code == 200
+
+def test_feed_follows_profile_changed_elsewhere(app, client):
+    client.post('/login', data={'email': "user0@example.com", 'password': PASSWORD})
+    first = re.search(r'/similar/(\d+)', client.get('/?page=1&time=6').text).group(1)
+    # Another worker process handles a like, the ranking cached by this one has to be dropped
+    with app.app_context():
+        user = db.session.get(User, "user0@example.com")
+        vector, updated = user.vector, user.profile_updated
+        paper = db.session.execute(
+            db.select(Paper).where(Paper.id != int(first)).order_by(Paper.updated_date.desc()).limit(1)
+        ).scalar()
+        user.vector, user.profile_updated = paper.vector, datetime.now()
+        db.session.commit()
+        paper_id = paper.id
+    try:
+        assert re.search(r'/similar/(\d+)', client.get('/?page=1&time=6').text).group(1) == str(paper_id)
+    finally:
+        with app.app_context():
+            user = db.session.get(User, "user0@example.com")
+            user.vector, user.profile_updated = vector, updated
+            db.session.commit()
@@ -0,0 +1,11 @@
+"""The number of database queries of every page for a user with many liked papers, the budgets of benchmarks/queries.py."""
+import pytest
+from benchmarks.queries import QUERY_BUDGETS, URLS, page_queries
+from conftest import PASSWORD
+
+@pytest.mark.parametrize('endpoint, url', URLS)
+def test_query_budget(client, endpoint, url):
+    # The first request loads the ranking engine and the search index
+    page_queries(client, endpoint, url, password=PASSWORD)
+    queries = [page_queries(client, endpoint, url, password=PASSWORD)[0] for _ in range(3)]
+    assert max(queries) <= QUERY_BUDGETS[endpoint]
@@ -0,0 +1,56 @@
+"""update_user_profile_batch against update_user_profile called once per like/unlike, the way the profiles were updated
+before the batch update."""
+import numpy as np
+import pytest
+from recommender import update_user_profile, update_user_profile_batch, ALPHA, BETA, GAMMA
+from benchmarks.synthetic import Corpus
+from vectors import SparseVector
+
+@pytest.fixture(scope='module')
+def papers():
+    return [vector for _, _, vector in Corpus(n_terms=5000).papers(200, length=300)]
+
+@pytest.fixture(scope='module')
+def profile(papers):
+    interests = SparseVector(np.arange(1, 11), [1] * 10)
+    return update_user_profile_batch(interests, [(vector, True) for vector in papers[:20]])
+
+def assert_same(vector1, vector2):
+    np.testing.assert_array_equal(vector1.ids, vector2.ids)
+    np.testing.assert_allclose(vector1.weights, vector2.weights, rtol=1e-5)
+
+def test_likes_match_sequential_updates(papers, profile):
+    expected = profile
+    for vector in papers[20:70]:
+        expected = update_user_profile(expected, vector, ALPHA, BETA, GAMMA)
+    assert_same(update_user_profile_batch(profile, [(vector, True) for vector in papers[20:70]]), expected)
+
+def test_unlikes_match_sequential_inverse(papers, profile):
+    # The unlike is the inverse of the like (P - beta * D) / alpha, that is update_user_profile with 1 / alpha and
+    # -beta / alpha. The original unlike was update_user_profile with 1 / alpha and -beta (P / alpha - beta * D)
+    generator = np.random.default_rng(0)
+    updates = [(papers[i], bool(generator.random() < 0.7)) for i in generator.choice(len(papers), 60)]
+    expected = profile
+    for vector, liked in updates:
+        if liked:
+            expected = update_user_profile(expected, vector, ALPHA, BETA, GAMMA)
+        else:
+            expected = update_user_profile(expected, vector, 1 / ALPHA, -BETA / ALPHA, 0)
+    assert_same(update_user_profile_batch(profile, updates), expected)
+
+def largest_difference(vector1, vector2):
+    ids = np.union1d(vector1.ids, vector2.ids)
+    weights1, weights2 = np.zeros(len(ids)), np.zeros(len(ids))
+    weights1[np.searchsorted(ids, vector1.ids)] = vector1.weights
+    weights2[np.searchsorted(ids, vector2.ids)] = vector2.weights
+    return np.abs(weights1 - weights2).max()
+
+def test_unlike_cancels_like(papers, profile):
+    # Without the pruning, liking papers and unliking them in reverse order gives the starting profile back (up to the
+    # rounding), which the original unlike formula doesn't
+    updates = [(vector, True) for vector in papers[20:30]] + [(vector, False) for vector in reversed(papers[20:30])]
+    assert largest_difference(update_user_profile_batch(profile, updates, gamma=0), profile) < 1e-6
+    original = profile
+    for vector, liked in updates:
+        original = update_user_profile(original, vector, *((ALPHA, BETA, 0) if liked else (1 / ALPHA, -BETA, 0)))
+    assert largest_difference(original, profile) > 1e-3
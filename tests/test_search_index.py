@@ -0,0 +1,28 @@
+"""The incremental updates and the bounded rankings of the inverted index."""
+import numpy as np
+from search_index import InvertedIndex
+from benchmarks.synthetic import Corpus
+
+def test_incremental_build_and_top_k():
+    corpus = Corpus(n_terms=2000, seed=1)
+    papers = corpus.papers(600, length=100)
+    # New versions of some papers come with the last batch
+    revised = [(paper_id, date, papers[-1 - i][2]) for i, (paper_id, date, _) in enumerate(papers[:50:5])]
+    incremental = InvertedIndex(None)
+    incremental.build(papers[:300], 0)
+    incremental.build(papers[300:] + revised, 0, incremental.state())
+    # The postings of a term are in the order the papers were added
+    replaced = {paper_id for paper_id, _, _ in revised}
+    full = InvertedIndex(None)
+    full.build([paper for paper in papers[:300] if paper[0] not in replaced] + papers[300:] + revised, 0)
+    for built, expected in zip(incremental.state(), full.state()):
+        assert np.array_equal(built, expected)
+
+    query = papers[7][2]
+    ids, dates, scores = full.search(query)
+    order = np.lexsort((ids, -scores))
+    for k in (1, 20, len(ids) + 1):
+        best, best_scores, total = full.ranking(query, k)
+        assert np.array_equal(best, ids[order][:k]) and total == len(ids)
+    newest, _, _ = full.newest(query, 20)
+    assert np.array_equal(newest, ids[np.lexsort((ids, -dates.view(np.int64)))][:20])
@@ -0,0 +1,124 @@
+"""Content-addressed store of the texts extracted from the papers (and optionally their pdfs), so the whole corpus can be
+vectorized again without downloading anything from arXiv. Every content is saved once under its sha256 hash, and small
+reference files map an arXiv id and version to the hash. The total size is capped, the least recently used contents
+are evicted first."""
+import threading
+import hashlib
+import logging
+import mmap
+import zlib
+import os
+
+TEXT_STORE_PATH = 'text_store'
+MAX_BYTES = 8 * 2**30
+# After an eviction the store is this fraction of [max_bytes], so it doesn't evict on every new content
+EVICTION_TARGET = 0.9
+COMPRESSION_LEVEL = 6
+
+class TextStore:
+    """The contents are in [path]/objects/<first 2 characters of the hash>/<hash> (zlib compressed, the pdfs are stored as
+    they are) and the references in [path]/refs/<arxiv id>v<version>.<kind>, where kind is 'txt' or 'pdf'. The
+    modification time of a content is the last time it was used."""
+
+    def __init__(self, path=TEXT_STORE_PATH, max_bytes=MAX_BYTES, keep_pdfs=False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.keep_pdfs = keep_pdfs
+        self.lock = threading.Lock()
+        # Total size of the contents, computed from the disk on the first use
+        self.size = None
+
+    def reference_path(self, arxiv_id, version, kind):
+        # Old style ids contain a slash (e.g. cs/0112017)
+        return os.path.join(self.path, 'refs', f"{arxiv_id.replace('/', '_')}v{version}.{kind}")
+
+    def object_path(self, digest):
+        return os.path.join(self.path, 'objects', digest[:2], digest)
+
+    def objects(self):
+        """Yields the (path, size, modification time) of all the contents."""
+        root = os.path.join(self.path, 'objects')
+        if not os.path.isdir(root):
+            return
+        for directory in os.scandir(root):
+            for entry in os.scandir(directory.path):
+                if entry.name.endswith('.tmp'):
+                    continue
+                stat = entry.stat()
+                yield entry.path, stat.st_size, stat.st_mtime
+
+    def ensure_size(self):
+        """Sums the sizes of the contents, the caller holds the lock."""
+        if self.size is None:
+            self.size = sum(size for _, size, _ in self.objects())
+
+    def write(self, path, content):
+        # Writing to a temporary file first, so a crash never leaves a half written file
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f"{path}.{threading.get_ident()}.tmp"
+        with open(temporary, 'wb') as file:
+            file.write(content)
+        os.replace(temporary, path)
+
+    def put(self, arxiv_id, version, kind, content):
+        """Saves the [content] (bytes) of the [kind] of the paper."""
+        if not content:
+            return
+        digest = hashlib.sha256(content).hexdigest()
+        path = self.object_path(digest)
+        with self.lock:
+            self.ensure_size()
+            if os.path.exists(path):
+                os.utime(path)
+            else:
+                data = zlib.compress(content, COMPRESSION_LEVEL) if kind == 'txt' else content
+                self.write(path, data)
+                self.size += len(data)
+            self.write(self.reference_path(arxiv_id, version, kind), digest.encode())
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def get(self, arxiv_id, version, kind):
+        """Returns the content of the [kind] of the paper, or None if it isn't in the store."""
+        reference = self.reference_path(arxiv_id, version, kind)
+        try:
+            with open(reference, 'rb') as file:
+                path = self.object_path(file.read().decode())
+            with open(path, 'rb') as file:
+                # The content is read through a memory map, so the whole file isn't copied before decompressing it
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    content = zlib.decompress(data) if kind == 'txt' else bytes(data)
+            os.utime(path)
+        except FileNotFoundError:
+            # The evicted contents leave their references behind
+            if os.path.exists(reference):
+                os.remove(reference)
+            return None
+        return content
+
+    def put_text(self, arxiv_id, version, text):
+        self.put(arxiv_id, version, 'txt', text.encode('utf8'))
+
+    def get_text(self, arxiv_id, version):
+        content = self.get(arxiv_id, version, 'txt')
+        return content.decode('utf8') if content is not None else None
+
+    def evict(self):
+        """Removes the least recently used contents until the store is under EVICTION_TARGET * max_bytes. The references
+        to them are removed lazily by get(). The caller holds the lock."""
+        target = EVICTION_TARGET * self.max_bytes
+        removed = 0
+        for path, size, _ in sorted(self.objects(), key=lambda item: item[2]):
+            if self.size <= target:
+                break
+            os.remove(path)
+            self.size -= size
+            removed += 1
+        logging.info(f"Evicted {removed} contents from the text store, {self.size / 2**20:.0f} MiB left")
+
+    def stats(self):
+        with self.lock:
+            self.ensure_size()
+            return {'bytes': self.size, 'max_bytes': self.max_bytes}
+
+text_store = TextStore()
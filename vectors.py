@@ -0,0 +1,50 @@
+"""Compact sparse vectors used for the paper and user profiles. A vector is a sorted array of term ids (from the
+Term table) and a parallel array of weights. In the database it's stored as one binary blob: the int32 ids followed by
+the float32 weights, so it can be decoded without copying with np.frombuffer."""
+import numpy as np
+
+ID_TYPE = np.dtype('<i4')
+WEIGHT_TYPE = np.dtype('<f4')
+
+class SparseVector:
+    """Term ids (sorted, unique) and their weights."""
+
+    def __init__(self, ids=(), weights=()):
+        ids = np.asarray(ids, dtype=ID_TYPE)
+        weights = np.asarray(weights, dtype=WEIGHT_TYPE)
+        if len(ids) > 1 and np.any(ids[1:] <= ids[:-1]):
+            ids, first = np.unique(ids, return_index=True)
+            weights = weights[first]
+        self.ids = ids
+        self.weights = weights
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __repr__(self):
+        return f"SparseVector({len(self)} terms)"
+
+    def norm(self):
+        weights = self.weights.astype(np.float64)
+        return float(np.sqrt(weights @ weights))
+
+    def to_bytes(self):
+        return self.ids.astype(ID_TYPE, copy=False).tobytes() + self.weights.astype(WEIGHT_TYPE, copy=False).tobytes()
+
+    @classmethod
+    def from_bytes(cls, blob):
+        """Decodes the blob without copying, the arrays are read-only views of it."""
+        vector = cls.__new__(cls)
+        n = len(blob) // (ID_TYPE.itemsize + WEIGHT_TYPE.itemsize)
+        vector.ids = np.frombuffer(blob, dtype=ID_TYPE, count=n)
+        vector.weights = np.frombuffer(blob, dtype=WEIGHT_TYPE, count=n, offset=n * ID_TYPE.itemsize)
+        return vector
+
+    @classmethod
+    def from_dict(cls, vector, term_ids):
+        """Converts a term -> weight dict using the term -> id mapping [term_ids]. Terms without an id are dropped."""
+        items = [(term_ids[term], weight) for term, weight in vector.items() if term in term_ids]
+        if not items:
+            return cls()
+        ids, weights = zip(*sorted(items))
+        return cls(ids, weights)
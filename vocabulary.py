@@ -0,0 +1,171 @@
+"""Persistent vocabulary and document frequencies shared by every batch of scraped papers.
+The tf-idf weights of all the papers are computed with the same vocabulary and idf, so their scores are comparable.
+The term ids are the same as the ids in the Term table."""
+from scipy.sparse import csr_matrix
+from collections import Counter
+import numpy as np
+import os
+
+VOCABULARY_PATH = 'vocabulary.npz'
+# Terms that appear in more than MAX_DF of the documents are ignored (the same as max_df in the TfidfVectorizer)
+MAX_DF = 0.9
+# The MAX_DF rule is applied only when the corpus is big enough, otherwise it would prune every term of the first batch
+MIN_DOCUMENTS_FOR_MAX_DF = 10
+# Paper vectors are re-weighted when the idf drifts more than this since they were last weighted
+DRIFT_THRESHOLD = 0.05
+
+class Vocabulary:
+    """Term ids, document frequencies and the idf that the stored paper vectors are weighted with.
+    New documents update the document frequencies incrementally, nothing is refitted."""
+
+    def __init__(self, terms=(), df=None, n_documents=0, weighted_idf=None, epoch=0, path=VOCABULARY_PATH):
+        self.path = path
+        # False only for the shared vocabulary until ensure_loaded() reads it from [path]
+        self.loaded = True
+        self.terms = list(terms)
+        self.index = {term: i for i, term in enumerate(self.terms) if term}
+        self.df = np.zeros(len(self.terms), dtype=np.int64) if df is None else df.astype(np.int64)
+        self.n_documents = int(n_documents)
+        # The idf that was used to weight the paper vectors currently stored in the database
+        self.weighted_idf = self.idf() if weighted_idf is None else weighted_idf.astype(np.float64)
+        # Incremented every time the paper vectors are re-weighted, so the indexes built from them know they are outdated
+        self.epoch = int(epoch)
+
+    def __len__(self):
+        return len(self.terms)
+
+    def idf(self):
+        """Smoothed idf, the same formula as in scikit-learn: ln((1 + n) / (1 + df)) + 1."""
+        return np.log((1 + self.n_documents) / (1 + self.df)) + 1
+
+    def add_terms(self, term_ids):
+        """Adds the terms from the term -> id dict [term_ids]. The ids come from the Term table, so the arrays are extended
+        up to the largest id and ids that this vocabulary hasn't seen yet are left as empty terms with df = 0."""
+        size = max(term_ids.values(), default=-1) + 1
+        if size > len(self.terms):
+            self.terms.extend([''] * (size - len(self.terms)))
+            self.df = np.concatenate([self.df, np.zeros(size - len(self.df), dtype=np.int64)])
+            self.weighted_idf = np.concatenate([self.weighted_idf, np.ones(size - len(self.weighted_idf))])
+        for term, i in term_ids.items():
+            self.terms[i] = term
+            self.index[term] = i
+
+    def add_documents(self, documents, assign_ids=None):
+        """Updates the document frequencies with a list of tokenized documents. New terms get the current idf as their weight.
+        [assign_ids] takes a list of new terms and returns a term -> id dict, by default the ids are assigned sequentially."""
+        new_terms = [token for token in dict.fromkeys(token for tokens in documents for token in tokens) if token not in self.index]
+        if assign_ids is None:
+            self.add_terms({term: len(self.terms) + i for i, term in enumerate(new_terms)})
+        else:
+            self.add_terms(assign_ids(new_terms))
+
+        ids, counts = self.document_frequencies(documents)
+        self.n_documents += len(documents)
+        self.df[ids] += counts
+        new_ids = [self.index[term] for term in new_terms if term in self.index]
+        self.weighted_idf[new_ids] = self.idf()[new_ids]
+
+    def remove_documents(self, documents):
+        """Takes back the document frequencies of documents added with add_documents(), e.g. when the papers made from them
+        couldn't be committed or were replaced by new versions. Their terms stay in the vocabulary."""
+        ids, counts = self.document_frequencies(documents)
+        self.n_documents -= len(documents)
+        self.df[ids] -= counts
+
+    def document_frequencies(self, documents):
+        """Returns the ids of the known terms of the tokenized documents and the number of documents they appear in."""
+        counts = Counter()
+        for tokens in documents:
+            for token in set(tokens):
+                if token in self.index:
+                    counts[self.index[token]] += 1
+        return (
+            np.fromiter(counts.keys(), dtype=np.int64, count=len(counts)),
+            np.fromiter(counts.values(), dtype=np.int64, count=len(counts))
+        )
+
+    def allowed(self):
+        """Returns a boolean mask of the terms that aren't pruned by MAX_DF."""
+        if self.n_documents < MIN_DOCUMENTS_FOR_MAX_DF:
+            return np.ones(len(self.terms), dtype=bool)
+        return self.df <= MAX_DF * self.n_documents
+
+    def counts(self, documents):
+        """Converts tokenized documents to a CSR matrix of term counts with a column for every term. Unknown terms are dropped."""
+        indptr = [0]
+        indices = []
+        data = []
+        for tokens in documents:
+            for token, count in Counter(tokens).items():
+                i = self.index.get(token)
+                if i is not None:
+                    indices.append(i)
+                    data.append(count)
+            indptr.append(len(indices))
+        return csr_matrix(
+            (np.array(data, dtype=np.float64), np.array(indices, dtype=np.int64), np.array(indptr, dtype=np.int64)),
+            shape=(len(documents), len(self.terms))
+        )
+
+    def weigh(self, counts):
+        """Converts a CSR matrix of term counts to L2 normalized tf-idf. The terms pruned by MAX_DF are dropped."""
+        result = csr_matrix(counts, dtype=np.float64, copy=True)
+        result.data *= (self.weighted_idf * self.allowed())[result.indices]
+        result.eliminate_zeros()
+        norms = np.sqrt(np.asarray(result.multiply(result).sum(axis=1)).ravel())
+        result.data /= np.repeat(np.where(norms > 0, norms, 1), np.diff(result.indptr))
+        return result
+
+    def transform(self, documents):
+        """Converts tokenized documents to an L2 normalized tf-idf CSR matrix with a column for every term."""
+        return self.weigh(self.counts(documents))
+
+    def drift(self):
+        """The mean relative change of the idf since the paper vectors were weighted, weighted by document frequency."""
+        if self.df.sum() == 0:
+            return 0.0
+        change = np.abs(self.idf() - self.weighted_idf) / self.weighted_idf
+        return float(np.average(change, weights=self.df))
+
+    def save(self, path=None):
+        """Saves the vocabulary to [path], by default to the file it was loaded from."""
+        path = path or self.path
+        # Writing to a temporary file first, so a crash never leaves a half written vocabulary
+        temporary = path + '.tmp.npz'
+        np.savez(
+            temporary,
+            terms=np.array(self.terms, dtype=str),
+            df=self.df,
+            n_documents=np.array(self.n_documents),
+            weighted_idf=self.weighted_idf,
+            epoch=np.array(self.epoch),
+        )
+        os.replace(temporary, path)
+
+    def ensure_loaded(self):
+        """Loads the vocabulary from its file on the first call, it stays empty if the file doesn't exist yet."""
+        if not self.loaded:
+            self.__dict__.update(Vocabulary.load(self.path).__dict__)
+
+    def stored_epoch(self):
+        """The epoch of the saved vocabulary, read without loading the terms and the frequencies."""
+        if self.loaded:
+            return self.epoch
+        if not os.path.exists(self.path):
+            return 0
+        with np.load(self.path) as data:
+            return int(data['epoch']) if 'epoch' in data else 0
+
+    @classmethod
+    def load(cls, path=VOCABULARY_PATH):
+        """Loads the vocabulary from [path], or returns an empty one if the file doesn't exist yet."""
+        if not os.path.exists(path):
+            return cls(path=path)
+        with np.load(path) as data:
+            epoch = data['epoch'] if 'epoch' in data else 0
+            return cls(data['terms'].tolist(), data['df'], data['n_documents'], data['weighted_idf'], epoch, path)
+
+# The vocabulary of the papers in the database. Only the scraper loads it (see ensure_loaded()), the web workers get the
+# epoch of the papers from the ranking engine
+vocabulary = Vocabulary()
+vocabulary.loaded = False